@@ -27,6 +27,7 @@ from dicom_receiver.config import (
     DEFAULT_CLEANUP_AFTER_UPLOAD,
     DEFAULT_MAX_RETRIES,
     DEFAULT_RETRY_DELAY,
+    DEFAULT_MAX_CONCURRENT_UPLOADS,
     PATIENT_INFO_MAP_FILENAME,
     print_config,
     ensure_dirs_exist
@@ -77,6 +78,8 @@ def main():
                        help=f'Maximum number of retry attempts for API operations (default/env: {DEFAULT_MAX_RETRIES})')
     parser.add_argument('--retry-delay', type=int, default=DEFAULT_RETRY_DELAY,
                        help=f'Delay in seconds between retry attempts (default/env: {DEFAULT_RETRY_DELAY})')
+    parser.add_argument('--max-concurrent-uploads', type=int, default=DEFAULT_MAX_CONCURRENT_UPLOADS,
+                       help=f'Maximum number of studies uploaded at the same time (default/env: {DEFAULT_MAX_CONCURRENT_UPLOADS})')
     
     parser.add_argument('--show-config', action='store_true',
                         help='Print the current configuration and exit')
@@ -110,6 +113,7 @@ def main():
         if args.cleanup_after_upload:
             logger.info("Cleanup after upload is enabled")
         logger.info(f"Upload retry mechanism: max_retries={args.max_retries}, retry_delay={args.retry_delay}s")
+        logger.info(f"Concurrent uploads: {args.max_concurrent_uploads}")
     
     storage = DicomStorage(args.storage)
     anonymizer = DicomAnonymizer(Path(args.storage))
@@ -154,7 +158,8 @@ def main():
         zip_dir=args.zip_dir,
         cleanup_after_upload=args.cleanup_after_upload,
         max_retries=args.max_retries,
-        retry_delay=args.retry_delay
+        retry_delay=args.retry_delay,
+        max_concurrent_uploads=args.max_concurrent_uploads
     )
     
     logger.info(f"Starting DICOM receiver with storage directory: {args.storage}")
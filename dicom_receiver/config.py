@@ -46,6 +46,9 @@ DEFAULT_CLEANUP_AFTER_UPLOAD = get_env_or_default('DICOM_RECEIVER_CLEANUP_AFTER_
 DEFAULT_MAX_RETRIES = int(get_env_or_default('DICOM_RECEIVER_MAX_RETRIES', 3))
 DEFAULT_RETRY_DELAY = int(get_env_or_default('DICOM_RECEIVER_RETRY_DELAY', 5))
 
+# Number of completed studies zipped and uploaded in parallel
+DEFAULT_MAX_CONCURRENT_UPLOADS = int(get_env_or_default('DICOM_RECEIVER_MAX_CONCURRENT_UPLOADS', 4))
+
 # Configure which patient information fields to encrypt
 # Environment variable format: comma-separated list of tags to encrypt
 ENV_PII_TAGS = get_env_or_default('DICOM_RECEIVER_PII_TAGS', None)
@@ -85,7 +88,8 @@ def get_config_dict():
         'zip_dir': DEFAULT_ZIP_DIR,
         'cleanup_after_upload': DEFAULT_CLEANUP_AFTER_UPLOAD,
         'max_retries': DEFAULT_MAX_RETRIES,
-        'retry_delay': DEFAULT_RETRY_DELAY
+        'retry_delay': DEFAULT_RETRY_DELAY,
+        'max_concurrent_uploads': DEFAULT_MAX_CONCURRENT_UPLOADS
     }
 
 def print_config():
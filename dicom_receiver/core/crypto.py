@@ -12,6 +12,8 @@ from typing import Dict, Optional
 import threading
 
 from pydicom import Dataset
+from pydicom.datadict import tag_for_keyword
+from pydicom.tag import Tag
 
 from dicom_receiver.config import PII_TAGS, PATIENT_INFO_MAP_FILENAME
 
@@ -39,13 +41,25 @@ class DicomAnonymizer:
             self.patient_info_map_file = self.storage_dir / PATIENT_INFO_MAP_FILENAME
         
         self.patient_name_map = {}  # Maps original patient names to anonymized names
+        self.reverse_name_map = {}  # Maps anonymized names back to original patient names
+        self._map_mtime = None  # Modification time of the map file when last read or written
+        self._restore_tags = {}  # Maps study UIDs to the (tag, original value) pairs to restore
         self.patient_info_map = self._load_patient_info_map()
         self.patient_counter = self._get_next_patient_counter()
         
         self.patient_map_lock = threading.Lock()
     
+    def _get_map_mtime(self) -> Optional[int]:
+        """Get the modification time of the map file, or None if it doesn't exist"""
+        try:
+            return self.patient_info_map_file.stat().st_mtime_ns
+        except OSError:
+            return None
+    
     def _load_patient_info_map(self) -> Dict:
         """Load the patient information mapping from disk"""
+        self._map_mtime = self._get_map_mtime()
+        self._restore_tags = {}
         if self.patient_info_map_file.exists():
             try:
                 with open(self.patient_info_map_file, 'r') as f:
@@ -55,6 +69,7 @@ class DicomAnonymizer:
                         # Load patient name mapping if it exists
                         if 'patient_name_map' in data:
                             self.patient_name_map = data['patient_name_map']
+                            self.reverse_name_map = {v: k for k, v in self.patient_name_map.items()}
                         
                         return data['patient_info']
                     else:
@@ -85,6 +100,7 @@ class DicomAnonymizer:
         # Create new anonymized name
         anon_name = f"sub-{self.patient_counter:03d}"
         self.patient_name_map[original_name] = anon_name
+        self.reverse_name_map[anon_name] = original_name
         self.patient_counter += 1
         
         logger.info(f"Created new anonymized patient name: {original_name} -> {anon_name}")
@@ -113,6 +129,25 @@ class DicomAnonymizer:
                             combined_map['patient_study_map'][patient_id].append(study_uid)
                 
                 json.dump(combined_map, f, indent=2)
+            
+            self._map_mtime = self._get_map_mtime()
+    
+    def reload_if_changed(self) -> bool:
+        """
+        Reload the mappings if another process or anonymizer has rewritten the map file
+        
+        Returns:
+        --------
+        bool: True if the mappings were reloaded
+        """
+        if self._get_map_mtime() == self._map_mtime:
+            return False
+        
+        with self.patient_map_lock:
+            self.patient_info_map = self._load_patient_info_map()
+            self.patient_counter = self._get_next_patient_counter()
+        logger.debug(f"Reloaded patient info map from {self.patient_info_map_file}")
+        return True
     
     def anonymize_dataset(self, dataset: Dataset) -> Dict:
         """
@@ -132,18 +167,26 @@ class DicomAnonymizer:
         # Get study UID for mapping
         study_uid = dataset.StudyInstanceUID
         
+        # Instances after the first of a study normally add nothing to the maps
+        map_changed = False
+        name_count = len(self.patient_name_map)
+        
         # Initialize map if needed
         if study_uid not in self.patient_info_map:
             self.patient_info_map[study_uid] = {}
+            map_changed = True
         
         # Process PII fields that exist in the dataset
         for tag in PII_TAGS:
-            if hasattr(dataset, tag) and getattr(dataset, tag):
-                value = str(getattr(dataset, tag))
+            # A single lookup per tag instead of hasattr() followed by two getattr() calls
+            value = dataset.get(tag)
+            if value:
+                value = str(value)
                 
                 # Store original value for later retrieval
                 if tag not in self.patient_info_map[study_uid]:
                     self.patient_info_map[study_uid][tag] = value
+                    map_changed = True
                 
                 # Save the original value
                 original_info[tag] = value
@@ -172,8 +215,9 @@ class DicomAnonymizer:
                 # Replace with the anonymized value
                 setattr(dataset, tag, anonymized_value)
         
-        # Save updated map to disk
-        self._save_patient_info_map()
+        # Save updated map to disk, skipping the rewrite when nothing new was recorded
+        if map_changed or len(self.patient_name_map) != name_count:
+            self._save_patient_info_map()
         
         return original_info
     
@@ -216,12 +260,33 @@ class DicomAnonymizer:
             logger.warning(f"No patient information found for study {study_uid}")
             return False
         
-        # Restore the original patient info
-        for tag, value in self.patient_info_map[study_uid].items():
-            if hasattr(dataset, tag):
-                setattr(dataset, tag, value)
+        # Restore the original patient info, only assigning values that differ
+        for tag, value in self._get_restore_tags(study_uid):
+            elem = dataset.get(tag)
+            if elem is not None and elem.value != value:
+                elem.value = value
         
         return True
+    
+    def _get_restore_tags(self, study_uid: str) -> list:
+        """
+        Get the (tag, original value) pairs recorded for a study
+        
+        Every instance of a retrieved study restores the same values, so the
+        keywords are resolved to tags once per study rather than per instance.
+        The cached pairs are rebuilt when anonymizing adds values for the study.
+        """
+        patient_info = self.patient_info_map[study_uid]
+        cached = self._restore_tags.get(study_uid)
+        if cached is None or cached[0] != len(patient_info):
+            restore_tags = []
+            for keyword, value in patient_info.items():
+                tag = tag_for_keyword(keyword)
+                if tag is not None:
+                    restore_tags.append((Tag(tag), value))
+            cached = (len(patient_info), restore_tags)
+            self._restore_tags[study_uid] = cached
+        return cached[1]
 
     # Backward compatibility methods
     def encrypt_dataset(self, dataset: Dataset) -> Dict:
@@ -16,7 +16,7 @@ logger = logging.getLogger('dicom_receiver.handlers.find')
 class FindHandler:
     """Handler for C-FIND operations"""
     
-    def __init__(self, storage, query_handler, anonymization_utils, api_integration_utils):
+    def __init__(self, storage, metadata_source, anonymization_utils, api_integration_utils):
         """
         Initialize the find handler
         
@@ -24,31 +24,39 @@ class FindHandler:
         -----------
         storage : DicomStorage
             Storage handler for local DICOM files
-        query_handler : DicomQueryHandler
-            Handler for API queries (can be None)
+        metadata_source : CachedMetadataSource
+            Shared cache of API metadata (can be None)
         anonymization_utils : AnonymizationUtils
             Utilities for de-anonymization
         api_integration_utils : ApiIntegrationUtils
             Utilities for API integration (can be None)
         """
         self.storage = storage
-        self.query_handler = query_handler
+        self.metadata_source = metadata_source
         self.anonymization_utils = anonymization_utils
         self.api_integration_utils = api_integration_utils
         
         # Initialize query handlers
         self.patient_handler = PatientQueryHandler(
-            storage, query_handler, anonymization_utils, api_integration_utils
+            storage, metadata_source, anonymization_utils, api_integration_utils
         )
         self.study_handler = StudyQueryHandler(
-            storage, query_handler, anonymization_utils, api_integration_utils
+            storage, metadata_source, anonymization_utils, api_integration_utils
         )
         self.series_handler = SeriesQueryHandler(
-            storage, query_handler, anonymization_utils, api_integration_utils
+            storage, metadata_source, anonymization_utils, api_integration_utils
         )
         self.image_handler = ImageQueryHandler(
-            storage, query_handler, anonymization_utils, api_integration_utils
+            storage, metadata_source, anonymization_utils, api_integration_utils
         )
+        
+        # Query method for each supported QueryRetrieveLevel
+        self.level_handlers = {
+            'PATIENT': self.patient_handler.find_patients,
+            'STUDY': self.study_handler.find_studies,
+            'SERIES': self.series_handler.find_series,
+            'IMAGE': self.image_handler.find_images,
+        }
     
     def handle_find(self, event):
         """Handle a C-FIND request"""
@@ -63,30 +71,29 @@ class FindHandler:
         query_level = getattr(query_ds, 'QueryRetrieveLevel', 'STUDY')
         logger.info(f"📋 Query Level: {query_level}")
         
-        # Log query parameters
-        logger.info("📝 Query Parameters:")
-        for tag in query_ds:
-            if hasattr(query_ds, tag.keyword) and tag.keyword:
-                value = getattr(query_ds, tag.keyword, '')
+        # Log query parameters as a single record, reading the element values directly
+        if logger.isEnabledFor(logging.INFO):
+            lines = ["📝 Query Parameters:"]
+            for elem in query_ds:
+                if not elem.keyword:
+                    continue
+                value = elem.value
                 if value:
                     # Avoid logging binary data - truncate long values
                     if isinstance(value, (str, int, float)):
-                        display_value = str(value)[:100] + "..." if len(str(value)) > 100 else str(value)
+                        text = str(value)
+                        display_value = text[:100] + "..." if len(text) > 100 else text
                     else:
                         display_value = f"<{type(value).__name__}>"
-                    logger.info(f"   {tag.keyword}: {display_value}")
+                    lines.append(f"   {elem.keyword}: {display_value}")
                 else:
-                    logger.info(f"   {tag.keyword}: <empty> (requesting this field)")
+                    lines.append(f"   {elem.keyword}: <empty> (requesting this field)")
+            logger.info("\n".join(lines))
         
         try:
-            if query_level == 'PATIENT':
-                yield from self.patient_handler.find_patients(query_ds)
-            elif query_level == 'STUDY':
-                yield from self.study_handler.find_studies(query_ds)
-            elif query_level == 'SERIES':
-                yield from self.series_handler.find_series(query_ds)
-            elif query_level == 'IMAGE':
-                yield from self.image_handler.find_images(query_ds)
+            find = self.level_handlers.get(query_level)
+            if find is not None:
+                yield from find(query_ds)
             else:
                 logger.warning(f"❌ Unsupported query level: {query_level}")
                 yield 0xC000, None  # Unable to process
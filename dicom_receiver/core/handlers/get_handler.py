@@ -6,11 +6,26 @@ Handles C-GET download requests (currently disabled due to presentation context
 """
 
 import logging
+from functools import partial
 from pathlib import Path
 from io import BytesIO
 
+from pydicom import Dataset
+from pydicom.tag import Tag
+
+from dicom_receiver.core.handlers.prefetch import prefetch_datasets
+
 logger = logging.getLogger('dicom_receiver.handlers.get')
 
+# Element values larger than this are read lazily (only header tags are de-anonymized)
+DEFER_SIZE = '16 KB'
+
+# Sub-operations between progress messages; per-file messages are logged at debug level
+PROGRESS_LOG_INTERVAL = 100
+
+# SOPInstanceUID, the only element parsed when picking requested instances out of a series
+SOP_INSTANCE_UID_TAG = Tag(0x0008, 0x0018)
+
 class GetHandler:
     """Handler for C-GET operations (currently disabled)"""
     
@@ -47,18 +62,22 @@ class GetHandler:
         query_level = getattr(query_ds, 'QueryRetrieveLevel', 'STUDY')
         logger.info(f"📋 Query Level: {query_level}")
         
-        # Log query parameters
-        logger.info("📝 Query Parameters:")
-        for tag in query_ds:
-            if hasattr(query_ds, tag.keyword) and tag.keyword:
-                value = getattr(query_ds, tag.keyword, '')
+        # Log query parameters as a single record, reading the element values directly
+        if logger.isEnabledFor(logging.INFO):
+            lines = ["📝 Query Parameters:"]
+            for elem in query_ds:
+                if not elem.keyword:
+                    continue
+                value = elem.value
                 if value:
                     # Avoid logging binary data - truncate long values
                     if isinstance(value, (str, int, float)):
-                        display_value = str(value)[:100] + "..." if len(str(value)) > 100 else str(value)
+                        text = str(value)
+                        display_value = text[:100] + "..." if len(text) > 100 else text
                     else:
                         display_value = f"<{type(value).__name__}>"
-                    logger.info(f"   {tag.keyword}: {display_value}")
+                    lines.append(f"   {elem.keyword}: {display_value}")
+            logger.info("\n".join(lines))
         
         def get_generator():
             try:
@@ -82,53 +101,53 @@ class GetHandler:
                 
                 logger.info(f"Using transfer syntax: {preferred_syntax}")
                 
-                # Get files based on query level
-                files = self._get_files_for_query(query_ds, query_level)
+                # Get files based on query level (API downloads may be streamed)
+                total_files, files = self._get_files_for_query(query_ds, query_level)
                 
-                if not files:
+                if total_files == 0:
                     logger.warning("❌ No files found for C-GET request")
                     yield 0  # No sub-operations to perform
                     return
                 
-                logger.info(f"Found {len(files)} files to send")
-                yield len(files)
+                logger.info(f"Found {total_files} files to send")
+                yield total_files
                 
                 # Track successful and failed transfers
                 successful_transfers = 0
                 failed_transfers = 0
                 
-                # Send each file
-                for i, file_path in enumerate(files, 1):
+                # Send each file, the next ones being read and de-anonymized
+                # on a worker thread while pynetdicom sends the current one
+                load = partial(self._load_dataset, preferred_syntax=preferred_syntax)
+                for i, (file_path, ds) in enumerate(prefetch_datasets(files, load, 'cget-prefetch'), 1):
                     try:
-                        if isinstance(file_path, bytes):
-                            # File data from API
-                            logger.info(f"Processing API file {i}/{len(files)}")
-                            ds = self._load_dataset_from_bytes(file_path, preferred_syntax)
-                        else:
-                            # Local file path
-                            logger.info(f"Processing local file {i}/{len(files)}: {Path(file_path).name}")
-                            ds = self._load_dataset_from_file(file_path, preferred_syntax)
+                        if logger.isEnabledFor(logging.DEBUG):
+                            if isinstance(file_path, (str, Path)):
+                                logger.debug(f"Processing local file {i}/{total_files}: {Path(file_path).name}")
+                            else:
+                                logger.debug(f"Processing API file {i}/{total_files}")
                         
                         if ds:
-                            logger.info(f"Yielding dataset {i}/{len(files)}")
                             yield (0xFF00, ds)
-                            logger.info(f"Successfully sent file {i}/{len(files)}")
+                            logger.debug(f"Successfully sent file {i}/{total_files}")
                             successful_transfers += 1
+                            if i % PROGRESS_LOG_INTERVAL == 0:
+                                logger.info(f"📤 Sent {i}/{total_files} files")
                         else:
-                            logger.warning(f"Failed to load dataset {i}/{len(files)}")
+                            logger.warning(f"Failed to load dataset {i}/{total_files}")
                             failed_transfers += 1
                             
                     except Exception as e:
-                        logger.error(f"Error sending file {i}/{len(files)}: {str(e)}")
+                        logger.error(f"Error sending file {i}/{total_files}: {str(e)}")
                         failed_transfers += 1
                         continue
                 
                 # Final status based on transfer results
                 if failed_transfers == 0:
-                    logger.info(f"✅ C-GET completed successfully: {successful_transfers}/{len(files)} files sent")
+                    logger.info(f"✅ C-GET completed successfully: {successful_transfers}/{total_files} files sent")
                     # Don't yield final status - pynetdicom handles this automatically
                 elif successful_transfers > 0:
-                    logger.warning(f"⚠️ C-GET completed with warnings: {successful_transfers}/{len(files)} files sent, {failed_transfers} failed")
+                    logger.warning(f"⚠️ C-GET completed with warnings: {successful_transfers}/{total_files} files sent, {failed_transfers} failed")
                     # Don't yield final status - pynetdicom handles this automatically
                 else:
                     logger.error(f"❌ C-GET failed: no files could be sent")
@@ -143,55 +162,73 @@ class GetHandler:
         return get_generator()
     
     def _get_files_for_query(self, query_ds, query_level):
-        """Get files based on the query level and parameters"""
+        """
+        Get files based on the query level and parameters
+        
+        Returns:
+        --------
+        tuple
+            (number of files, iterable of file paths or file bytes)
+        """
         try:
             if query_level == 'STUDY':
                 return self._get_study_files(query_ds)
             elif query_level == 'SERIES':
-                return self._get_series_files(query_ds)
+                files = self._get_series_files(query_ds)
             elif query_level == 'IMAGE':
-                return self._get_image_files(query_ds)
+                files = self._get_image_files(query_ds)
             else:
                 logger.warning(f"❌ Unsupported C-GET level: {query_level}")
-                return []
+                files = []
+            return len(files), files
         except Exception as e:
             logger.error(f"Error getting files for query: {e}")
-            return []
+            return 0, iter(())
     
     def _get_study_files(self, query_ds):
-        """Get all files for a study"""
+        """
+        Get all files for a study
+        
+        The study is streamed from the API download one file at a time instead of
+        holding every file of the study in memory.
+        
+        Returns:
+        --------
+        tuple
+            (number of files, iterable of file bytes)
+        """
         study_uid = getattr(query_ds, 'StudyInstanceUID', None)
         if not study_uid:
             logger.warning("❌ No StudyInstanceUID provided for C-GET")
-            return []
+            return 0, iter(())
         
         logger.info(f"🔍 Getting files for study: {study_uid}")
         
         if not self.query_handler or not self.api_integration_utils:
             logger.warning("❌ No API access configured for download")
-            return []
+            return 0, iter(())
         
         try:
             # Get the result_id for this study
             result_id = self.api_integration_utils.get_result_id_for_study(study_uid)
             if not result_id:
                 logger.warning(f"❌ No result_id found for study: {study_uid}")
-                return []
+                return 0, iter(())
             
             # Download the study ZIP from API
             logger.info(f"🌐 Downloading study from API (result_id: {result_id})")
-            dicom_files = self.api_integration_utils.download_study_from_api(result_id, study_uid)
+            total_files, dicom_files = self.api_integration_utils.stream_study_from_api(result_id, study_uid)
             
-            if not dicom_files:
+            if total_files == 0:
                 logger.warning(f"❌ Failed to download study: {study_uid}")
-                return []
+                return 0, iter(())
             
-            logger.info(f"📤 Downloaded {len(dicom_files)} files from API")
-            return dicom_files
+            logger.info(f"📤 Downloaded {total_files} files from API")
+            return total_files, dicom_files
             
         except Exception as e:
             logger.error(f"❌ Error downloading study {study_uid}: {e}")
-            return []
+            return 0, iter(())
     
     def _get_series_files(self, query_ds):
         """Get all files for a series"""
@@ -273,11 +310,16 @@ class GetHandler:
             filtered_files = []
             for file_data in dicom_files:
                 try:
+                    if isinstance(file_data, Dataset):
+                        # Already parsed by the series download
+                        if getattr(file_data, 'SOPInstanceUID', None) in sop_uids:
+                            filtered_files.append(file_data)
                     # If file_data is bytes, we need to read it to check SOP Instance UID
-                    if isinstance(file_data, bytes):
+                    elif isinstance(file_data, bytes):
                         from pydicom import dcmread
                         from io import BytesIO
-                        ds = dcmread(BytesIO(file_data), stop_before_pixels=True)
+                        ds = dcmread(BytesIO(file_data), stop_before_pixels=True,
+                                     specific_tags=[SOP_INSTANCE_UID_TAG])
                         file_sop_uid = getattr(ds, 'SOPInstanceUID', None)
                         if file_sop_uid in sop_uids:
                             filtered_files.append(file_data)
@@ -299,14 +341,21 @@ class GetHandler:
             logger.error(f"❌ Error downloading instances: {e}")
             return []
     
+    def _load_dataset(self, file_path, preferred_syntax):
+        """Load and prepare a dataset from a local file path or an API file (bytes or Dataset)"""
+        if isinstance(file_path, (str, Path)):
+            return self._load_dataset_from_file(file_path, preferred_syntax)
+        return self._load_dataset_from_bytes(file_path, preferred_syntax)
+    
     def _load_dataset_from_file(self, file_path, preferred_syntax):
         """Load and prepare a dataset from a local file"""
         try:
             from pydicom import dcmread
             import pydicom
             
-            # Read the DICOM file
-            ds = dcmread(file_path, force=True)
+            # Read the DICOM file, leaving large values such as PixelData unparsed
+            # until pynetdicom encodes them for C-STORE
+            ds = dcmread(file_path, force=True, defer_size=DEFER_SIZE)
             
             # De-anonymize patient information
             self.anonymization_utils.de_anonymize_dataset(ds)
@@ -335,9 +384,10 @@ class GetHandler:
             # Ensure the dataset is properly encoded
             ds.fix_meta_info(enforce_standard=True)
             
-            patient_name = getattr(ds, 'PatientName', 'Unknown')
-            sop_uid = getattr(ds, 'SOPInstanceUID', 'Unknown')[:16] + "..." if len(getattr(ds, 'SOPInstanceUID', '')) > 16 else getattr(ds, 'SOPInstanceUID', 'Unknown')
-            logger.info(f"📤 Prepared local file: {Path(file_path).name} (Patient: {patient_name}, SOP: {sop_uid})")
+            if logger.isEnabledFor(logging.DEBUG):
+                patient_name = getattr(ds, 'PatientName', 'Unknown')
+                sop_uid = getattr(ds, 'SOPInstanceUID', 'Unknown')[:16] + "..." if len(getattr(ds, 'SOPInstanceUID', '')) > 16 else getattr(ds, 'SOPInstanceUID', 'Unknown')
+                logger.debug(f"📤 Prepared local file: {Path(file_path).name} (Patient: {patient_name}, SOP: {sop_uid})")
             return ds
             
         except Exception as e:
@@ -345,13 +395,18 @@ class GetHandler:
             return None
     
     def _load_dataset_from_bytes(self, file_data, preferred_syntax):
-        """Load and prepare a dataset from bytes (API download)"""
+        """Load and prepare a dataset from bytes or an already parsed Dataset (API download)"""
         try:
             from pydicom import dcmread
             import pydicom
             
-            # Read DICOM from bytes
-            ds = dcmread(BytesIO(file_data), force=True)
+            if isinstance(file_data, Dataset):
+                # Series downloads hand over the datasets they parsed
+                ds = file_data
+            else:
+                # Read DICOM from bytes, deferring large values; the dataset keeps a
+                # reference to the buffer for the deferred read
+                ds = dcmread(BytesIO(file_data), force=True, defer_size=DEFER_SIZE)
             
             # De-anonymize patient information
             self.anonymization_utils.de_anonymize_dataset(ds)
@@ -380,9 +435,10 @@ class GetHandler:
             # Ensure the dataset is properly encoded
             ds.fix_meta_info(enforce_standard=True)
             
-            patient_name = getattr(ds, 'PatientName', 'Unknown')
-            sop_uid = getattr(ds, 'SOPInstanceUID', 'Unknown')[:16] + "..." if len(getattr(ds, 'SOPInstanceUID', '')) > 16 else getattr(ds, 'SOPInstanceUID', 'Unknown')
-            logger.info(f"📤 Prepared API file: SOP: {sop_uid} (Patient: {patient_name})")
+            if logger.isEnabledFor(logging.DEBUG):
+                patient_name = getattr(ds, 'PatientName', 'Unknown')
+                sop_uid = getattr(ds, 'SOPInstanceUID', 'Unknown')[:16] + "..." if len(getattr(ds, 'SOPInstanceUID', '')) > 16 else getattr(ds, 'SOPInstanceUID', 'Unknown')
+                logger.debug(f"📤 Prepared API file: SOP: {sop_uid} (Patient: {patient_name})")
             return ds
             
         except Exception as e:
@@ -7,15 +7,39 @@ C-MOVE is more widely supported than C-GET by DICOM viewers like Horos.
 """
 
 import logging
+from dataclasses import dataclass, field
 from pathlib import Path
 from io import BytesIO
+from typing import Any, Dict, Optional
 
-from pydicom import dcmread
+from pydicom import Dataset, dcmread
 
 from dicom_receiver.core.config import AEConfiguration
+from dicom_receiver.core.handlers.prefetch import prefetch_datasets
 
 logger = logging.getLogger('dicom_receiver.handlers.move')
 
+# Element values larger than this are read lazily (only header tags are de-anonymized)
+DEFER_SIZE = '16 KB'
+
+# Sub-operations between progress messages; per-file messages are logged at debug level
+PROGRESS_LOG_INTERVAL = 100
+
+# Identifier fields that are logged even when empty
+KEY_IDENTIFIER_FIELDS = frozenset([
+    'QueryRetrieveLevel', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'PatientID'
+])
+
+@dataclass
+class QueryParams:
+    """Query parameters extracted from a C-MOVE identifier"""
+    query_level: str = 'STUDY'
+    study_uid: Optional[str] = None
+    series_uid: Any = None
+    sop_uid: Any = None
+    patient_id: Optional[str] = None
+    params_dict: Dict[str, str] = field(default_factory=dict)
+
 class MoveHandler:
     """
     Handler for DICOM C-MOVE operations
@@ -78,42 +102,14 @@ class MoveHandler:
             logger.info(f"🔄 C-MOVE request received")
             logger.info(f"📍 Move Destination AE: {move_destination}")
             
-            # Get the identifier and log query parameters
-            identifier = request.Identifier
-            query_level = getattr(identifier, 'QueryRetrieveLevel', 'STUDY')
+            # Walk the identifier once to log it and extract the query parameters
+            params = self._parse_identifier(request.Identifier)
+            query_level = params.query_level
+            study_uid = params.study_uid
             logger.info(f"🔍 Query Level: {query_level}")
-            
-            # Debug: Log the raw identifier structure
-            logger.info(f"🔍 Raw identifier elements:")
-            for elem in identifier:
-                # Avoid logging binary data
-                if elem.value is not None:
-                    if isinstance(elem.value, (str, int, float)):
-                        display_value = str(elem.value)[:100] + "..." if len(str(elem.value)) > 100 else str(elem.value)
-                    else:
-                        display_value = f"<{type(elem.value).__name__}>"
-                else:
-                    display_value = "None"
-                logger.info(f"   {elem.keyword} ({elem.tag}): {display_value} (VR: {elem.VR})")
-            
-            # Log the query parameters
-            query_params = {}
-            for elem in identifier:
-                if elem.value and str(elem.value).strip():
-                    query_params[elem.keyword] = str(elem.value).strip()
-                elif elem.keyword in ['QueryRetrieveLevel', 'StudyInstanceUID', 'SeriesInstanceUID', 'SOPInstanceUID', 'PatientID']:
-                    # Log important fields even if empty
-                    query_params[elem.keyword] = str(elem.value) if elem.value else '<empty>'
-            
-            logger.info(f"🔍 Query parameters: {query_params}")
-            
-            # Extract StudyInstanceUID directly from identifier
-            study_uid = None
-            for elem in identifier:
-                if elem.keyword == 'StudyInstanceUID' and elem.value:
-                    study_uid = str(elem.value).strip()
-                    logger.info(f"🔍 Extracted StudyInstanceUID: {study_uid}")
-                    break
+            logger.info(f"🔍 Query parameters: {params.params_dict}")
+            if study_uid:
+                logger.info(f"🔍 Extracted StudyInstanceUID: {study_uid}")
             
             # Get the destination AE's network address from configuration
             destination_ip, destination_port = self.ae_config.get_ae_address(move_destination)
@@ -121,55 +117,47 @@ class MoveHandler:
             
             # Always use API since files are cleaned up after upload
             # and API results are new/processed files that don't exist locally
-            temp_api_files = []
+            # Files are streamed from the API so each one can be sent as soon as it is read
+            total_files = 0
+            api_files = iter(())
             if self.api_integration_utils:
                 logger.info("📡 Downloading files from API...")
-                temp_api_files = self._find_api_files(identifier, study_uid)
+                total_files, api_files = self._find_api_files(params)
             else:
                 logger.warning("❌ No API access configured for download")
             
-            total_temp_files = len(temp_api_files)
-            
-            if total_temp_files == 0:
+            if total_files == 0:
                 logger.warning("❌ No matching files found for C-MOVE request")
                 logger.warning(f"   Searched for StudyInstanceUID: {study_uid}")
                 logger.warning(f"   Query Level: {query_level}")
                 yield 0xA701  # Refused: Out of Resources - Unable to perform sub-operations
                 return
             
-            logger.info(f"📁 Found {total_temp_files} files to move from API")
+            logger.info(f"📁 Found {total_files} files to move from API")
             logger.info(f"🚀 Initiating C-MOVE to {move_destination} at {destination_ip}:{destination_port}")
             
             # First yield the destination address (required by pynetdicom for C-MOVE)
             yield (destination_ip, destination_port)
             
-            # Use the files we already found
-            api_files = temp_api_files
-            total_files = total_temp_files
-            
             # Yield the number of sub-operations
             yield total_files
             
             sent_count = 0
             
-            # Yield API files as datasets
-            for file_data in api_files:
-                try:
-                    # Read the DICOM dataset from bytes
-                    ds = dcmread(BytesIO(file_data))
-                    
-                    # De-anonymize patient information
-                    self.anonymization_utils.de_anonymize_dataset(ds)
-                    
-                    sent_count += 1
-                    logger.info(f"📤 Yielding API file {sent_count}/{total_files}")
-                    
-                    # Yield the dataset - pynetdicom will handle the C-STORE
-                    yield 0xFF00, ds  # Pending with dataset
-                    
-                except Exception as e:
-                    logger.error(f"❌ Error processing API file: {e}")
+            # Yield API files as datasets, the next ones being read and de-anonymized
+            # on a worker thread while pynetdicom sends the current one
+            for file_data, ds in prefetch_datasets(api_files, self._load_api_dataset, 'cmove-prefetch'):
+                if ds is None:
                     yield 0xB000  # Warning: Sub-operations Complete - One or more Failures
+                    continue
+                
+                sent_count += 1
+                logger.debug(f"📤 Yielding API file {sent_count}/{total_files}")
+                if sent_count % PROGRESS_LOG_INTERVAL == 0:
+                    logger.info(f"📤 Yielded {sent_count}/{total_files} files")
+                
+                # Yield the dataset - pynetdicom will handle the C-STORE
+                yield 0xFF00, ds  # Pending with dataset
             
             # Final status
             logger.info(f"🎉 C-MOVE completed: {sent_count}/{total_files} files yielded to pynetdicom for transmission")
@@ -179,17 +167,91 @@ class MoveHandler:
             logger.error(f"❌ Error in C-MOVE handler: {e}")
             yield 0xA701  # Refused: Out of Resources - Unable to perform sub-operations
     
-    def _find_local_files(self, identifier, study_uid=None):
+    def _load_api_dataset(self, file_data):
+        """Read and de-anonymize a file downloaded from the API, or return None on failure"""
+        try:
+            if isinstance(file_data, Dataset):
+                # Series downloads hand over the datasets they parsed
+                ds = file_data
+            else:
+                # Read the DICOM dataset from bytes, leaving large values such as
+                # PixelData unparsed until pynetdicom encodes them for C-STORE.
+                # The dataset keeps a reference to the buffer for the deferred read.
+                ds = dcmread(BytesIO(file_data), defer_size=DEFER_SIZE)
+            
+            # De-anonymize patient information
+            self.anonymization_utils.de_anonymize_dataset(ds)
+            return ds
+            
+        except Exception as e:
+            logger.error(f"❌ Error processing API file: {e}")
+            return None
+    
+    def _parse_identifier(self, identifier):
+        """
+        Extract the query parameters from an identifier in a single pass
+        
+        Parameters:
+        -----------
+        identifier : Dataset
+            The C-MOVE request identifier
+            
+        Returns:
+        --------
+        QueryParams
+            The query level, UIDs and loggable parameters of the request
+        """
+        params = QueryParams()
+        
+        logger.info(f"🔍 Raw identifier elements:")
+        for elem in identifier:
+            keyword = elem.keyword
+            value = elem.value
+            
+            # Avoid logging binary data
+            if value is not None:
+                if isinstance(value, (str, int, float)):
+                    display_value = str(value)[:100] + "..." if len(str(value)) > 100 else str(value)
+                else:
+                    display_value = f"<{type(value).__name__}>"
+            else:
+                display_value = "None"
+            logger.info(f"   {keyword} ({elem.tag}): {display_value} (VR: {elem.VR})")
+            
+            text = str(value).strip() if value else ''
+            if text:
+                params.params_dict[keyword] = text
+            elif keyword in KEY_IDENTIFIER_FIELDS:
+                # Log important fields even if empty
+                params.params_dict[keyword] = str(value) if value else '<empty>'
+            
+            if not text:
+                continue
+            
+            # Multi-valued UIDs are kept as-is so they can be matched individually
+            uid = value.strip() if isinstance(value, str) else value
+            if keyword == 'QueryRetrieveLevel':
+                params.query_level = text
+            elif keyword == 'StudyInstanceUID':
+                params.study_uid = text
+            elif keyword == 'SeriesInstanceUID':
+                params.series_uid = uid
+            elif keyword == 'SOPInstanceUID':
+                params.sop_uid = uid
+            elif keyword == 'PatientID':
+                params.patient_id = text
+        
+        return params
+    
+    def _find_local_files(self, params):
         """Find matching files in local storage"""
         try:
             # Use the same logic as the find handler to locate files
             files = []
-            
-            # Get query level
-            query_level = getattr(identifier, 'QueryRetrieveLevel', 'STUDY')
+            query_level = params.query_level
             
             if query_level == 'PATIENT':
-                patient_id = getattr(identifier, 'PatientID', None)
+                patient_id = params.patient_id
                 if patient_id:
                     # Find all studies for this patient
                     patient_dir = self.storage.storage_dir / patient_id
@@ -199,13 +261,8 @@ class MoveHandler:
                                 files.extend(self._get_all_files_in_study(study_dir))
             
             elif query_level == 'STUDY':
-                # Use the passed study_uid or extract from identifier
-                if not study_uid:
-                    study_uid = getattr(identifier, 'StudyInstanceUID', None)
-                    if study_uid:
-                        study_uid = str(study_uid).strip()
-                
-                if study_uid and study_uid.strip():
+                study_uid = params.study_uid
+                if study_uid:
                     logger.info(f"🔍 Looking for study: {study_uid}")
                     study_dir = self.storage.get_study_path_by_uid(study_uid)
                     if study_dir and study_dir.exists():
@@ -217,34 +274,24 @@ class MoveHandler:
                     logger.warning("❌ No StudyInstanceUID provided for STUDY level query")
             
             elif query_level == 'SERIES':
-                series_uid = getattr(identifier, 'SeriesInstanceUID', None)
+                series_uid = params.series_uid
                 if series_uid:
                     # Find series across all studies
                     for patient_dir in self.storage.storage_dir.iterdir():
                         if patient_dir.is_dir():
                             for study_dir in patient_dir.iterdir():
                                 if study_dir.is_dir():
-                                    series_dir = study_dir / series_uid
+                                    series_dir = study_dir / str(series_uid)
                                     if series_dir.exists():
                                         files.extend(self._get_all_files_in_series(series_dir))
             
             elif query_level == 'IMAGE':
-                sop_uid = getattr(identifier, 'SOPInstanceUID', None)
+                sop_uid = params.sop_uid
                 if sop_uid:
-                    # Find specific image across all studies
-                    for patient_dir in self.storage.storage_dir.iterdir():
-                        if patient_dir.is_dir():
-                            for study_dir in patient_dir.iterdir():
-                                if study_dir.is_dir():
-                                    for series_dir in study_dir.iterdir():
-                                        if series_dir.is_dir():
-                                            for file_path in series_dir.glob('*.dcm'):
-                                                try:
-                                                    ds = dcmread(file_path, stop_before_pixels=True)
-                                                    if getattr(ds, 'SOPInstanceUID', None) == sop_uid:
-                                                        files.append(file_path)
-                                                except:
-                                                    continue
+                    # Look up the specific image directly instead of reading every stored file
+                    file_path = self.storage.get_instance_path_by_uid(str(sop_uid))
+                    if file_path:
+                        files.append(file_path)
             
             return files
             
@@ -252,44 +299,44 @@ class MoveHandler:
             logger.error(f"Error finding local files: {e}")
             return []
     
-    def _find_api_files(self, identifier, study_uid=None):
-        """Find matching files from API and download them"""
+    def _find_api_files(self, params):
+        """
+        Find matching files from the API
+        
+        Returns:
+        --------
+        tuple
+            (number of files, iterable of file bytes)
+        """
         try:
             if not self.api_integration_utils:
-                return []
+                return 0, iter(())
             
             # Use the API integration utils to download files
-            query_level = getattr(identifier, 'QueryRetrieveLevel', 'STUDY')
+            query_level = params.query_level
             
             if query_level == 'STUDY':
-                # Use the passed study_uid or extract from identifier
-                if not study_uid:
-                    study_uid = getattr(identifier, 'StudyInstanceUID', None)
-                    if study_uid:
-                        study_uid = str(study_uid).strip()
-                
-                if study_uid and study_uid.strip():
-                    logger.info(f"🌐 Downloading study from API: {study_uid}")
-                    return self.api_integration_utils.download_study_files(study_uid)
+                if params.study_uid:
+                    logger.info(f"🌐 Downloading study from API: {params.study_uid}")
+                    return self.api_integration_utils.stream_study_files(params.study_uid)
             
             elif query_level == 'SERIES':
-                series_uid = getattr(identifier, 'SeriesInstanceUID', None)
-                study_uid = getattr(identifier, 'StudyInstanceUID', None)
-                if series_uid:
-                    return self.api_integration_utils.download_series_files(series_uid, study_uid)
+                if params.series_uid:
+                    files = self.api_integration_utils.download_series_files(params.series_uid, params.study_uid)
+                    return len(files), files
             
             elif query_level == 'IMAGE':
-                sop_uid = getattr(identifier, 'SOPInstanceUID', None)
-                series_uid = getattr(identifier, 'SeriesInstanceUID', None)
-                study_uid = getattr(identifier, 'StudyInstanceUID', None)
-                if sop_uid:
-                    return self.api_integration_utils.download_image_files(sop_uid, series_uid, study_uid)
+                if params.sop_uid:
+                    files = self.api_integration_utils.download_image_files(
+                        params.sop_uid, params.series_uid, params.study_uid
+                    )
+                    return len(files), files
             
-            return []
+            return 0, iter(())
             
         except Exception as e:
             logger.error(f"Error finding API files: {e}")
-            return []
+            return 0, iter(())
     
     def _get_all_files_in_study(self, study_dir):
         """Get all DICOM files in a study directory"""
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Read-ahead for C-GET and C-MOVE sub-operations
+
+Loads the next datasets of a retrieval on a worker thread while pynetdicom
+sends the current one with C-STORE
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Files read and prepared ahead of the one being sent with C-STORE
+PREFETCH_DEPTH = 4
+
+# Returned by the worker once the files are exhausted
+_NO_MORE_FILES = object()
+
+def prefetch_datasets(files, load, thread_name='prefetch', depth=PREFETCH_DEPTH):
+    """
+    Load the datasets of a retrieval ahead of the one being sent
+
+    A single worker thread pulls the next files (reading them out of the
+    downloaded ZIP for API studies) and loads them, with at most `depth` files
+    loaded ahead of the C-STORE in progress. Files are yielded in order.
+
+    Parameters:
+    -----------
+    files : iterable
+        File paths or file bytes to send
+    load : callable
+        Parses and prepares one file, returning a Dataset or None if it could
+        not be loaded; it should not raise
+    thread_name : str
+        Name prefix of the worker thread
+    depth : int
+        Number of files loaded ahead
+
+    Yields:
+    -------
+    tuple
+        (file path or bytes, Dataset or None)
+    """
+    files = iter(files)
+
+    def load_next():
+        # Only ever runs on the single worker thread, so the files
+        # iterator is never advanced concurrently
+        file = next(files, _NO_MORE_FILES)
+        if file is _NO_MORE_FILES:
+            return _NO_MORE_FILES
+        return file, load(file)
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=thread_name)
+    pending = deque(executor.submit(load_next) for _ in range(depth))
+    try:
+        while True:
+            loaded = pending.popleft().result()
+            if loaded is _NO_MORE_FILES:
+                break
+            pending.append(executor.submit(load_next))
+            yield loaded
+    finally:
+        # Also reached when the association goes away mid-transfer
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        close = getattr(files, 'close', None)
+        if close:
+            # Closes the downloaded study ZIP
+            close()
@@ -6,13 +6,31 @@ Handles incoming DICOM file storage requests
 """
 
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pydicom
+from pydicom.filereader import read_dataset
+from pydicom.uid import ExplicitVRLittleEndian
 
 logger = logging.getLogger('dicom_receiver.handlers.store')
 
+# Serialized instances waiting to be written before C-STORE requests are held back
+MAX_PENDING_WRITES = 64
+
+# Float, Double Float and plain Pixel Data
+PIXEL_DATA_TAGS = frozenset([0x7FE00008, 0x7FE00009, 0x7FE00010])
+
+def _at_pixel_data(tag, vr, length):
+    """Stop condition for reading a dataset up to its pixel data"""
+    return tag in PIXEL_DATA_TAGS
+
 class StoreHandler:
     """Handler for C-STORE operations"""
     
-    def __init__(self, storage, study_monitor, encryptor):
+    def __init__(self, storage, study_monitor, encryptor, write_workers: int = 0,
+                 max_pending_writes: int = MAX_PENDING_WRITES):
         """
         Initialize the store handler
         
@@ -24,21 +42,37 @@ class StoreHandler:
             Monitor for tracking study completion
         encryptor : DicomEncryptor/DicomAnonymizer
             Encryptor/anonymizer for patient information
+        write_workers : int
+            Threads writing stored files in the background (0 writes them
+            before the C-STORE response is sent)
+        max_pending_writes : int
+            Maximum number of files waiting for a write worker
         """
         self.storage = storage
         self.study_monitor = study_monitor
         self.encryptor = encryptor
+        
+        # Files queued or being written per StudyInstanceUID (see wait_for_writes)
+        self._study_writes = {}
+        self._writes_done = threading.Condition()
+        
+        self.write_executor = None
+        if write_workers > 0:
+            self.write_executor = ThreadPoolExecutor(
+                max_workers=write_workers, thread_name_prefix='store'
+            )
+            self.pending_writes = threading.BoundedSemaphore(max_pending_writes)
     
     def handle_store(self, event):
         """Handle a C-STORE request"""
-        dataset = event.dataset
+        dataset, pixel_offset = self._decode_header(event)
         
         study_uid = dataset.StudyInstanceUID
         series_uid = dataset.SeriesInstanceUID
         instance_uid = dataset.SOPInstanceUID
         
         # Log PatientID before processing
-        patient_id_before = getattr(dataset, 'PatientID', 'NOT_FOUND')
+        patient_id_before = dataset.get('PatientID', 'NOT_FOUND')
         logger.info(f"📥 Storing DICOM - PatientID: '{patient_id_before}', Study: {study_uid}")
         
         self.study_monitor.update_study_activity(study_uid)
@@ -52,19 +86,120 @@ class StoreHandler:
         # Ensure proper DICOM file metadata for pixel data accessibility
         self._fix_dicom_file_metadata(dataset)
         
-        # Save the file
-        dataset.save_as(file_path)
+        # Serialize in memory, so the file can be written with a single call
+        # instead of one buffered write per element
+        buffer = BytesIO()
+        dataset.save_as(buffer)
+        received = event.request.DataSet if pixel_offset is not None else None
         
-        logger.info(f"✅ Stored DICOM file: {file_path}")
+        if self.write_executor:
+            # Blocks when the disk falls behind, throttling the peer instead of
+            # buffering an unbounded number of instances in memory
+            self.pending_writes.acquire()
+            with self._writes_done:
+                self._study_writes[study_uid] = self._study_writes.get(study_uid, 0) + 1
+            self.write_executor.submit(
+                self._write_in_background, file_path, dataset, buffer, received, pixel_offset, study_uid
+            )
+        else:
+            self._write_file(file_path, dataset, buffer, received, pixel_offset)
         
         return 0x0000
     
+    def _write_file(self, file_path, dataset, buffer, received, pixel_offset):
+        """Write a serialized instance to disk and index it"""
+        try:
+            f = open(file_path, 'wb')
+        except FileNotFoundError:
+            # Storage only creates a series directory once, so it is gone if the
+            # study was uploaded and cleaned up while instances were still arriving
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            f = open(file_path, 'wb')
+        with f:
+            f.write(buffer.getbuffer())
+            if received is not None:
+                # The pixel data was never decoded, so copy it as received
+                with received.getbuffer() as view, view[pixel_offset:] as tail:
+                    f.write(tail)
+        
+        # Index the stored header values so C-FIND doesn't have to read the file back
+        self.storage.index_instance(file_path, dataset)
+        
+        logger.info(f"✅ Stored DICOM file: {file_path}")
+    
+    def _write_in_background(self, file_path, dataset, buffer, received, pixel_offset, study_uid):
+        """Write an instance on a worker thread, counting it as outstanding for its study"""
+        try:
+            self._write_file(file_path, dataset, buffer, received, pixel_offset)
+        except Exception as e:
+            logger.error(f"❌ Error writing DICOM file {file_path}: {e}")
+        finally:
+            self.pending_writes.release()
+            with self._writes_done:
+                remaining = self._study_writes.pop(study_uid) - 1
+                if remaining:
+                    self._study_writes[study_uid] = remaining
+                else:
+                    self._writes_done.notify_all()
+    
+    def wait_for_writes(self, study_uid: str):
+        """
+        Wait until every received file of a study has been written to disk
+        
+        The study monitor can finalize a study while its last files are still
+        queued for a write worker, so this is called before a completed study
+        is read back from disk.
+        
+        Parameters:
+        -----------
+        study_uid : str
+            StudyInstanceUID of the study
+        """
+        with self._writes_done:
+            self._writes_done.wait_for(lambda: study_uid not in self._study_writes)
+    
+    def shutdown(self):
+        """Wait for files still queued for writing"""
+        if self.write_executor:
+            self.write_executor.shutdown(wait=True)
+    
+    def _decode_header(self, event):
+        """
+        Decode the received dataset up to its pixel data
+        
+        Only header elements are anonymized, so the (possibly very large) pixel
+        data does not need to be decoded and re-encoded. The header is stored in
+        the transfer syntax it was received in, so the pixel data can be copied
+        as received for any little endian, non-deflated transfer syntax;
+        otherwise the full dataset is decoded.
+        
+        Parameters:
+        -----------
+        event : pynetdicom.events.Event
+            The C-STORE request event
+            
+        Returns:
+        --------
+        tuple: (Dataset, int or None) the decoded dataset and the offset of the
+        pixel data in the received stream, or None if the dataset was fully decoded
+        """
+        stream = event.request.DataSet
+        t_syntax = event.context.transfer_syntax
+        if stream is None or not t_syntax.is_little_endian or t_syntax.is_deflated:
+            return event.dataset, None
+        
+        stream.seek(0)
+        dataset = read_dataset(stream, t_syntax.is_implicit_VR, True, stop_when=_at_pixel_data)
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = t_syntax.is_implicit_VR
+        # Labels the file with the encoding of the copied pixel data
+        # (e.g. JPEG for compressed images)
+        dataset.file_meta = event.file_meta
+        return dataset, stream.tell()
+    
     def _fix_dicom_file_metadata(self, dataset):
         """Fix DICOM file metadata to ensure pixel data accessibility and Horos compatibility"""
         try:
-            import pydicom
-            from pydicom.uid import ImplicitVRLittleEndian, ExplicitVRLittleEndian
-            
             # CRITICAL: Add DICOM preamble for Horos compatibility
             if not hasattr(dataset, 'preamble') or dataset.preamble is None:
                 dataset.preamble = b'\x00' * 128  # 128-byte preamble required by DICOM standard
@@ -86,12 +221,10 @@ class StoreHandler:
                 preferred_syntax = dataset.file_meta.TransferSyntaxUID
                 logger.debug(f"Preserving original TransferSyntaxUID: {preferred_syntax}")
             
-            # Set transfer syntax and encoding based on the actual transfer syntax
-            dataset.is_little_endian = preferred_syntax in [
-                ImplicitVRLittleEndian,
-                ExplicitVRLittleEndian
-            ]
-            dataset.is_implicit_VR = preferred_syntax == ImplicitVRLittleEndian
+            # Set transfer syntax and encoding based on the actual transfer syntax;
+            # compressed transfer syntaxes are explicit VR little endian too
+            dataset.is_little_endian = preferred_syntax.is_little_endian
+            dataset.is_implicit_VR = preferred_syntax.is_implicit_VR
             
             # Ensure all required file meta elements are present
             dataset.file_meta.MediaStorageSOPClassUID = dataset.SOPClassUID
@@ -7,20 +7,166 @@ to configured DICOM nodes with duplicate prevention.
 """
 
 from dicom_receiver.utils import json_utils as json
+import atexit
+import gzip
 import logging
+import os
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import Dict, List, Set, Optional
-from datetime import datetime
+from typing import Dict, List, Set, Optional, Union
 
 from pynetdicom import AE, debug_logger
-from pynetdicom.sop_class import CTImageStorage, MRImageStorage, XRayAngiographicImageStorage
-from pydicom import dcmread
+from pynetdicom.sop_class import (
+    CTImageStorage,
+    MRImageStorage,
+    XRayAngiographicImageStorage,
+    ComputedRadiographyImageStorage,
+    DigitalXRayImageStorageForPresentation,
+    DigitalXRayImageStorageForProcessing,
+    UltrasoundImageStorage,
+    SecondaryCaptureImageStorage
+)
+from pydicom import Dataset, dcmread
 from io import BytesIO
 
 logger = logging.getLogger('dicom_receiver.node_manager')
 
+# Storage SOP classes requested when associating with a node
+FORWARDING_SOP_CLASSES = [
+    CTImageStorage,
+    MRImageStorage,
+    XRayAngiographicImageStorage,
+    ComputedRadiographyImageStorage,
+    DigitalXRayImageStorageForPresentation,
+    DigitalXRayImageStorageForProcessing,
+    UltrasoundImageStorage,
+    SecondaryCaptureImageStorage,
+]
+
+# Element values larger than this are left unparsed when forwarding; they are
+# written back to the association straight from the downloaded bytes
+DEFER_SIZE = '16 KB'
+
+# Seconds between API polls when nodes.json doesn't set polling_interval
+DEFAULT_POLLING_INTERVAL = 60
+
+# Upper bound on nodes forwarded to concurrently
+MAX_FORWARDING_WORKERS = 8
+
+# Seconds between flushes of changed tracking data to disk
+TRACKING_FLUSH_INTERVAL = 5
+
+def _atomic_write_json(path: Path, data, compress: bool = False):
+    """
+    Write JSON to a file so readers see either the old or the new content
+    
+    The data is written to a temporary file next to the target and swapped in
+    with os.replace, so a crash mid-write never leaves a truncated file behind.
+    
+    Parameters:
+    -----------
+    path : Path
+        The file to write
+    data : dict
+        The data to serialize
+    compress : bool, optional
+        Write compact, gzip-compressed JSON instead of indented plain JSON
+    """
+    tmp_path = path.with_name(path.name + '.tmp')
+    if compress:
+        with gzip.open(tmp_path, 'wb') as f:
+            json.dump(data, f)
+    else:
+        with open(tmp_path, 'wb') as f:
+            json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+def _build_forwarding_ae() -> AE:
+    """Create the AE used to associate with nodes, with all forwarding contexts requested"""
+    ae = AE()
+    # Don't limit the PDU size we accept, so nothing the node sends back is fragmented
+    ae.maximum_pdu_size = 0
+    for sop_class in FORWARDING_SOP_CLASSES:
+        ae.add_requested_context(sop_class)
+    return ae
+
+class NodeSender:
+    """
+    Sends datasets to a node over a single association
+    
+    Used as a context manager so a whole batch of series shares one association
+    instead of negotiating a new one per series.
+    """
+    
+    def __init__(self, node_config: Dict, ae: Optional[AE] = None):
+        """
+        Initialize the sender
+        
+        Parameters:
+        -----------
+        node_config : dict
+            Configuration of the destination node
+        ae : AE, optional
+            AE to associate from; a new one with the forwarding contexts is created if omitted
+        """
+        self.node_config = node_config
+        self.ae = ae or _build_forwarding_ae()
+        self.assoc = None
+    
+    def __enter__(self):
+        self._associate()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+    
+    @property
+    def is_established(self) -> bool:
+        """Whether the association with the node is currently up"""
+        return self.assoc is not None and self.assoc.is_established
+    
+    def _associate(self):
+        """Open the association with the node"""
+        self.assoc = self.ae.associate(
+            self.node_config['ip'],
+            self.node_config['port'],
+            ae_title=self.node_config['aet']
+        )
+        
+        if self.assoc.is_established:
+            logger.info(f"🔗 Established association with {self.node_config['name']}")
+        else:
+            logger.error(f"❌ Failed to establish association with {self.node_config['name']}")
+    
+    def send(self, ds):
+        """
+        Send a dataset via C-STORE, re-associating once if the node dropped the association
+        
+        Parameters:
+        -----------
+        ds : Dataset
+            The dataset to store on the node
+            
+        Returns:
+        --------
+        Dataset or None: The C-STORE response status, or None if nothing was received
+        """
+        if not self.is_established:
+            self._associate()
+            if not self.is_established:
+                return None
+        
+        return self.assoc.send_c_store(ds)
+    
+    def release(self):
+        """Release the association if it is still up"""
+        if self.is_established:
+            self.assoc.release()
+        self.assoc = None
+
 class NodeManager:
     """
     Manages DICOM nodes and automatic forwarding of new series
@@ -45,19 +191,32 @@ class NodeManager:
         
         # File paths
         self.nodes_file = self.storage_dir / "nodes.json"
-        self.tracking_file = self.storage_dir / "forwarding_tracking.json"
+        self.tracking_file = self.storage_dir / "forwarding_tracking.json.gz"
+        self.legacy_tracking_file = self.storage_dir / "forwarding_tracking.json"
         
         # State
         self.nodes = {}
-        self.sent_tracking = {}  # {node_name: {series_uid: timestamp}}
+        self.settings = {}  # Kept so node updates can rewrite nodes.json without re-reading it
+        self.sent_tracking = {}  # {node_name: set of series_uid}
         self.is_running = False
         self.polling_thread = None
+        self.flush_thread = None
         self.stop_event = threading.Event()
         
+        # Shared by every forwarding association; the requested contexts never change
+        self.forwarding_ae = _build_forwarding_ae()
+        
+        # Tracking changes are batched and written by the flusher
+        self._tracking_dirty = False
+        self._tracking_lock = threading.Lock()
+        
         # Load existing configuration
         self._load_nodes()
         self._load_tracking()
         
+        # Make sure pending tracking changes reach disk on exit
+        atexit.register(self._flush_tracking)
+        
         logger.info(f"NodeManager initialized with {len(self.nodes)} nodes")
     
     def _load_nodes(self):
@@ -67,6 +226,7 @@ class NodeManager:
                 with open(self.nodes_file, 'r') as f:
                     data = json.load(f)
                     self.nodes = data.get('nodes', {})
+                    self.settings = data.get('settings', {})
                 logger.info(f"Loaded {len(self.nodes)} nodes from {self.nodes_file}")
             else:
                 # Create default nodes.json file
@@ -105,10 +265,10 @@ class NodeManager:
         }
         
         try:
-            with open(self.nodes_file, 'w') as f:
-                json.dump(default_config, f, indent=2)
+            _atomic_write_json(self.nodes_file, default_config)
             
             self.nodes = default_config['nodes']
+            self.settings = default_config['settings']
             logger.info(f"Created default nodes configuration at {self.nodes_file}")
             
         except Exception as e:
@@ -118,8 +278,18 @@ class NodeManager:
         """Load forwarding tracking data"""
         try:
             if self.tracking_file.exists():
-                with open(self.tracking_file, 'r') as f:
-                    self.sent_tracking = json.load(f)
+                with gzip.open(self.tracking_file, 'rb') as f:
+                    data = json.load(f)
+            elif self.legacy_tracking_file.exists():
+                # Uncompressed file written by older versions
+                with open(self.legacy_tracking_file, 'rb') as f:
+                    data = json.load(f)
+            else:
+                data = None
+            
+            if data is not None:
+                # Older files map each series to the time it was sent; only membership is kept
+                self.sent_tracking = {node_id: set(series) for node_id, series in data.items()}
                 logger.info(f"Loaded forwarding tracking data for {len(self.sent_tracking)} nodes")
             else:
                 self.sent_tracking = {}
@@ -130,11 +300,33 @@ class NodeManager:
     def _save_tracking(self):
         """Save forwarding tracking data"""
         try:
-            with open(self.tracking_file, 'w') as f:
-                json.dump(self.sent_tracking, f, indent=2)
+            data = {node_id: list(series) for node_id, series in self.sent_tracking.items()}
+            _atomic_write_json(self.tracking_file, data, compress=True)
+            
+            # The compressed file now holds everything the legacy file did
+            if self.legacy_tracking_file.exists():
+                self.legacy_tracking_file.unlink()
         except Exception as e:
             logger.error(f"Error saving tracking data: {e}")
     
+    def _flush_tracking(self):
+        """Save tracking data if it changed since the last flush"""
+        with self._tracking_lock:
+            if not self._tracking_dirty:
+                return
+            self._tracking_dirty = False
+            self._save_tracking()
+    
+    def _flush_loop(self):
+        """Periodically flush changed tracking data until stopped"""
+        while not self.stop_event.wait(TRACKING_FLUSH_INTERVAL):
+            self._flush_tracking()
+    
+    def _save_nodes(self):
+        """Write the node configuration and settings to nodes.json"""
+        config = {"nodes": self.nodes, "settings": self.settings}
+        _atomic_write_json(self.nodes_file, config)
+    
     def get_enabled_nodes(self) -> Dict:
         """Get all enabled nodes"""
         return {k: v for k, v in self.nodes.items() if v.get('enabled', True)}
@@ -152,15 +344,7 @@ class NodeManager:
         
         # Save to file
         try:
-            # Load current file to preserve settings
-            config = {"nodes": self.nodes}
-            if self.nodes_file.exists():
-                with open(self.nodes_file, 'r') as f:
-                    existing = json.load(f)
-                    config["settings"] = existing.get("settings", {})
-            
-            with open(self.nodes_file, 'w') as f:
-                json.dump(config, f, indent=2)
+            self._save_nodes()
             
             logger.info(f"Added/updated node '{node_id}': {name} ({ip}:{port}, AET: {aet})")
             
@@ -172,21 +356,14 @@ class NodeManager:
         if node_id in self.nodes:
             del self.nodes[node_id]
             
-            # Remove from tracking as well
-            if node_id in self.sent_tracking:
-                del self.sent_tracking[node_id]
-                self._save_tracking()
+            # Remove from tracking as well, holding the lock the flusher saves under
+            with self._tracking_lock:
+                if self.sent_tracking.pop(node_id, None) is not None:
+                    self._tracking_dirty = True
             
             # Save nodes file
             try:
-                config = {"nodes": self.nodes}
-                if self.nodes_file.exists():
-                    with open(self.nodes_file, 'r') as f:
-                        existing = json.load(f)
-                        config["settings"] = existing.get("settings", {})
-                
-                with open(self.nodes_file, 'w') as f:
-                    json.dump(config, f, indent=2)
+                self._save_nodes()
                 
                 logger.info(f"Removed node '{node_id}'")
                 
@@ -205,6 +382,9 @@ class NodeManager:
         self.polling_thread = threading.Thread(target=self._polling_loop, daemon=True)
         self.polling_thread.start()
         
+        self.flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flush_thread.start()
+        
         logger.info("🚀 Started automatic DICOM forwarding service")
     
     def stop_auto_forwarding(self):
@@ -217,14 +397,20 @@ class NodeManager:
         
         if self.polling_thread:
             self.polling_thread.join(timeout=5)
+        if self.flush_thread:
+            self.flush_thread.join(timeout=5)
+        
+        # Write out anything marked since the last flush
+        self._flush_tracking()
         
         logger.info("🛑 Stopped automatic DICOM forwarding service")
     
     def _polling_loop(self):
-        """Main polling loop that runs every minute"""
-        logger.info("📡 Starting API polling loop (every 60 seconds)")
+        """Main polling loop that runs every `polling_interval` seconds (default 60)"""
+        interval = self.settings.get('polling_interval', DEFAULT_POLLING_INTERVAL)
+        logger.info(f"📡 Starting API polling loop (every {interval} seconds)")
         
-        while not self.stop_event.wait(60):  # Wait 60 seconds or until stop event
+        while not self.stop_event.wait(interval):  # Wait for the interval or until stop event
             try:
                 self._check_and_forward_new_series()
             except Exception as e:
@@ -235,80 +421,124 @@ class NodeManager:
         try:
             logger.debug("🔍 Checking API for new series...")
             
-            # Query API for all metadata
-            api_data = self.query_handler.query_all_metadata()
-            if not api_data or 'results' not in api_data:
-                logger.debug("No API data available")
-                return
-            
             enabled_nodes = self.get_enabled_nodes()
             if not enabled_nodes:
                 logger.debug("No enabled nodes for forwarding")
                 return
             
-            new_series_count = 0
+            # Only the result/study/series identifiers are needed, so the full
+            # de-anonymized metadata tree is never built
+            api_series = {}
+            for result_id, study_uid, series_uid in self.query_handler.iter_series_uids():
+                api_series.setdefault(series_uid, (result_id, study_uid))
             
-            # Process each result
-            for result_item in api_data['results']:
-                if 'dicom_data' not in result_item or 'studies' not in result_item['dicom_data']:
-                    continue
-                
-                result_id = result_item['result']['id']
-                studies_data = result_item['dicom_data']['studies']
-                
-                # Process each study
-                for study_uid, study_info in studies_data.items():
-                    if 'series' not in study_info:
-                        continue
-                    
-                    # Process each series
-                    for series_uid in study_info['series'].keys():
-                        # Check if this series needs to be forwarded to any nodes
-                        for node_id, node_config in enabled_nodes.items():
-                            if not self._is_series_sent(node_id, series_uid):
-                                logger.info(f"📤 New series found: {series_uid[:20]}... -> {node_config['name']}")
-                                
-                                # Forward the series
-                                if self._forward_series_to_node(result_id, series_uid, study_uid, node_id, node_config):
-                                    self._mark_series_sent(node_id, series_uid)
-                                    new_series_count += 1
+            # Collect the series each node is missing with one set difference per node
+            pending = {}
+            for node_id, node_config in enabled_nodes.items():
+                with self._tracking_lock:
+                    new_series = api_series.keys() - self.sent_tracking.get(node_id, set())
+                for series_uid in new_series:
+                    logger.info(f"📤 New series found: {series_uid[:20]}... -> {node_config['name']}")
+                    result_id, study_uid = api_series[series_uid]
+                    pending.setdefault(node_id, []).append((result_id, study_uid, series_uid))
+            
+            new_series_count = 0
+            if pending:
+                # Each node is served by its own worker so slow nodes don't hold up the others
+                with ThreadPoolExecutor(max_workers=min(MAX_FORWARDING_WORKERS, len(pending))) as executor:
+                    futures = [
+                        executor.submit(self._forward_pending_to_node, node_id, enabled_nodes[node_id], series_list)
+                        for node_id, series_list in pending.items()
+                    ]
+                    for future in as_completed(futures):
+                        new_series_count += future.result()
             
             if new_series_count > 0:
                 logger.info(f"✅ Forwarded {new_series_count} new series to nodes")
-                self._save_tracking()
             else:
                 logger.debug("No new series to forward")
                 
         except Exception as e:
             logger.error(f"Error checking for new series: {e}")
     
+    def _forward_pending_to_node(self, node_id: str, node_config: Dict, series_list: List) -> int:
+        """
+        Forward a node's pending series one after another
+        
+        Parameters:
+        -----------
+        node_id : str
+            ID of the destination node
+        node_config : dict
+            Configuration of the destination node
+        series_list : list
+            (result_id, study_uid, series_uid) tuples to forward
+            
+        Returns:
+        --------
+        int: Number of series forwarded successfully
+        """
+        forwarded = 0
+        try:
+            # One association carries every series in the batch, and the next series is
+            # downloaded in the background while the current one is being sent
+            with NodeSender(node_config, self.forwarding_ae) as sender, ThreadPoolExecutor(max_workers=1) as downloader:
+                if not sender.is_established:
+                    return 0
+                
+                result_id, _, series_uid = series_list[0]
+                download = downloader.submit(self._download_series, result_id, series_uid)
+                for i, (_, _, series_uid) in enumerate(series_list):
+                    if self.stop_event.is_set():
+                        download.cancel()
+                        break
+                    
+                    series_files = download.result()
+                    if i + 1 < len(series_list):
+                        next_result_id, _, next_series_uid = series_list[i + 1]
+                        download = downloader.submit(self._download_series, next_result_id, next_series_uid)
+                    
+                    # Forward the series
+                    if self._forward_series_to_node(series_uid, series_files, node_config, sender):
+                        self._mark_series_sent(node_id, series_uid)
+                        forwarded += 1
+        except Exception as e:
+            logger.error(f"Error forwarding to {node_config['name']}: {e}")
+        return forwarded
+    
     def _is_series_sent(self, node_id: str, series_uid: str) -> bool:
         """Check if a series has already been sent to a node"""
-        return (node_id in self.sent_tracking and 
-                series_uid in self.sent_tracking[node_id])
+        return series_uid in self.sent_tracking.get(node_id, ())
     
     def _mark_series_sent(self, node_id: str, series_uid: str):
         """Mark a series as sent to a node"""
-        if node_id not in self.sent_tracking:
-            self.sent_tracking[node_id] = {}
-        
-        self.sent_tracking[node_id][series_uid] = datetime.now().isoformat()
+        # Held so the flusher never serializes the dict mid-update
+        with self._tracking_lock:
+            self.sent_tracking.setdefault(node_id, set()).add(series_uid)
+            self._tracking_dirty = True
+    
+    def _download_series(self, result_id: str, series_uid: str) -> List[Union[Dataset, bytes]]:
+        """Download a series from the API, returning an empty list on failure"""
+        try:
+            series_files = self.api_integration_utils.download_series_from_api(result_id, series_uid)
+            if series_files:
+                logger.info(f"📥 Downloaded {len(series_files)} files for series")
+            return series_files or []
+        except Exception as e:
+            logger.error(f"Error downloading series {series_uid}: {e}")
+            return []
     
-    def _forward_series_to_node(self, result_id: str, series_uid: str, study_uid: str, node_id: str, node_config: Dict) -> bool:
-        """Forward a series to a specific node"""
+    def _forward_series_to_node(self, series_uid: str, series_files: List[Union[Dataset, bytes]], node_config: Dict, sender: NodeSender) -> bool:
+        """Forward a downloaded series to a specific node"""
         try:
             logger.info(f"📤 Forwarding series {series_uid[:20]}... to {node_config['name']} ({node_config['ip']}:{node_config['port']})")
             
-            # Download series from API
-            series_files = self.api_integration_utils.download_series_from_api(result_id, series_uid)
             if not series_files:
                 logger.error(f"❌ Failed to download series {series_uid} from API")
                 return False
             
-            logger.info(f"📥 Downloaded {len(series_files)} files for series")
-            
             # Send files to node via C-STORE
-            success = self._send_files_to_node(series_files, node_config)
+            success = self._send_files_to_node(series_files, node_config, sender)
             
             if success:
                 logger.info(f"✅ Successfully forwarded series {series_uid[:20]}... to {node_config['name']}")
@@ -321,53 +551,25 @@ class NodeManager:
             logger.error(f"Error forwarding series {series_uid} to {node_config['name']}: {e}")
             return False
     
-    def _send_files_to_node(self, file_data_list: List[bytes], node_config: Dict) -> bool:
-        """Send DICOM files to a node via C-STORE"""
+    def _send_files_to_node(self, file_data_list: List[Union[Dataset, bytes]], node_config: Dict, sender: NodeSender) -> bool:
+        """Send DICOM files to a node via C-STORE over the sender's association"""
         try:
-            # Create Application Entity
-            ae = AE()
-            ae.add_requested_context(CTImageStorage)
-            ae.add_requested_context(MRImageStorage)
-            ae.add_requested_context(XRayAngiographicImageStorage)
-            
-            # Add more SOP classes as needed
-            from pynetdicom.sop_class import (
-                ComputedRadiographyImageStorage,
-                DigitalXRayImageStorageForPresentation,
-                DigitalXRayImageStorageForProcessing,
-                UltrasoundImageStorage,
-                SecondaryCaptureImageStorage
-            )
-            ae.add_requested_context(ComputedRadiographyImageStorage)
-            ae.add_requested_context(DigitalXRayImageStorageForPresentation)
-            ae.add_requested_context(DigitalXRayImageStorageForProcessing)
-            ae.add_requested_context(UltrasoundImageStorage)
-            ae.add_requested_context(SecondaryCaptureImageStorage)
-            
-            # Connect to the node
-            assoc = ae.associate(
-                node_config['ip'], 
-                node_config['port'], 
-                ae_title=node_config['aet']
-            )
-            
-            if not assoc.is_established:
-                logger.error(f"❌ Failed to establish association with {node_config['name']}")
-                return False
-            
-            logger.info(f"🔗 Established association with {node_config['name']}")
-            
             success_count = 0
             total_files = len(file_data_list)
             
             # Send each file
             for i, file_data in enumerate(file_data_list, 1):
                 try:
-                    # Read DICOM dataset from bytes
-                    ds = dcmread(BytesIO(file_data), force=True)
+                    if isinstance(file_data, Dataset):
+                        # Already parsed and de-anonymized by the series download
+                        ds = file_data
+                    else:
+                        # Read DICOM dataset from bytes; elements are never accessed here, so
+                        # pynetdicom encodes them from their raw values without conversion
+                        ds = dcmread(BytesIO(file_data), force=True, defer_size=DEFER_SIZE)
                     
                     # Send C-STORE request
-                    status = assoc.send_c_store(ds)
+                    status = sender.send(ds)
                     
                     if status:
                         if status.Status == 0x0000:  # Success
@@ -381,9 +583,6 @@ class NodeManager:
                 except Exception as e:
                     logger.error(f"❌ Error sending file {i}/{total_files}: {e}")
             
-            # Release association
-            assoc.release()
-            
             logger.info(f"📊 Sent {success_count}/{total_files} files to {node_config['name']}")
             
             # Consider it successful if at least 80% of files were sent
@@ -403,7 +602,7 @@ class NodeManager:
         }
         
         for node_id, node_config in self.nodes.items():
-            sent_count = len(self.sent_tracking.get(node_id, {}))
+            sent_count = len(self.sent_tracking.get(node_id, ()))
             stats["nodes"][node_id] = {
                 "name": node_config["name"],
                 "enabled": node_config.get("enabled", True),
@@ -414,13 +613,18 @@ class NodeManager:
     
     def clear_tracking_for_node(self, node_id: str):
         """Clear tracking data for a specific node (allows re-sending)"""
-        if node_id in self.sent_tracking:
-            del self.sent_tracking[node_id]
-            self._save_tracking()
+        with self._tracking_lock:
+            cleared = self.sent_tracking.pop(node_id, None) is not None
+            if cleared:
+                self._tracking_dirty = True
+        if cleared:
             logger.info(f"Cleared tracking data for node '{node_id}'")
     
     def clear_all_tracking(self):
         """Clear all tracking data (allows re-sending everything)"""
-        self.sent_tracking = {}
-        self._save_tracking()
+        # Cleared in place under the lock, so a series marked sent concurrently
+        # is not recorded in a dict that is about to be dropped
+        with self._tracking_lock:
+            self.sent_tracking.clear()
+            self._tracking_dirty = True
         logger.info("Cleared all tracking data") 
\ No newline at end of file
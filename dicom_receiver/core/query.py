@@ -7,8 +7,14 @@ Handles API queries and de-anonymization of response data
 
 from dicom_receiver.utils import json_utils as json
 import logging
+import re
+import threading
+import time
 import requests
-from typing import Dict, List, Optional, Any
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+from types import MappingProxyType
+from typing import Dict, Iterator, List, Mapping, Optional, Any, Tuple
 from pathlib import Path
 
 from dicom_receiver.core.crypto import DicomAnonymizer
@@ -16,6 +22,34 @@ from dicom_receiver.core.uploader import ApiUploader
 
 logger = logging.getLogger('dicom_receiver.query')
 
+# Connections kept open to the API per scheme
+HTTP_POOL_SIZE = 4
+
+# Seconds the C-FIND handlers reuse a metadata payload before fetching it again
+DEFAULT_METADATA_TTL = 30
+
+# Longest time (seconds) metadata fetches are skipped after repeated failures
+MAX_METADATA_BACKOFF = 60
+
+# Returned by a conditional metadata fetch when the API answers 304 Not Modified
+NOT_MODIFIED = object()
+
+# Asterisk placeholders the API emits for unrepresentable numbers, e.g.
+# "slice_location":-66.*** or [1, ***, 2]; both forms are matched in one scan
+_ASTERISK_VALUE = re.compile(rb':\s*(?:-?\d*\.)?\*+|[,\s]\*+[,\s]')
+
+# Response fields holding patient names/IDs, compared case-insensitively
+_PATIENT_KEYS = frozenset(['patient_name', 'patient_id', 'patientname', 'patientid'])
+_PATIENT_NAME_KEYS = frozenset(['patient_name', 'patientname'])
+
+def _replace_asterisk_value(match):
+    """Replace an asterisk placeholder with a JSON null"""
+    return b': null' if match.group().startswith(b':') else b', null,'
+
+def _clean_response_body(body: bytes) -> bytes:
+    """Replace invalid asterisk values in a raw JSON response with null"""
+    return _ASTERISK_VALUE.sub(_replace_asterisk_value, body)
+
 class DicomQueryHandler:
     """
     Handles querying the API and de-anonymizing response data
@@ -57,9 +91,23 @@ class DicomQueryHandler:
         # Initialize the anonymizer for de-anonymization
         self.anonymizer = DicomAnonymizer(self.storage_dir)
         
+        # Keep-alive session so repeated polls reuse the same connection
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE))
+        # Ask for every content coding urllib3 can decode: gzip and deflate, plus zstd
+        # and brotli when the optional zstandard / brotli packages are installed.
+        # This covers the metadata JSON as well as the study and series ZIP downloads.
+        self.session.headers.update({'Accept-Encoding': make_headers(accept_encoding=True)['accept-encoding']})
+        
+        # Series identifiers from the last full metadata response, reused while the
+        # API reports the metadata as unchanged
+        self._series_validators = {}
+        self._series_uids = []
+        
     def _authenticate(self) -> bool:
         """Ensure we have a valid authentication token"""
-        if not self.api_uploader.auth_token:
+        if not self.api_uploader.has_valid_token():
             return self.api_uploader.login()
         return True
     
@@ -67,59 +115,72 @@ class DicomQueryHandler:
         """
         De-anonymize patient information in the response data
         
+        The data is updated in place; only patient name/ID values are rewritten.
+        
         Args:
             data: The response data containing anonymized patient information
             
         Returns:
             The data with de-anonymized patient information
         """
-        # Create a reverse mapping from anonymized names to original names
-        reverse_name_map = {v: k for k, v in self.anonymizer.patient_name_map.items()}
+        # Pick up patients anonymized by the receiver since the map was last read
+        self.anonymizer.reload_if_changed()
+        
+        # Reverse mapping from anonymized names to original names, kept up to date by the anonymizer
+        reverse_name_map = self.anonymizer.reverse_name_map
+        
+        # Lower-cased patient key for each key name seen ('' for other keys); the tree
+        # repeats a small set of key names, so each is classified only once per call
+        patient_key_cache = {}
         
-        def deanonymize_recursive(obj):
-            """Recursively de-anonymize patient information in nested structures"""
-            if isinstance(obj, dict):
-                result = {}
-                for key, value in obj.items():
+        # Walk the nested structure with an explicit stack instead of rebuilding every node
+        stack = [data]
+        while stack:
+            obj = stack.pop()
+            if isinstance(obj, list):
+                stack.extend(item for item in obj if isinstance(item, (dict, list)))
+                continue
+            
+            for key, value in obj.items():
+                if isinstance(value, str):
                     # Handle various patient name/ID field names that might appear in the API response
-                    if key.lower() in ['patient_name', 'patient_id', 'patientname', 'patientid'] and isinstance(value, str):
-                        # Check if this is an anonymized name that we can de-anonymize
-                        if value in reverse_name_map:
-                            result[key] = reverse_name_map[value]
-                            logger.debug(f"De-anonymized {key}: {value} -> {reverse_name_map[value]}")
-                        else:
-                            result[key] = value
+                    lower_key = patient_key_cache.get(key)
+                    if lower_key is None:
+                        lower_key = key.lower()
+                        if lower_key not in _PATIENT_KEYS:
+                            lower_key = ''
+                        patient_key_cache[key] = lower_key
+                    if not lower_key:
+                        continue
+                    
+                    # Check if this is an anonymized name that we can de-anonymize
+                    if value in reverse_name_map:
+                        obj[key] = reverse_name_map[value]
+                        logger.debug(f"De-anonymized {key}: {value} -> {obj[key]}")
                     # Handle DICOM format patient names (e.g., "DOE^JOHN")
-                    elif key.lower() in ['patient_name', 'patientname'] and isinstance(value, str) and '^' in value:
+                    elif lower_key in _PATIENT_NAME_KEYS and '^' in value:
                         # For DICOM format names, check if the base name (before ^) is anonymized
-                        name_parts = value.split('^')
-                        base_name = name_parts[0] if name_parts else value
+                        base_name, _, rest = value.partition('^')
                         if base_name in reverse_name_map:
                             # Reconstruct the DICOM format name with de-anonymized base
-                            original_name = reverse_name_map[base_name]
-                            if len(name_parts) > 1:
-                                result[key] = f"{original_name}^{'^'.join(name_parts[1:])}"
-                            else:
-                                result[key] = original_name
-                            logger.debug(f"De-anonymized DICOM name {key}: {value} -> {result[key]}")
-                        else:
-                            result[key] = value
-                    else:
-                        result[key] = deanonymize_recursive(value)
-                return result
-            elif isinstance(obj, list):
-                return [deanonymize_recursive(item) for item in obj]
-            else:
-                return obj
+                            obj[key] = f"{reverse_name_map[base_name]}^{rest}"
+                            logger.debug(f"De-anonymized DICOM name {key}: {value} -> {obj[key]}")
+                elif isinstance(value, (dict, list)):
+                    stack.append(value)
         
-        return deanonymize_recursive(data)
+        return data
     
-    def query_all_dicom_metadata(self) -> Optional[Dict[str, Any]]:
+    def _fetch_all_dicom_metadata(self, validators: Optional[Dict[str, str]] = None) -> Optional[Dict[str, Any]]:
         """
-        Query the API for all DICOM metadata and return de-anonymized results
+        Fetch and validate the all_dicom_metadata response without de-anonymizing it
+        
+        Args:
+            validators: ETag/Last-Modified of a previous response for a conditional
+                request; updated in place from a new response
         
         Returns:
-            Dict containing the de-anonymized response data, or None if failed
+            Dict containing the raw response data, NOT_MODIFIED if the API reports the
+            data unchanged since `validators`, or None if failed
         """
         if not self._authenticate():
             logger.error("Failed to authenticate with API")
@@ -134,25 +195,29 @@ class DicomQueryHandler:
                 'Authorization': f'Bearer {self.api_uploader.auth_token}',
                 'Accept': 'application/json'
             }
+            if validators is not None:
+                if 'ETag' in validators:
+                    headers['If-None-Match'] = validators['ETag']
+                if 'Last-Modified' in validators:
+                    headers['If-Modified-Since'] = validators['Last-Modified']
             
-            response = requests.get(query_url, headers=headers, timeout=30)
+            response = self.session.get(query_url, headers=headers, timeout=30)
             
-            if response.status_code == 200:
-                # Clean the response text to handle invalid JSON values
-                response_text = response.text
-                # Replace asterisks with null values for invalid numeric fields
-                import re
-                # Handle various patterns of asterisks in JSON values
-                response_text = re.sub(r':\s*\*+', ': null', response_text)  # :***
-                response_text = re.sub(r':\s*-?\d*\.\*+', ': null', response_text)  # :-66.***
-                response_text = re.sub(r':\s*-?\d+\.\*+', ': null', response_text)  # :1.6000000238419,"slice_location":-66.***
-                response_text = re.sub(r'[,\s]\*+[,\s]', ', null,', response_text)  # ,***,
+            if response.status_code == 304:
+                logger.info("DICOM metadata unchanged since last query")
+                return NOT_MODIFIED
+            
+            elif response.status_code == 200:
+                # Clean the raw response body to handle invalid JSON values; working on
+                # bytes lets orjson parse it without decoding to str first
+                response_text = _clean_response_body(response.content)
                 
                 try:
                     data = json.loads(response_text)
                 except json.JSONDecodeError as e:
                     logger.error(f"JSON decode error: {e}")
-                    logger.error(f"Error context: {response_text[max(0, e.pos-50):e.pos+50]}")
+                    context = response_text[max(0, e.pos-50):e.pos+50].decode('utf-8', errors='replace')
+                    logger.error(f"Error context: {context}")
                     return None
                 
                 # Validate the new API response structure
@@ -177,11 +242,9 @@ class DicomQueryHandler:
                     logger.warning("No 'results' array in API response")
                     data['results'] = []
                 
-                # De-anonymize the patient information
-                deanonymized_data = self._deanonymize_patient_info(data)
-                
-                logger.info("Successfully de-anonymized patient information")
-                return deanonymized_data
+                if validators is not None:
+                    self._update_validators(validators, response)
+                return data
                 
             elif response.status_code == 401:
                 logger.warning("Authentication failed, attempting to re-authenticate")
@@ -192,15 +255,12 @@ class DicomQueryHandler:
                 if self.api_uploader.login():
                     # Retry with new token
                     headers['Authorization'] = f'Bearer {self.api_uploader.auth_token}'
-                    response = requests.get(query_url, headers=headers, timeout=30)
+                    response = self.session.get(query_url, headers=headers, timeout=30)
+                    if response.status_code == 304:
+                        return NOT_MODIFIED
                     if response.status_code == 200:
                         # Handle JSON response with cleaning for retry
-                        response_text = response.text
-                        import re
-                        response_text = re.sub(r':\s*\*+', ': null', response_text)
-                        response_text = re.sub(r':\s*-?\d*\.\*+', ': null', response_text)
-                        response_text = re.sub(r':\s*-?\d+\.\*+', ': null', response_text)
-                        response_text = re.sub(r'[,\s]\*+[,\s]', ', null,', response_text)
+                        response_text = _clean_response_body(response.content)
                         
                         try:
                             data = json.loads(response_text)
@@ -216,8 +276,9 @@ class DicomQueryHandler:
                         if 'results' not in data:
                             data['results'] = []
                         
-                        deanonymized_data = self._deanonymize_patient_info(data)
-                        return deanonymized_data
+                        if validators is not None:
+                            self._update_validators(validators, response)
+                        return data
                 
                 logger.error("Re-authentication failed")
                 return None
@@ -233,6 +294,70 @@ class DicomQueryHandler:
             logger.error(f"Unexpected error during query: {e}")
             return None
     
+    def _update_validators(self, validators: Dict[str, str], response) -> None:
+        """Replace the stored validators with the ETag/Last-Modified of a response"""
+        validators.clear()
+        for header in ('ETag', 'Last-Modified'):
+            if header in response.headers:
+                validators[header] = response.headers[header]
+    
+    def query_all_dicom_metadata(self) -> Optional[Dict[str, Any]]:
+        """
+        Query the API for all DICOM metadata and return de-anonymized results
+        
+        Returns:
+            Dict containing the de-anonymized response data, or None if failed
+        """
+        data = self._fetch_all_dicom_metadata()
+        if data is None:
+            return None
+        
+        try:
+            # De-anonymize the patient information
+            deanonymized_data = self._deanonymize_patient_info(data)
+            
+            logger.info("Successfully de-anonymized patient information")
+            return deanonymized_data
+        except Exception as e:
+            logger.error(f"Unexpected error during query: {e}")
+            return None
+    
+    def iter_series_uids(self) -> Iterator[Tuple[str, str, str]]:
+        """
+        Iterate over the series available from the API
+        
+        Only result, study and series identifiers are read, so the response is
+        not de-anonymized. Use query_all_dicom_metadata when patient data is needed.
+        
+        The request is conditional on the previous response; when the API reports
+        the metadata unchanged, the identifiers from that response are yielded
+        again without downloading or parsing anything.
+        
+        Yields:
+            (result_id, study_uid, series_uid) for each series in each result
+        """
+        # Validators are only kept once the identifiers they describe have been stored
+        validators = dict(self._series_validators)
+        data = self._fetch_all_dicom_metadata(validators)
+        if data is None:
+            return
+        
+        if data is not NOT_MODIFIED:
+            series_uids = []
+            for result_item in data['results']:
+                dicom_data = result_item.get('dicom_data')
+                if not dicom_data or 'studies' not in dicom_data:
+                    continue
+                
+                result_id = result_item['result']['id']
+                for study_uid, study_info in dicom_data['studies'].items():
+                    for series_uid in study_info.get('series', ()):
+                        series_uids.append((result_id, study_uid, series_uid))
+            self._series_uids = series_uids
+            self._series_validators = validators
+        
+        yield from self._series_uids
+    
     def query_result_by_id(self, result_id: str) -> Optional[Dict[str, Any]]:
         """
         Query the API for a specific result by ID and return de-anonymized data
@@ -257,10 +382,10 @@ class DicomQueryHandler:
                 'Accept': 'application/json'
             }
             
-            response = requests.get(query_url, headers=headers, timeout=30)
+            response = self.session.get(query_url, headers=headers, timeout=30)
             
             if response.status_code == 200:
-                data = json.loads(response.text)
+                data = json.loads(response.content)
                 logger.info(f"Successfully retrieved metadata for result {result_id}")
                 
                 # De-anonymize the patient information
@@ -278,9 +403,9 @@ class DicomQueryHandler:
                 if self.api_uploader.login():
                     # Retry with new token
                     headers['Authorization'] = f'Bearer {self.api_uploader.auth_token}'
-                    response = requests.get(query_url, headers=headers, timeout=30)
+                    response = self.session.get(query_url, headers=headers, timeout=30)
                     if response.status_code == 200:
-                        data = json.loads(response.text)
+                        data = json.loads(response.content)
                         deanonymized_data = self._deanonymize_patient_info(data)
                         return deanonymized_data
                 
@@ -298,23 +423,25 @@ class DicomQueryHandler:
             logger.error(f"Unexpected error during query: {e}")
             return None
     
-    def get_anonymization_mapping(self) -> Dict[str, str]:
+    def get_anonymization_mapping(self) -> Mapping[str, str]:
         """
         Get the current anonymization mapping
         
         Returns:
-            Dict mapping original patient names to anonymized names
+            Read-only view mapping original patient names to anonymized names
         """
-        return self.anonymizer.patient_name_map.copy()
+        self.anonymizer.reload_if_changed()
+        return MappingProxyType(self.anonymizer.patient_name_map)
     
-    def get_reverse_anonymization_mapping(self) -> Dict[str, str]:
+    def get_reverse_anonymization_mapping(self) -> Mapping[str, str]:
         """
         Get the reverse anonymization mapping
         
         Returns:
-            Dict mapping anonymized names to original patient names
+            Read-only view mapping anonymized names to original patient names
         """
-        return {v: k for k, v in self.anonymizer.patient_name_map.items()}
+        self.anonymizer.reload_if_changed()
+        return MappingProxyType(self.anonymizer.reverse_name_map)
     
     def query_all_metadata(self) -> Optional[Dict[str, Any]]:
         """
@@ -323,4 +450,67 @@ class DicomQueryHandler:
         Returns:
             Dict containing the de-anonymized response data, or None if failed
         """
-        return self.query_all_dicom_metadata() 
\ No newline at end of file
+        return self.query_all_dicom_metadata()
+
+
+class CachedMetadataSource:
+    """
+    Shares the de-anonymized API metadata between query handlers
+    
+    A hierarchical C-FIND session (patient, study, series, image) asks for the
+    same payload at every level, so it is fetched once per TTL window. After a
+    failed fetch the API is not queried again for an exponentially growing
+    backoff, so an outage doesn't make every query wait for the HTTP timeout.
+    """
+    
+    def __init__(self, query_handler: DicomQueryHandler, ttl: float = DEFAULT_METADATA_TTL):
+        """
+        Initialize the metadata cache
+        
+        Args:
+            query_handler: Handler used to fetch the metadata from the API
+            ttl: Seconds a fetched payload is served before it is refreshed
+        """
+        self.query_handler = query_handler
+        self.ttl = ttl
+        self._timestamp = None
+        self._data = None
+        self._failures = 0
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+    
+    def get(self) -> Optional[Dict[str, Any]]:
+        """
+        Get the API metadata, fetching it only if the cached copy has expired
+        
+        Returns:
+            Dict containing the de-anonymized response data, or None if failed
+            or backing off after a failure. The dict is shared between callers
+            and must not be modified.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._timestamp is not None and now - self._timestamp < self.ttl:
+                return self._data
+            
+            if now < self._retry_at:
+                return None
+            
+            data = self.query_handler.query_all_metadata()
+            if data is not None:
+                # Failed fetches are not cached so a later query retries
+                self._timestamp = time.monotonic()
+                self._data = data
+                self._failures = 0
+            else:
+                self._failures += 1
+                backoff = min(MAX_METADATA_BACKOFF, 2 ** self._failures)
+                self._retry_at = time.monotonic() + backoff
+                logger.warning(f"API metadata unavailable, skipping API queries for {backoff}s")
+            return data
+    
+    def invalidate(self) -> None:
+        """Discard the cached payload so the next get() fetches it again"""
+        with self._lock:
+            self._timestamp = None
+            self._data = None
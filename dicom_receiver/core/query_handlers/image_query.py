@@ -6,14 +6,38 @@ Handles image-level queries with local storage and API fallback
 """
 
 import logging
+from operator import itemgetter
 from pydicom import Dataset
+from pydicom.config import IGNORE
+from pydicom.dataelem import DataElement
+from pydicom.tag import Tag
 
 logger = logging.getLogger('dicom_receiver.query.image')
 
+# Query/Retrieve Level element of every response
+QUERY_RETRIEVE_LEVEL_TAG = Tag(0x0008, 0x0052)
+STUDY_INSTANCE_UID_TAG = Tag(0x0020, 0x000D)
+SERIES_INSTANCE_UID_TAG = Tag(0x0020, 0x000E)
+
+# (tag, VR, row key) of the elements returned for every image
+IMAGE_RESPONSE_FIELDS = (
+    (Tag(0x0010, 0x0010), 'PN', 'PatientName'),
+    (Tag(0x0010, 0x0020), 'LO', 'PatientID'),
+    (Tag(0x0020, 0x000D), 'UI', 'StudyInstanceUID'),
+    (Tag(0x0020, 0x000E), 'UI', 'SeriesInstanceUID'),
+    (Tag(0x0008, 0x0018), 'UI', 'SOPInstanceUID'),
+    (Tag(0x0008, 0x0016), 'UI', 'SOPClassUID'),
+    (Tag(0x0020, 0x0013), 'IS', 'InstanceNumber'),
+)
+
+# Fetches a row's values in IMAGE_RESPONSE_FIELDS order with a single call;
+# local and API image rows always carry all of these keys
+image_row_values = itemgetter(*(key for _, _, key in IMAGE_RESPONSE_FIELDS))
+
 class ImageQueryHandler:
     """Handler for image-level C-FIND queries"""
     
-    def __init__(self, storage, query_handler, anonymization_utils, api_integration_utils):
+    def __init__(self, storage, metadata_source, anonymization_utils, api_integration_utils):
         """
         Initialize the image query handler
         
@@ -21,15 +45,15 @@ class ImageQueryHandler:
         -----------
         storage : DicomStorage
             Storage handler for local DICOM files
-        query_handler : DicomQueryHandler
-            Handler for API queries (can be None)
+        metadata_source : CachedMetadataSource
+            Shared cache of API metadata (can be None)
         anonymization_utils : AnonymizationUtils
             Utilities for de-anonymization
         api_integration_utils : ApiIntegrationUtils
             Utilities for API integration (can be None)
         """
         self.storage = storage
-        self.query_handler = query_handler
+        self.metadata_source = metadata_source
         self.anonymization_utils = anonymization_utils
         self.api_integration_utils = api_integration_utils
     
@@ -37,8 +61,9 @@ class ImageQueryHandler:
         """Find images matching the query"""
         logger.info("🖼️ Processing IMAGE level C-FIND")
         
-        study_uid = getattr(query_ds, 'StudyInstanceUID', None)
-        series_uid = getattr(query_ds, 'SeriesInstanceUID', None)
+        # Look the UIDs up by tag to skip pydicom's keyword resolution
+        study_elem = query_ds.get(STUDY_INSTANCE_UID_TAG)
+        study_uid = study_elem.value if study_elem is not None else None
         
         if not study_uid:
             logger.warning("❌ StudyInstanceUID required for IMAGE level query")
@@ -48,6 +73,8 @@ class ImageQueryHandler:
             yield 0x0000, None
             return
         
+        series_elem = query_ds.get(SERIES_INSTANCE_UID_TAG)
+        series_uid = series_elem.value if series_elem is not None else None
         if not series_uid:
             logger.info("ℹ️ No SeriesInstanceUID provided, will search all series in study")
             # Continue with the query but search all series in the study
@@ -65,10 +92,10 @@ class ImageQueryHandler:
         logger.info(f"📊 Found {len(images)} images in local storage")
         
         # If no local images and we have API access, query the API
-        if not images and self.query_handler and self.api_integration_utils:
+        if not images and self.metadata_source and self.api_integration_utils:
             logger.info("🌐 No local images found, querying API...")
             try:
-                api_data = self.query_handler.query_all_metadata()
+                api_data = self.metadata_source.get()
                 if api_data:
                     if series_uid:
                         # Query specific series
@@ -86,32 +113,27 @@ class ImageQueryHandler:
             except Exception as e:
                 logger.error(f"❌ Error querying API: {e}")
         
+        # Per-row details are only formatted when debug logging is enabled
+        debug = logger.isEnabledFor(logging.DEBUG)
+        # One response dataset is refilled for every row: pynetdicom encodes each
+        # pending response before it asks for the next one. The query level is the
+        # same for every row, so it is only set once
+        response_ds = Dataset()
+        response_ds.add_new(QUERY_RETRIEVE_LEVEL_TAG, 'CS', 'IMAGE')
         response_count = 0
         for image_info in images:
-            # Create response dataset
-            response_ds = Dataset()
-            response_ds.QueryRetrieveLevel = 'IMAGE'
-            
-            # Set patient information (already de-anonymized if from API)
-            response_ds.PatientName = image_info.get('PatientName', '')
-            response_ds.PatientID = image_info.get('PatientID', '')
-            
-            # Set study information
-            response_ds.StudyInstanceUID = image_info.get('StudyInstanceUID', '')
-            
-            # Set series information
-            response_ds.SeriesInstanceUID = image_info.get('SeriesInstanceUID', '')
-            
-            # Set image information
-            response_ds.SOPInstanceUID = image_info.get('SOPInstanceUID', '')
-            response_ds.SOPClassUID = image_info.get('SOPClassUID', '')
-            response_ds.InstanceNumber = image_info.get('InstanceNumber', '')
+            # Overwrite the response fields from precomputed tags, avoiding keyword lookups
+            # (patient information is already de-anonymized if from API)
+            # Values come from storage/API rows already in DICOM form, so per-element
+            # VR validation is skipped
+            for (tag, vr, _), value in zip(IMAGE_RESPONSE_FIELDS, image_row_values(image_info)):
+                response_ds[tag] = DataElement(tag, vr, value, validation_mode=IGNORE)
             
-            logger.info(f"📤 Returning image #{response_count + 1}:")
-            logger.info(f"   👤 Patient: {response_ds.PatientName} (ID: {response_ds.PatientID})")
-            logger.info(f"   🖼️ Instance: #{response_ds.InstanceNumber or 'N/A'}")
-            logger.info(f"   🆔 SOP UID: {response_ds.SOPInstanceUID}")
-            logger.info(f"   📋 SOP Class: {response_ds.SOPClassUID}")
+            if debug:
+                logger.debug("📤 Returning image #%d: 👤 %s (ID: %s) 🖼️ #%s 🆔 %s 📋 %s",
+                             response_count + 1, response_ds.PatientName, response_ds.PatientID,
+                             response_ds.InstanceNumber or 'N/A', response_ds.SOPInstanceUID,
+                             response_ds.SOPClassUID)
             
             response_count += 1
             yield 0xFF00, response_ds  # Pending status
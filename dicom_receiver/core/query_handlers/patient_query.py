@@ -7,13 +7,31 @@ Handles patient-level queries with local storage and API fallback
 
 import logging
 from pydicom import Dataset
+from pydicom.config import IGNORE
+from pydicom.dataelem import DataElement
+from pydicom.tag import Tag
 
 logger = logging.getLogger('dicom_receiver.query.patient')
 
+# Query/Retrieve Level element of every response
+QUERY_RETRIEVE_LEVEL_TAG = Tag(0x0008, 0x0052)
+
+# (tag, VR, row key) of the elements returned for every patient
+PATIENT_RESPONSE_FIELDS = (
+    (Tag(0x0010, 0x0010), 'PN', 'PatientName'),
+    (Tag(0x0010, 0x0020), 'LO', 'PatientID'),
+)
+
+# Elements only returned when the row has a value for them
+PATIENT_OPTIONAL_FIELDS = (
+    (Tag(0x0010, 0x0030), 'DA', 'PatientBirthDate'),
+    (Tag(0x0010, 0x0040), 'CS', 'PatientSex'),
+)
+
 class PatientQueryHandler:
     """Handler for patient-level C-FIND queries"""
     
-    def __init__(self, storage, query_handler, anonymization_utils, api_integration_utils):
+    def __init__(self, storage, metadata_source, anonymization_utils, api_integration_utils):
         """
         Initialize the patient query handler
         
@@ -21,15 +39,15 @@ class PatientQueryHandler:
         -----------
         storage : DicomStorage
             Storage handler for local DICOM files
-        query_handler : DicomQueryHandler
-            Handler for API queries (can be None)
+        metadata_source : CachedMetadataSource
+            Shared cache of API metadata (can be None)
         anonymization_utils : AnonymizationUtils
             Utilities for de-anonymization
         api_integration_utils : ApiIntegrationUtils
             Utilities for API integration (can be None)
         """
         self.storage = storage
-        self.query_handler = query_handler
+        self.metadata_source = metadata_source
         self.anonymization_utils = anonymization_utils
         self.api_integration_utils = api_integration_utils
     
@@ -42,10 +60,10 @@ class PatientQueryHandler:
         logger.info(f"📊 Found {len(patients)} patients in local storage")
         
         # If no local patients and we have API access, query the API
-        if not patients and self.query_handler and self.api_integration_utils:
+        if not patients and self.metadata_source and self.api_integration_utils:
             logger.info("🌐 No local patients found, querying API...")
             try:
-                api_data = self.query_handler.query_all_metadata()
+                api_data = self.metadata_source.get()
                 if api_data:
                     patients = self.api_integration_utils.extract_patients_from_api_data(
                         api_data, self.anonymization_utils
@@ -56,21 +74,32 @@ class PatientQueryHandler:
             except Exception as e:
                 logger.error(f"❌ Error querying API: {e}")
         
+        # Per-row details are only formatted when debug logging is enabled
+        debug = logger.isEnabledFor(logging.DEBUG)
+        # One response dataset is refilled for every row: pynetdicom encodes each
+        # pending response before it asks for the next one. The query level is the
+        # same for every row, so it is only set once
+        response_ds = Dataset()
+        response_ds.add_new(QUERY_RETRIEVE_LEVEL_TAG, 'CS', 'PATIENT')
         response_count = 0
         for patient_info in patients:
-            # Create response dataset
-            response_ds = Dataset()
-            response_ds.QueryRetrieveLevel = 'PATIENT'
-            
-            response_ds.PatientName = patient_info.get('PatientName', '')
-            response_ds.PatientID = patient_info.get('PatientID', '')
-            
-            if 'PatientBirthDate' in patient_info:
-                response_ds.PatientBirthDate = patient_info['PatientBirthDate']
-            if 'PatientSex' in patient_info:
-                response_ds.PatientSex = patient_info['PatientSex']
+            # Overwrite the response fields from precomputed tags, avoiding keyword lookups
+            # (patient information is already de-anonymized if from API)
+            # Values come from storage/API rows already in DICOM form, so per-element
+            # VR validation is skipped
+            get = patient_info.get
+            for tag, vr, key in PATIENT_RESPONSE_FIELDS:
+                response_ds[tag] = DataElement(tag, vr, get(key, ''), validation_mode=IGNORE)
+            for tag, vr, key in PATIENT_OPTIONAL_FIELDS:
+                if key in patient_info:
+                    response_ds[tag] = DataElement(tag, vr, patient_info[key], validation_mode=IGNORE)
+                else:
+                    # Don't carry an optional field over from the previous row
+                    response_ds.pop(tag, None)
             
-            logger.info(f"📤 Returning patient #{response_count + 1}: {response_ds.PatientName} (ID: {response_ds.PatientID})")
+            if debug:
+                logger.debug("📤 Returning patient #%d: %s (ID: %s)",
+                             response_count + 1, response_ds.PatientName, response_ds.PatientID)
             response_count += 1
             yield 0xFF00, response_ds  # Pending status
         
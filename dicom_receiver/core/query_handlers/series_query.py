@@ -7,13 +7,38 @@ Handles series-level queries with local storage and API fallback
 
 import logging
 from pydicom import Dataset
+from pydicom.config import IGNORE
+from pydicom.dataelem import DataElement
+from pydicom.tag import Tag
 
 logger = logging.getLogger('dicom_receiver.query.series')
 
+# Query/Retrieve Level element of every response
+QUERY_RETRIEVE_LEVEL_TAG = Tag(0x0008, 0x0052)
+STUDY_INSTANCE_UID_TAG = Tag(0x0020, 0x000D)
+
+# (tag, VR, row key) of the elements returned for every series
+SERIES_RESPONSE_FIELDS = (
+    (Tag(0x0010, 0x0010), 'PN', 'PatientName'),
+    (Tag(0x0010, 0x0020), 'LO', 'PatientID'),
+    (Tag(0x0020, 0x000D), 'UI', 'StudyInstanceUID'),
+    (Tag(0x0020, 0x000E), 'UI', 'SeriesInstanceUID'),
+    (Tag(0x0020, 0x0011), 'IS', 'SeriesNumber'),
+    (Tag(0x0008, 0x103E), 'LO', 'SeriesDescription'),
+    (Tag(0x0008, 0x0060), 'CS', 'Modality'),
+    (Tag(0x0008, 0x0021), 'DA', 'SeriesDate'),
+    (Tag(0x0008, 0x0031), 'TM', 'SeriesTime'),
+)
+
+# Elements only returned when the row has a value for them
+SERIES_OPTIONAL_FIELDS = (
+    (Tag(0x0020, 0x1209), 'IS', 'NumberOfSeriesRelatedInstances'),
+)
+
 class SeriesQueryHandler:
     """Handler for series-level C-FIND queries"""
     
-    def __init__(self, storage, query_handler, anonymization_utils, api_integration_utils):
+    def __init__(self, storage, metadata_source, anonymization_utils, api_integration_utils):
         """
         Initialize the series query handler
         
@@ -21,15 +46,15 @@ class SeriesQueryHandler:
         -----------
         storage : DicomStorage
             Storage handler for local DICOM files
-        query_handler : DicomQueryHandler
-            Handler for API queries (can be None)
+        metadata_source : CachedMetadataSource
+            Shared cache of API metadata (can be None)
         anonymization_utils : AnonymizationUtils
             Utilities for de-anonymization
         api_integration_utils : ApiIntegrationUtils
             Utilities for API integration (can be None)
         """
         self.storage = storage
-        self.query_handler = query_handler
+        self.metadata_source = metadata_source
         self.anonymization_utils = anonymization_utils
         self.api_integration_utils = api_integration_utils
     
@@ -37,7 +62,9 @@ class SeriesQueryHandler:
         """Find series matching the query"""
         logger.info("📁 Processing SERIES level C-FIND")
         
-        study_uid = getattr(query_ds, 'StudyInstanceUID', None)
+        # Look the UID up by tag to skip pydicom's keyword resolution
+        study_elem = query_ds.get(STUDY_INSTANCE_UID_TAG)
+        study_uid = study_elem.value if study_elem is not None else None
         if not study_uid:
             logger.warning("❌ No StudyInstanceUID provided for SERIES level query")
             yield 0xC000, None
@@ -50,50 +77,53 @@ class SeriesQueryHandler:
         logger.info(f"📊 Found {len(series_list)} series in local storage")
         
         # If no local series and we have API access, query the API
-        if not series_list and self.query_handler and self.api_integration_utils:
+        if not series_list and self.metadata_source and self.api_integration_utils:
             logger.info("🌐 No local series found, querying API...")
             try:
-                api_data = self.query_handler.query_all_metadata()
+                api_data = self.metadata_source.get()
                 if api_data:
                     series_list = self.api_integration_utils.extract_series_from_api_data(
                         api_data, study_uid, self.anonymization_utils
                     )
                     logger.info(f"🌐 Found {len(series_list)} series from API")
+                    if series_list:
+                        # A retrieval of the study usually follows, so start downloading it
+                        self.api_integration_utils.prefetch_study(study_uid)
                 else:
                     logger.warning("🌐 API query returned no data")
             except Exception as e:
                 logger.error(f"❌ Error querying API: {e}")
         
+        # Per-row details are only formatted when debug logging is enabled
+        debug = logger.isEnabledFor(logging.DEBUG)
+        # One response dataset is refilled for every row: pynetdicom encodes each
+        # pending response before it asks for the next one. The query level is the
+        # same for every row, so it is only set once
+        response_ds = Dataset()
+        response_ds.add_new(QUERY_RETRIEVE_LEVEL_TAG, 'CS', 'SERIES')
         response_count = 0
         for series_info in series_list:
-            # Create response dataset
-            response_ds = Dataset()
-            response_ds.QueryRetrieveLevel = 'SERIES'
-            
-            # Set patient information (already de-anonymized if from API)
-            response_ds.PatientName = series_info.get('PatientName', '')
-            response_ds.PatientID = series_info.get('PatientID', '')
-            
-            # Set study information
-            response_ds.StudyInstanceUID = series_info.get('StudyInstanceUID', '')
-            
-            # Set series information
-            response_ds.SeriesInstanceUID = series_info.get('SeriesInstanceUID', '')
-            response_ds.SeriesNumber = series_info.get('SeriesNumber', '')
-            response_ds.SeriesDescription = series_info.get('SeriesDescription', '')
-            response_ds.Modality = series_info.get('Modality', '')
-            response_ds.SeriesDate = series_info.get('SeriesDate', '')
-            response_ds.SeriesTime = series_info.get('SeriesTime', '')
-            
-            if 'NumberOfSeriesRelatedInstances' in series_info:
-                response_ds.NumberOfSeriesRelatedInstances = series_info['NumberOfSeriesRelatedInstances']
+            # Overwrite the response fields from precomputed tags, avoiding keyword lookups
+            # (patient information is already de-anonymized if from API)
+            # Values come from storage/API rows already in DICOM form, so per-element
+            # VR validation is skipped
+            get = series_info.get
+            for tag, vr, key in SERIES_RESPONSE_FIELDS:
+                response_ds[tag] = DataElement(tag, vr, get(key, ''), validation_mode=IGNORE)
+            for tag, vr, key in SERIES_OPTIONAL_FIELDS:
+                if key in series_info:
+                    response_ds[tag] = DataElement(tag, vr, series_info[key], validation_mode=IGNORE)
+                else:
+                    # Don't carry an optional field over from the previous row
+                    response_ds.pop(tag, None)
             
-            logger.info(f"📤 Returning series #{response_count + 1}:")
-            logger.info(f"   👤 Patient: {response_ds.PatientName} (ID: {response_ds.PatientID})")
-            logger.info(f"   📁 Series: {response_ds.SeriesDescription or 'No Description'} (#{response_ds.SeriesNumber or 'N/A'})")
-            logger.info(f"   🏥 Modality: {response_ds.Modality or 'Unknown'}")
-            logger.info(f"   🆔 UID: {response_ds.SeriesInstanceUID}")
-            logger.info(f"   🖼️ Images: {getattr(response_ds, 'NumberOfSeriesRelatedInstances', 0)}")
+            if debug:
+                logger.debug("📤 Returning series #%d: 👤 %s (ID: %s) 📁 %s (#%s) 🏥 %s 🆔 %s 🖼️ Images: %s",
+                             response_count + 1, response_ds.PatientName, response_ds.PatientID,
+                             response_ds.SeriesDescription or 'No Description',
+                             response_ds.SeriesNumber or 'N/A', response_ds.Modality or 'Unknown',
+                             response_ds.SeriesInstanceUID,
+                             getattr(response_ds, 'NumberOfSeriesRelatedInstances', 0))
             
             response_count += 1
             yield 0xFF00, response_ds  # Pending status
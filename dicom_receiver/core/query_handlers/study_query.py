@@ -7,13 +7,39 @@ Handles study-level queries with local storage and API fallback
 
 import logging
 from pydicom import Dataset
+from pydicom.config import IGNORE
+from pydicom.dataelem import DataElement
+from pydicom.tag import Tag
 
 logger = logging.getLogger('dicom_receiver.query.study')
 
+# Query/Retrieve Level element of every response
+QUERY_RETRIEVE_LEVEL_TAG = Tag(0x0008, 0x0052)
+
+# (tag, VR, row key) of the elements returned for every study
+STUDY_RESPONSE_FIELDS = (
+    (Tag(0x0010, 0x0010), 'PN', 'PatientName'),
+    (Tag(0x0010, 0x0020), 'LO', 'PatientID'),
+    (Tag(0x0020, 0x000D), 'UI', 'StudyInstanceUID'),
+    (Tag(0x0020, 0x0010), 'SH', 'StudyID'),
+    (Tag(0x0008, 0x1030), 'LO', 'StudyDescription'),
+    (Tag(0x0008, 0x0020), 'DA', 'StudyDate'),
+    (Tag(0x0008, 0x0030), 'TM', 'StudyTime'),
+    (Tag(0x0008, 0x0050), 'SH', 'AccessionNumber'),
+)
+
+# Elements only returned when the row has a value for them
+STUDY_OPTIONAL_FIELDS = (
+    (Tag(0x0010, 0x0030), 'DA', 'PatientBirthDate'),
+    (Tag(0x0010, 0x0040), 'CS', 'PatientSex'),
+    (Tag(0x0020, 0x1206), 'IS', 'NumberOfStudyRelatedSeries'),
+    (Tag(0x0020, 0x1208), 'IS', 'NumberOfStudyRelatedInstances'),
+)
+
 class StudyQueryHandler:
     """Handler for study-level C-FIND queries"""
     
-    def __init__(self, storage, query_handler, anonymization_utils, api_integration_utils):
+    def __init__(self, storage, metadata_source, anonymization_utils, api_integration_utils):
         """
         Initialize the study query handler
         
@@ -21,15 +47,15 @@ class StudyQueryHandler:
         -----------
         storage : DicomStorage
             Storage handler for local DICOM files
-        query_handler : DicomQueryHandler
-            Handler for API queries (can be None)
+        metadata_source : CachedMetadataSource
+            Shared cache of API metadata (can be None)
         anonymization_utils : AnonymizationUtils
             Utilities for de-anonymization
         api_integration_utils : ApiIntegrationUtils
             Utilities for API integration (can be None)
         """
         self.storage = storage
-        self.query_handler = query_handler
+        self.metadata_source = metadata_source
         self.anonymization_utils = anonymization_utils
         self.api_integration_utils = api_integration_utils
     
@@ -42,10 +68,10 @@ class StudyQueryHandler:
         logger.info(f"📊 Found {len(studies)} studies in local storage")
         
         # If no local studies and we have API access, query the API
-        if not studies and self.query_handler and self.api_integration_utils:
+        if not studies and self.metadata_source and self.api_integration_utils:
             logger.info("🌐 No local studies found, querying API...")
             try:
-                api_data = self.query_handler.query_all_metadata()
+                api_data = self.metadata_source.get()
                 if api_data:
                     studies = self.api_integration_utils.extract_studies_from_api_data(
                         api_data, self.anonymization_utils
@@ -56,39 +82,36 @@ class StudyQueryHandler:
             except Exception as e:
                 logger.error(f"❌ Error querying API: {e}")
         
+        # Per-row details are only formatted when debug logging is enabled
+        debug = logger.isEnabledFor(logging.DEBUG)
+        # One response dataset is refilled for every row: pynetdicom encodes each
+        # pending response before it asks for the next one. The query level is the
+        # same for every row, so it is only set once
+        response_ds = Dataset()
+        response_ds.add_new(QUERY_RETRIEVE_LEVEL_TAG, 'CS', 'STUDY')
         response_count = 0
         for study_info in studies:
-            # Create response dataset
-            response_ds = Dataset()
-            response_ds.QueryRetrieveLevel = 'STUDY'
-            
-            # Set patient information (already de-anonymized if from API)
-            response_ds.PatientName = study_info.get('PatientName', '')
-            response_ds.PatientID = study_info.get('PatientID', '')
-            
-            # Set study information
-            response_ds.StudyInstanceUID = study_info.get('StudyInstanceUID', '')
-            response_ds.StudyID = study_info.get('StudyID', '')
-            response_ds.StudyDescription = study_info.get('StudyDescription', '')
-            response_ds.StudyDate = study_info.get('StudyDate', '')
-            response_ds.StudyTime = study_info.get('StudyTime', '')
-            response_ds.AccessionNumber = study_info.get('AccessionNumber', '')
-            
-            if 'PatientBirthDate' in study_info:
-                response_ds.PatientBirthDate = study_info['PatientBirthDate']
-            if 'PatientSex' in study_info:
-                response_ds.PatientSex = study_info['PatientSex']
-            if 'NumberOfStudyRelatedSeries' in study_info:
-                response_ds.NumberOfStudyRelatedSeries = study_info['NumberOfStudyRelatedSeries']
-            if 'NumberOfStudyRelatedInstances' in study_info:
-                response_ds.NumberOfStudyRelatedInstances = study_info['NumberOfStudyRelatedInstances']
+            # Overwrite the response fields from precomputed tags, avoiding keyword lookups
+            # (patient information is already de-anonymized if from API)
+            # Values come from storage/API rows already in DICOM form, so per-element
+            # VR validation is skipped
+            get = study_info.get
+            for tag, vr, key in STUDY_RESPONSE_FIELDS:
+                response_ds[tag] = DataElement(tag, vr, get(key, ''), validation_mode=IGNORE)
+            for tag, vr, key in STUDY_OPTIONAL_FIELDS:
+                if key in study_info:
+                    response_ds[tag] = DataElement(tag, vr, study_info[key], validation_mode=IGNORE)
+                else:
+                    # Don't carry an optional field over from the previous row
+                    response_ds.pop(tag, None)
             
-            logger.info(f"📤 Returning study #{response_count + 1}:")
-            logger.info(f"   👤 Patient: {response_ds.PatientName} (ID: {response_ds.PatientID})")
-            logger.info(f"   📋 Study: {response_ds.StudyDescription or 'No Description'}")
-            logger.info(f"   📅 Date: {response_ds.StudyDate or 'Unknown'}")
-            logger.info(f"   🆔 UID: {response_ds.StudyInstanceUID}")
-            logger.info(f"   📊 Series: {getattr(response_ds, 'NumberOfStudyRelatedSeries', 0)}, Images: {getattr(response_ds, 'NumberOfStudyRelatedInstances', 0)}")
+            if debug:
+                logger.debug("📤 Returning study #%d: 👤 %s (ID: %s) 📋 %s 📅 %s 🆔 %s 📊 Series: %s, Images: %s",
+                             response_count + 1, response_ds.PatientName, response_ds.PatientID,
+                             response_ds.StudyDescription or 'No Description',
+                             response_ds.StudyDate or 'Unknown', response_ds.StudyInstanceUID,
+                             getattr(response_ds, 'NumberOfStudyRelatedSeries', 0),
+                             getattr(response_ds, 'NumberOfStudyRelatedInstances', 0))
             
             response_count += 1
             yield 0xFF00, response_ds  # Pending status
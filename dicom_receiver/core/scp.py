@@ -7,8 +7,9 @@ Main coordinator for DICOM networking, associations, and operations
 
 import logging
 import signal
+import sys
 import threading
-import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
@@ -27,12 +28,58 @@ from pynetdicom.sop_class import (
 from dicom_receiver.core.crypto import DicomEncryptor
 from dicom_receiver.core.storage import DicomStorage, StudyMonitor
 from dicom_receiver.core.uploader import ApiUploader
-from dicom_receiver.core.query import DicomQueryHandler
+from dicom_receiver.core.query import DicomQueryHandler, CachedMetadataSource
 from dicom_receiver.core.handlers import StoreHandler, FindHandler, GetHandler, MoveHandler
 from dicom_receiver.core.utils import AnonymizationUtils, ApiIntegrationUtils
 
 logger = logging.getLogger('dicom_receiver.scp')
 
+def _set_windows_timer_resolution(enable: bool):
+    """
+    Request (or release) a 1 ms system timer resolution on Windows
+    
+    pynetdicom's socket polling sleeps between reads; with Windows' default
+    ~15.6 ms timer tick, large transfers spend most of their time in those
+    sleeps. Does nothing on other platforms.
+    
+    Parameters:
+    -----------
+    enable : bool
+        True to request the 1 ms resolution, False to release it
+    """
+    if sys.platform != 'win32':
+        return
+    try:
+        import ctypes
+        winmm = ctypes.WinDLL('winmm')
+        if enable:
+            winmm.timeBeginPeriod(1)
+        else:
+            winmm.timeEndPeriod(1)
+    except (OSError, AttributeError) as e:
+        logger.warning(f"Could not change the Windows timer resolution: {e}")
+
+# Completed studies zipped and uploaded concurrently
+MAX_UPLOAD_WORKERS = 4
+
+# Threads writing received instances to disk while the association keeps receiving
+STORE_WRITE_WORKERS = 4
+
+# Transfer syntaxes negotiated for storage contexts
+STORAGE_TRANSFER_SYNTAXES = [ImplicitVRLittleEndian, ExplicitVRLittleEndian]
+
+# Query/retrieve and verification contexts, with pynetdicom's default transfer syntaxes
+QUERY_RETRIEVE_CONTEXTS = (
+    StudyRootQueryRetrieveInformationModelFind,
+    PatientRootQueryRetrieveInformationModelFind,
+    ModalityWorklistInformationFind,
+    StudyRootQueryRetrieveInformationModelGet,
+    PatientRootQueryRetrieveInformationModelGet,
+    StudyRootQueryRetrieveInformationModelMove,
+    PatientRootQueryRetrieveInformationModelMove,
+    Verification,
+)
+
 class DicomServiceProvider:
     """
     DICOM Service Class Provider (SCP) that receives and processes DICOM files
@@ -55,7 +102,8 @@ class DicomServiceProvider:
                  zip_dir: str = 'zips',
                  cleanup_after_upload: bool = False,
                  max_retries: int = 3,
-                 retry_delay: int = 5):
+                 retry_delay: int = 5,
+                 max_concurrent_uploads: int = MAX_UPLOAD_WORKERS):
         """
         Initialize the DICOM SCP
         
@@ -89,6 +137,8 @@ class DicomServiceProvider:
             Maximum number of retry attempts for failed API operations
         retry_delay : int
             Delay between retry attempts in seconds
+        max_concurrent_uploads : int
+            Maximum number of completed studies zipped and uploaded at the same time
         """
         # Core components
         self.storage = storage
@@ -103,6 +153,7 @@ class DicomServiceProvider:
         self.server_thread = None
         self.ae = None
         self.shutdown_event = threading.Event()
+        self.upload_executor = None
         
         # Initialize utilities
         self.anonymization_utils = AnonymizationUtils(encryptor)
@@ -116,10 +167,13 @@ class DicomServiceProvider:
                 password=api_password,
                 token=api_token
             )
-            self.api_integration_utils = ApiIntegrationUtils(self.query_handler, api_url)
+            # API metadata is shared by the C-FIND levels and result lookups
+            self.metadata_source = CachedMetadataSource(self.query_handler)
+            self.api_integration_utils = ApiIntegrationUtils(self.query_handler, api_url, self.metadata_source)
             logger.info(f"Query handler initialized for API: {api_url}")
         else:
             self.query_handler = None
+            self.metadata_source = None
             self.api_integration_utils = None
             logger.info("No API URL provided - queries will only use local storage")
         
@@ -128,9 +182,9 @@ class DicomServiceProvider:
         self.ae_config = AEConfiguration()
         
         # Initialize handlers
-        self.store_handler = StoreHandler(storage, study_monitor, encryptor)
+        self.store_handler = StoreHandler(storage, study_monitor, encryptor, STORE_WRITE_WORKERS)
         self.find_handler = FindHandler(
-            storage, self.query_handler, self.anonymization_utils, self.api_integration_utils
+            storage, self.metadata_source, self.anonymization_utils, self.api_integration_utils
         )
         self.get_handler = GetHandler(
             storage, self.query_handler, self.anonymization_utils, self.api_integration_utils
@@ -156,11 +210,13 @@ class DicomServiceProvider:
         if auto_upload:
             self._setup_auto_upload(
                 api_url, api_username, api_password, api_token,
-                zip_dir, cleanup_after_upload, max_retries, retry_delay
+                zip_dir, cleanup_after_upload, max_retries, retry_delay,
+                max_concurrent_uploads
             )
     
     def _setup_auto_upload(self, api_url, api_username, api_password, api_token,
-                          zip_dir, cleanup_after_upload, max_retries, retry_delay):
+                          zip_dir, cleanup_after_upload, max_retries, retry_delay,
+                          max_concurrent_uploads):
         """Setup auto-upload functionality"""
         self.zip_dir = Path(zip_dir)
         self.zip_dir.mkdir(parents=True, exist_ok=True)
@@ -175,12 +231,22 @@ class DicomServiceProvider:
             retry_delay=retry_delay
         )
         
-        self.study_monitor.register_study_complete_callback(self._study_complete_handler)
+        # Uploads run on their own workers: the study monitor invokes callbacks while
+        # holding the lock that every incoming C-STORE needs
+        self.upload_executor = ThreadPoolExecutor(
+            max_workers=max_concurrent_uploads, thread_name_prefix='upload'
+        )
+        self.study_monitor.register_study_complete_callback(self._submit_study_upload)
         
         logger.info(f"Auto-upload enabled. Studies will be uploaded to {api_url}")
         if cleanup_after_upload:
             logger.info("Cleanup after upload is enabled. Files will be removed after successful upload.")
         logger.info(f"Upload retry mechanism: max_retries={max_retries}, retry_delay={retry_delay}s")
+        logger.info(f"Up to {max_concurrent_uploads} studies are uploaded concurrently")
+    
+    def _submit_study_upload(self, study_uid):
+        """Queue a completed study to be zipped and uploaded on an upload worker"""
+        self.upload_executor.submit(self._study_complete_handler, study_uid)
     
     def _study_complete_handler(self, study_uid):
         """
@@ -193,6 +259,9 @@ class DicomServiceProvider:
         """
         logger.info(f"Processing completed study: {study_uid}")
         
+        # Files received just before the timeout may still be queued for writing
+        self.store_handler.wait_for_writes(study_uid)
+        
         # Get the study directory using the backward compatibility method
         study_dir = self.storage.get_study_path_by_uid(study_uid)
         
@@ -207,8 +276,9 @@ class DicomServiceProvider:
                 logger.warning(f"No anonymized patient name found for study {study_uid}, using study UID")
                 anonymized_name = study_uid
             
-            # Use anonymized patient name for zip file
-            zip_path = self.zip_dir / f"{anonymized_name}.zip"
+            # Use anonymized patient name for zip file, qualified by the study so that
+            # studies of the same patient uploading concurrently don't share a file
+            zip_path = self.zip_dir / f"{anonymized_name}_{study_uid}.zip"
             
             zip_file = self.api_uploader.zip_study(study_dir, str(zip_path))
             
@@ -226,6 +296,9 @@ class DicomServiceProvider:
             
             if success:
                 logger.info(f"Successfully uploaded study: {study_uid} as {anonymized_name}")
+                if self.metadata_source:
+                    # Let the next C-FIND pick up the newly uploaded study
+                    self.metadata_source.invalidate()
                 if response_data and 'id' in response_data:
                     logger.info(f"Dataset ID: {response_data.get('id')}")
                 if hasattr(self, 'api_uploader') and self.api_uploader.cleanup_after_upload:
@@ -238,6 +311,7 @@ class DicomServiceProvider:
     
     def _server_process(self):
         """Run the DICOM server in a separate thread"""
+        _set_windows_timer_resolution(True)
         try:
             # Configure pynetdicom to handle both ASCII and UTF-8 encodings
             # This fixes issues with OsiriX/Horos and other DICOM viewers that may send UTF-8 encoded strings
@@ -245,59 +319,37 @@ class DicomServiceProvider:
             
             self.ae = AE(ae_title=self.ae_title)
             
-            # Add storage presentation contexts with both SCP and SCU roles
-            # This is crucial for C-GET and C-MOVE operations to work properly
+            # Configure every storage context in a single pass
             for context in StoragePresentationContexts:
+                # Add storage presentation contexts with both SCP and SCU roles
+                # This is crucial for C-GET and C-MOVE operations to work properly
                 self.ae.add_supported_context(
                     context.abstract_syntax,
                     scu_role=True,  # Enable SCU role for sending files back to client during C-GET/C-MOVE
                     scp_role=True,  # Enable SCP role for receiving files during C-STORE
-                    transfer_syntax=[ImplicitVRLittleEndian, ExplicitVRLittleEndian]
+                    transfer_syntax=STORAGE_TRANSFER_SYNTAXES
                 )
                 
-            # WORKAROUND: Add storage contexts again without explicit role selection
-            # This handles DICOM viewers like Horos that don't properly negotiate SCP role during C-GET
-            # The default behavior (no role selection) allows both SCU and SCP roles
-            for context in StoragePresentationContexts:
+                # WORKAROUND: Add storage contexts again without explicit role selection
+                # This handles DICOM viewers like Horos that don't properly negotiate SCP role during C-GET
+                # The default behavior (no role selection) allows both SCU and SCP roles
                 self.ae.add_supported_context(
                     context.abstract_syntax,
                     transfer_syntax=[ImplicitVRLittleEndian]  # Use only Implicit VR for maximum compatibility
                 )
                 
-            # Add storage contexts as SCU for C-MOVE operations
-            # When pynetdicom handles C-MOVE, it creates a new association to send files
-            # This association needs SCU contexts configured
-            for context in StoragePresentationContexts:
+                # Add storage contexts as SCU for C-MOVE operations
+                # When pynetdicom handles C-MOVE, it creates a new association to send files
+                # This association needs SCU contexts configured
                 self.ae.add_requested_context(
                     context.abstract_syntax,
-                    transfer_syntax=[ImplicitVRLittleEndian, ExplicitVRLittleEndian]
+                    transfer_syntax=STORAGE_TRANSFER_SYNTAXES
                 )
             
-            # Add query/retrieve presentation contexts for C-FIND
-            self.ae.add_supported_context(StudyRootQueryRetrieveInformationModelFind)
-            self.ae.add_supported_context(PatientRootQueryRetrieveInformationModelFind)
-            self.ae.add_supported_context(ModalityWorklistInformationFind)
-            
-            # Add query/retrieve presentation contexts for C-GET
-            self.ae.add_supported_context(StudyRootQueryRetrieveInformationModelGet)
-            self.ae.add_supported_context(PatientRootQueryRetrieveInformationModelGet)
-            
-            # Add query/retrieve presentation contexts for C-MOVE
-            self.ae.add_supported_context(StudyRootQueryRetrieveInformationModelMove)
-            self.ae.add_supported_context(PatientRootQueryRetrieveInformationModelMove)
-            
-            # Add verification context
-            self.ae.add_supported_context(Verification)
-            
-            # Configure transfer syntaxes for query/retrieve contexts only
-            # Storage contexts already have transfer syntax configured above
-            for context in self.ae.supported_contexts:
-                # Only configure transfer syntax for contexts that don't have it set
-                if not hasattr(context, 'transfer_syntax') or not context.transfer_syntax:
-                    context.transfer_syntax = [
-                        ImplicitVRLittleEndian,
-                        ExplicitVRLittleEndian
-                    ]
+            # Add query/retrieve presentation contexts for C-FIND, C-GET and C-MOVE,
+            # plus the verification context
+            for abstract_syntax in QUERY_RETRIEVE_CONTEXTS:
+                self.ae.add_supported_context(abstract_syntax)
             
             # Setup event handlers using the modular handlers
             handlers = [
@@ -320,15 +372,17 @@ class DicomServiceProvider:
             logger.info("Storage contexts configured with dual role support for maximum compatibility")
             logger.info("Note: C-MOVE requires destination AE configuration for proper operation")
             
-            while not self.shutdown_event.is_set():
-                time.sleep(0.1)
+            self.shutdown_event.wait()
                 
         except Exception as e:
             logger.error(f"Error in DICOM server process: {e}")
         finally:
+            # Wake start() if the server stopped on its own
+            self.shutdown_event.set()
             if self.ae:
                 self.ae.shutdown()
                 logger.info("DICOM server has been shut down")
+            _set_windows_timer_resolution(False)
     
     def start(self):
         """Start the DICOM receiver service in non-blocking mode"""
@@ -353,8 +407,11 @@ class DicomServiceProvider:
         signal.signal(signal.SIGTERM, self._signal_handler)
         
         try:
-            while self.server_thread.is_alive():
-                self.server_thread.join(1.0)
+            # Blocks until stop() (or a failed server thread) sets the event. The wait
+            # is timed because an untimed wait can't be interrupted on Windows, where
+            # Ctrl+C would otherwise never reach the signal handler
+            while not self.shutdown_event.wait(1.0):
+                pass
         except KeyboardInterrupt:
             logger.info("Keyboard interrupt received, stopping DICOM receiver")
             self.stop()
@@ -374,6 +431,17 @@ class DicomServiceProvider:
         
         if self.server_thread and self.server_thread.is_alive():
             self.server_thread.join(5.0)
+        
+        # Finish writing received instances before their studies can be uploaded
+        self.store_handler.shutdown()
+        
+        # Don't start queued study prefetches
+        if self.api_integration_utils:
+            self.api_integration_utils.shutdown()
+        
+        # Let uploads that are already queued finish
+        if self.upload_executor:
+            self.upload_executor.shutdown(wait=True)
             
         self.is_running = False
         logger.info("DICOM receiver stopped")
@@ -5,15 +5,24 @@ Storage module for DICOM files
 Handles file storage, study tracking, and timeout monitoring
 """
 
+import heapq
 import logging
 import threading
 import time
 from pathlib import Path
-from typing import Dict, Set
+from typing import Dict, Optional, Set
 import shutil
 
 logger = logging.getLogger('dicom_receiver.storage')
 
+# Header values kept per stored instance to answer C-FIND without reading files
+INDEXED_KEYWORDS = (
+    'SOPInstanceUID', 'SOPClassUID', 'InstanceNumber',
+    'PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex',
+    'StudyDescription', 'StudyDate', 'StudyTime', 'StudyID', 'AccessionNumber',
+    'SeriesDescription', 'SeriesNumber', 'Modality', 'SeriesDate', 'SeriesTime'
+)
+
 class StudyMonitor:
     """
     Monitors study activity and detects when studies are complete
@@ -30,8 +39,13 @@ class StudyMonitor:
             Timeout in seconds after receiving the last file in a study
         """
         self.timeout = timeout
-        self.study_last_activity = {}
+        self.study_last_activity = {}  # Monotonic time of the last file received per study
         self.study_monitor_lock = threading.Lock()
+        # Signalled when a study starts being monitored
+        self._activity_changed = threading.Condition(self.study_monitor_lock)
+        # (deadline, study UID) for every monitored study, earliest first. A study keeps
+        # one entry, which is moved back when files arrived after it was scheduled
+        self._expiry_heap = []
         self.active_studies = set()
         self.study_complete_callbacks = []
         
@@ -44,27 +58,40 @@ class StudyMonitor:
     
     def update_study_activity(self, study_uid: str):
         """Update the last activity timestamp for a study"""
-        now = time.time()
+        now = time.monotonic()
         with self.study_monitor_lock:
+            if study_uid not in self.study_last_activity:
+                heapq.heappush(self._expiry_heap, (now + self.timeout, study_uid))
+                self._activity_changed.notify()
             self.study_last_activity[study_uid] = now
             self.active_studies.add(study_uid)
     
     def _monitor_studies_timeout(self):
         """Monitor studies for timeout since last activity"""
         while True:
-            current_time = time.time()
             studies_to_finalize = []
             
-            with self.study_monitor_lock:
-                for study_uid, last_activity in list(self.study_last_activity.items()):
-                    if current_time - last_activity > self.timeout:
+            with self._activity_changed:
+                # Sleep until the earliest deadline instead of scanning every study each second
+                while not self._expiry_heap:
+                    self._activity_changed.wait()
+                
+                current_time = time.monotonic()
+                while self._expiry_heap and self._expiry_heap[0][0] <= current_time:
+                    _, study_uid = heapq.heappop(self._expiry_heap)
+                    deadline = self.study_last_activity[study_uid] + self.timeout
+                    if deadline <= current_time:
                         studies_to_finalize.append(study_uid)
                         self.study_last_activity.pop(study_uid)
+                    else:
+                        # Files were received after the entry was scheduled
+                        heapq.heappush(self._expiry_heap, (deadline, study_uid))
+                
+                if not studies_to_finalize:
+                    self._activity_changed.wait(self._expiry_heap[0][0] - current_time)
             
             for study_uid in studies_to_finalize:
                 self._finalize_study(study_uid)
-            
-            time.sleep(1)
     
     def _finalize_study(self, study_uid: str):
         """Finalize a study after timeout"""
@@ -102,6 +129,15 @@ class DicomStorage:
         self.storage_dir.mkdir(parents=True, exist_ok=True)
         # Maps to track patient ID to study UIDs
         self.patient_study_map = {}
+        # Maps StudyInstanceUID to its study directory
+        self.study_path_map = {}
+        # Set once study_path_map holds every study on disk, so a miss means "not stored"
+        self._study_index_loaded = False
+        # Maps each scans directory to (directory mtime, {filename: instance info})
+        self.series_index = {}
+        # Scans directories already created, so a series only pays for mkdir once
+        self._known_dirs = set()
+        self._index_lock = threading.Lock()
     
     def get_file_path(self, study_uid: str, series_uid: str, instance_uid: str, dataset=None) -> Path:
         """
@@ -142,11 +178,90 @@ class DicomStorage:
         study_dir = patient_dir / study_uid
         series_dir = study_dir / series_uid
         scans_dir = series_dir / "scans"
-        scans_dir.mkdir(parents=True, exist_ok=True)
+        if scans_dir not in self._known_dirs:
+            scans_dir.mkdir(parents=True, exist_ok=True)
+            self._known_dirs.add(scans_dir)
+        self.study_path_map[study_uid] = study_dir
         
         filename = f"{instance_uid}.dcm"
         return scans_dir / filename
     
+    def _instance_info(self, dataset) -> Dict[str, str]:
+        """Extract the indexed header values from a dataset"""
+        return {
+            keyword: str(getattr(dataset, keyword))
+            for keyword in INDEXED_KEYWORDS
+            if hasattr(dataset, keyword)
+        }
+    
+    def index_instance(self, file_path: Path, dataset):
+        """
+        Record the header values of a stored instance in the series index
+        
+        Parameters:
+        -----------
+        file_path : Path
+            Path the dataset was saved to
+        dataset : Dataset
+            The dataset as written to disk
+        """
+        info = self._instance_info(dataset)
+        scans_dir = file_path.parent
+        with self._index_lock:
+            _, instances = self.series_index.get(scans_dir, (None, {}))
+            instances[file_path.name] = info
+            # The directory changed, so the next lookup re-lists it but reuses this entry
+            self.series_index[scans_dir] = (None, instances)
+    
+    def _get_series_instances(self, scans_dir: Path) -> Dict[str, Dict[str, str]]:
+        """
+        Get the indexed header values of every instance in a scans directory
+        
+        The directory is only re-listed when its mtime changes, and only files
+        that are not indexed yet are read, so removed files drop out and
+        repeated queries don't parse any DICOM data.
+        
+        Parameters:
+        -----------
+        scans_dir : Path
+            The scans directory of a series
+            
+        Returns:
+        --------
+        Dict[str, Dict]: Instance info keyed by filename
+        """
+        try:
+            mtime = scans_dir.stat().st_mtime_ns
+        except OSError:
+            with self._index_lock:
+                self.series_index.pop(scans_dir, None)
+            return {}
+        
+        with self._index_lock:
+            cached_mtime, instances = self.series_index.get(scans_dir, (None, {}))
+            if cached_mtime == mtime:
+                return dict(instances)
+            instances = dict(instances)
+        
+        current = {}
+        for dcm_file in scans_dir.glob("*.dcm"):
+            info = instances.get(dcm_file.name)
+            if info is None:
+                try:
+                    from pydicom import dcmread
+                    # Only the indexed header elements are parsed; pixel data is never read
+                    ds = dcmread(dcm_file, stop_before_pixels=True, specific_tags=INDEXED_KEYWORDS)
+                    info = self._instance_info(ds)
+                except Exception as e:
+                    # Not cached, so a file still being written is retried next time
+                    logger.warning(f"Error reading DICOM file {dcm_file}: {e}")
+                    continue
+            current[dcm_file.name] = info
+        
+        with self._index_lock:
+            self.series_index[scans_dir] = (mtime, current)
+        return dict(current)
+    
     def get_patient_path(self, patient_id: str) -> Path:
         """Get the path to a patient directory"""
         return self.storage_dir / patient_id
@@ -163,19 +278,54 @@ class DicomStorage:
         """Get the path to the scans directory within a series"""
         return self.storage_dir / patient_id / study_uid / series_uid / "scans"
     
+    def _load_study_index(self):
+        """Record every study directory on disk in study_path_map with a single walk"""
+        for patient_dir in self.storage_dir.iterdir():
+            if not patient_dir.is_dir():
+                continue
+            for study_dir in patient_dir.iterdir():
+                if study_dir.is_dir():
+                    self.study_path_map.setdefault(study_dir.name, study_dir)
+        self._study_index_loaded = True
+    
     # Backward compatibility methods
     def get_study_path_by_uid(self, study_uid: str) -> Path:
         """Get the study path for backward compatibility"""
-        # Try to find the study by checking all patient directories
-        for patient_dir in self.storage_dir.iterdir():
-            if patient_dir.is_dir():
-                study_dir = patient_dir / study_uid
-                if study_dir.exists():
-                    return study_dir
+        # Studies are resolved without touching the disk
+        study_dir = self.study_path_map.get(study_uid)
+        if study_dir is None and not self._study_index_loaded:
+            self._load_study_index()
+            study_dir = self.study_path_map.get(study_uid)
+        
+        # New studies are registered by get_file_path, so once the index is loaded
+        # a miss is answered without walking every patient directory
+        if study_dir is not None and study_dir.exists():
+            return study_dir
         
         # Fallback to old path structure if not found
         return self.storage_dir / study_uid
     
+    def get_instance_path_by_uid(self, sop_uid: str) -> Optional[Path]:
+        """
+        Get the path of a stored instance by its SOPInstanceUID
+        
+        Files are named after their SOPInstanceUID, so the instance is found by
+        filename without reading any DICOM data.
+        
+        Parameters:
+        -----------
+        sop_uid : str
+            SOPInstanceUID of the instance
+            
+        Returns:
+        --------
+        Path or None: Path to the stored file, or None if not found
+        """
+        for file_path in self.storage_dir.glob(f"*/*/*/scans/{sop_uid}.dcm"):
+            return file_path
+        
+        return None
+    
     def migrate_to_patient_structure(self, patient_study_map=None):
         """
         Migrate existing files from study/series/instance.dcm to patient/study/series/scans/instance.dcm
@@ -229,6 +379,10 @@ class DicomStorage:
             if not any(dir_path.iterdir()):
                 shutil.rmtree(str(dir_path))
                 
+        # Studies have moved, so the index is rebuilt on the next lookup
+        self.study_path_map.clear()
+        self._study_index_loaded = False
+        
         logger.info("Migration to patient/study/series/scans structure complete")
     
     def get_all_patients(self):
@@ -250,7 +404,7 @@ class DicomStorage:
             # Get patient info from the first DICOM file we can find
             patient_info = {'PatientID': patient_id}
             
-            # Look for any DICOM file to extract patient information
+            # Look for any indexed instance to extract patient information
             for study_dir in patient_dir.iterdir():
                 if not study_dir.is_dir():
                     continue
@@ -259,25 +413,13 @@ class DicomStorage:
                     if not series_dir.is_dir():
                         continue
                         
-                    scans_dir = series_dir / "scans"
-                    if scans_dir.exists():
-                        for dcm_file in scans_dir.glob("*.dcm"):
-                            try:
-                                from pydicom import dcmread
-                                ds = dcmread(dcm_file)
-                                
-                                if hasattr(ds, 'PatientName'):
-                                    patient_info['PatientName'] = str(ds.PatientName)
-                                if hasattr(ds, 'PatientBirthDate'):
-                                    patient_info['PatientBirthDate'] = str(ds.PatientBirthDate)
-                                if hasattr(ds, 'PatientSex'):
-                                    patient_info['PatientSex'] = str(ds.PatientSex)
-                                
-                                patients.append(patient_info)
-                                return patients  # Found one patient, return
-                            except Exception as e:
-                                logger.warning(f"Error reading DICOM file {dcm_file}: {e}")
-                                continue
+                    for info in self._get_series_instances(series_dir / "scans").values():
+                        for keyword in ('PatientName', 'PatientBirthDate', 'PatientSex'):
+                            if keyword in info:
+                                patient_info[keyword] = info[keyword]
+                        
+                        patients.append(patient_info)
+                        return patients  # Found one patient, return
         
         return patients
     
@@ -311,42 +453,23 @@ class DicomStorage:
                 series_count = 0
                 instance_count = 0
                 
-                # Get study info from the first DICOM file we can find
+                # Get study info from the first indexed instance we can find
                 for series_dir in study_dir.iterdir():
                     if not series_dir.is_dir():
                         continue
                         
                     series_count += 1
-                    scans_dir = series_dir / "scans"
-                    if scans_dir.exists():
-                        dcm_files = list(scans_dir.glob("*.dcm"))
-                        instance_count += len(dcm_files)
-                        
-                        # Extract study information from first DICOM file
-                        if dcm_files and 'StudyDescription' not in study_info:
-                            try:
-                                from pydicom import dcmread
-                                ds = dcmread(dcm_files[0])
-                                
-                                if hasattr(ds, 'PatientName'):
-                                    study_info['PatientName'] = str(ds.PatientName)
-                                if hasattr(ds, 'PatientBirthDate'):
-                                    study_info['PatientBirthDate'] = str(ds.PatientBirthDate)
-                                if hasattr(ds, 'PatientSex'):
-                                    study_info['PatientSex'] = str(ds.PatientSex)
-                                if hasattr(ds, 'StudyDescription'):
-                                    study_info['StudyDescription'] = str(ds.StudyDescription)
-                                if hasattr(ds, 'StudyDate'):
-                                    study_info['StudyDate'] = str(ds.StudyDate)
-                                if hasattr(ds, 'StudyTime'):
-                                    study_info['StudyTime'] = str(ds.StudyTime)
-                                if hasattr(ds, 'StudyID'):
-                                    study_info['StudyID'] = str(ds.StudyID)
-                                if hasattr(ds, 'AccessionNumber'):
-                                    study_info['AccessionNumber'] = str(ds.AccessionNumber)
-                                    
-                            except Exception as e:
-                                logger.warning(f"Error reading DICOM file {dcm_files[0]}: {e}")
+                    instances = self._get_series_instances(series_dir / "scans")
+                    instance_count += len(instances)
+                    
+                    # Extract study information from the first instance
+                    if instances and 'StudyDescription' not in study_info:
+                        info = next(iter(instances.values()))
+                        for keyword in ('PatientName', 'PatientBirthDate', 'PatientSex',
+                                        'StudyDescription', 'StudyDate', 'StudyTime',
+                                        'StudyID', 'AccessionNumber'):
+                            if keyword in info:
+                                study_info[keyword] = info[keyword]
                 
                 study_info['NumberOfStudyRelatedSeries'] = series_count
                 study_info['NumberOfStudyRelatedInstances'] = instance_count
@@ -386,32 +509,16 @@ class DicomStorage:
             
             scans_dir = series_dir / "scans"
             if scans_dir.exists():
-                dcm_files = list(scans_dir.glob("*.dcm"))
-                series_info['NumberOfSeriesRelatedInstances'] = len(dcm_files)
+                instances = self._get_series_instances(scans_dir)
+                series_info['NumberOfSeriesRelatedInstances'] = len(instances)
                 
-                # Extract series information from first DICOM file
-                if dcm_files:
-                    try:
-                        from pydicom import dcmread
-                        ds = dcmread(dcm_files[0])
-                        
-                        if hasattr(ds, 'PatientName'):
-                            series_info['PatientName'] = str(ds.PatientName)
-                        if hasattr(ds, 'PatientID'):
-                            series_info['PatientID'] = str(ds.PatientID)
-                        if hasattr(ds, 'SeriesDescription'):
-                            series_info['SeriesDescription'] = str(ds.SeriesDescription)
-                        if hasattr(ds, 'SeriesNumber'):
-                            series_info['SeriesNumber'] = str(ds.SeriesNumber)
-                        if hasattr(ds, 'Modality'):
-                            series_info['Modality'] = str(ds.Modality)
-                        if hasattr(ds, 'SeriesDate'):
-                            series_info['SeriesDate'] = str(ds.SeriesDate)
-                        if hasattr(ds, 'SeriesTime'):
-                            series_info['SeriesTime'] = str(ds.SeriesTime)
-                            
-                    except Exception as e:
-                        logger.warning(f"Error reading DICOM file {dcm_files[0]}: {e}")
+                # Extract series information from the first instance
+                if instances:
+                    info = next(iter(instances.values()))
+                    for keyword in ('PatientName', 'PatientID', 'SeriesDescription',
+                                    'SeriesNumber', 'Modality', 'SeriesDate', 'SeriesTime'):
+                        if keyword in info:
+                            series_info[keyword] = info[keyword]
             
             series_list.append(series_info)
         
@@ -447,30 +554,22 @@ class DicomStorage:
         if not scans_dir.exists():
             return images
         
-        for dcm_file in scans_dir.glob("*.dcm"):
-            try:
-                from pydicom import dcmread
-                ds = dcmread(dcm_file)
-                
-                image_info = {
-                    'StudyInstanceUID': study_uid,
-                    'SeriesInstanceUID': series_uid,
-                    'SOPInstanceUID': str(ds.SOPInstanceUID),
-                    'SOPClassUID': str(ds.SOPClassUID)
-                }
-                
-                if hasattr(ds, 'PatientName'):
-                    image_info['PatientName'] = str(ds.PatientName)
-                if hasattr(ds, 'PatientID'):
-                    image_info['PatientID'] = str(ds.PatientID)
-                if hasattr(ds, 'InstanceNumber'):
-                    image_info['InstanceNumber'] = str(ds.InstanceNumber)
-                
-                images.append(image_info)
-                
-            except Exception as e:
-                logger.warning(f"Error reading DICOM file {dcm_file}: {e}")
+        for info in self._get_series_instances(scans_dir).values():
+            if 'SOPInstanceUID' not in info or 'SOPClassUID' not in info:
                 continue
+            
+            image_info = {
+                'StudyInstanceUID': study_uid,
+                'SeriesInstanceUID': series_uid,
+                'SOPInstanceUID': info['SOPInstanceUID'],
+                'SOPClassUID': info['SOPClassUID']
+            }
+            
+            # Every row carries the same keys as the API rows, empty if unknown
+            for keyword in ('PatientName', 'PatientID', 'InstanceNumber'):
+                image_info[keyword] = info.get(keyword, '')
+            
+            images.append(image_info)
         
         return images
     
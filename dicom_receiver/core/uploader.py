@@ -6,6 +6,7 @@ Handles authentication and upload of zipped DICOM studies to remote API
 """
 
 import os
+import base64
 from dicom_receiver.utils import json_utils as json
 import logging
 import zipfile
@@ -13,11 +14,123 @@ import requests
 import shutil
 import time
 import threading
+import uuid
+from io import BytesIO
 from pathlib import Path
 from typing import Dict, Optional, Any
 
+from requests.adapters import HTTPAdapter
+from urllib3.fields import RequestField
+
 logger = logging.getLogger('dicom_receiver.uploader')
 
+# Block size used to write upload bodies to the socket (urllib3 defaults to 16 KiB)
+UPLOAD_BLOCKSIZE = 1024 * 1024
+
+# Deflate level for study zips: the fastest level gives most of the size reduction
+# on uncompressed pixel data at a fraction of the default level's CPU time
+ZIP_COMPRESSLEVEL = 1
+
+# Seconds before its expiry at which an access token is replaced by logging in again
+TOKEN_REFRESH_MARGIN = 30
+
+def _token_expiry(token: Optional[str]) -> Optional[float]:
+    """
+    Get the time.monotonic() deadline at which a JWT access token expires
+    
+    Args:
+        token (str, optional): Access token
+        
+    Returns:
+        float: Monotonic expiry time, or None if the token carries no expiry
+    """
+    if not token:
+        return None
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return time.monotonic() + float(claims['exp']) - time.time()
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+class MultipartFileBody:
+    """
+    A multipart/form-data request body that streams its file part from disk
+    
+    requests reads files passed with files= fully into memory before sending.
+    This body reports its total length up front, so it is still sent with a
+    Content-Length, while the file is read in blocks as the request is written.
+    """
+    
+    def __init__(self, fields: Dict[str, str], file_field: str, file_path: str,
+                 content_type: str = 'application/octet-stream'):
+        """
+        Build the body for a set of form fields and one file
+        
+        Args:
+            fields (dict): Form fields sent before the file
+            file_field (str): Name of the file form field
+            file_path (str): Path of the file to send
+            content_type (str): Content type of the file part
+        """
+        boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        
+        # Same encoding as requests/urllib3 use for files= uploads
+        head = BytesIO()
+        for name, value in fields.items():
+            field = RequestField(name=name, data=value)
+            field.make_multipart()
+            head.write(f'--{boundary}\r\n'.encode())
+            head.write(field.render_headers().encode())
+            head.write(value.encode('utf-8'))
+            head.write(b'\r\n')
+        
+        file_part = RequestField(name=file_field, data=b'', filename=os.path.basename(file_path))
+        file_part.make_multipart(content_type=content_type)
+        head.write(f'--{boundary}\r\n'.encode())
+        head.write(file_part.render_headers().encode())
+        head.seek(0)
+        
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        
+        self._length = len(head.getbuffer()) + os.path.getsize(file_path) + len(tail)
+        self._parts = [head, open(file_path, 'rb'), BytesIO(tail)]
+    
+    def __len__(self) -> int:
+        return self._length
+    
+    def read(self, size: int = -1) -> bytes:
+        """Read up to size bytes of the body (all remaining bytes if size is negative)"""
+        chunks = []
+        while self._parts and size != 0:
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0).close()
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+    
+    def close(self):
+        """Close the file part if the body was not read to the end"""
+        for part in self._parts:
+            part.close()
+        self._parts = []
+
+class UploadAdapter(HTTPAdapter):
+    """
+    HTTP adapter whose connections send request bodies in large blocks
+    
+    A streamed study zip is otherwise written in 16 KiB reads and socket
+    sends, so multi-GB uploads spend most of their CPU in per-block overhead.
+    """
+    
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs.setdefault('blocksize', UPLOAD_BLOCKSIZE)
+        super().init_poolmanager(*args, **kwargs)
+
 class ApiUploader:
     """
     Handles authentication and uploading of zipped DICOM studies
@@ -47,6 +160,7 @@ class ApiUploader:
         self.username = username
         self.password = password
         self.auth_token = token
+        self.auth_token_expires = _token_expiry(token)
         self.user_info = None
         self.cleanup_after_upload = cleanup_after_upload
         self.max_retries = max_retries
@@ -54,6 +168,27 @@ class ApiUploader:
         
         self.auth_lock = threading.Lock()
         
+        # Session used for study uploads, sending the zip in large blocks
+        self.upload_session = requests.Session()
+        self.upload_session.mount('http://', UploadAdapter())
+        self.upload_session.mount('https://', UploadAdapter())
+        
+    def has_valid_token(self) -> bool:
+        """
+        Check whether the current token can be used without logging in again
+        
+        A token close to its expiry only counts as invalid when there are
+        credentials to get a new one with.
+        
+        Returns:
+            bool: True if the token can be sent with a request
+        """
+        if not self.auth_token:
+            return False
+        if self.auth_token_expires is None or not (self.username and self.password):
+            return True
+        return time.monotonic() < self.auth_token_expires - TOKEN_REFRESH_MARGIN
+        
     def login(self) -> tuple:
         """
         Authenticate with the API and get access token
@@ -62,7 +197,7 @@ class ApiUploader:
             bool: True if authentication successful, False otherwise
         """
         with self.auth_lock:
-            if self.auth_token:
+            if self.has_valid_token():
                 return True
                 
             if not self.username or not self.password:
@@ -81,8 +216,9 @@ class ApiUploader:
                     )
                     
                     if response.status_code == 200:
-                        auth_data = json.loads(response.text)
+                        auth_data = json.loads(response.content)
                         self.auth_token = auth_data.get("access")
+                        self.auth_token_expires = _token_expiry(self.auth_token)
                         self.user_info = auth_data.get("user")
                         logger.info(f"Successfully authenticated as {self.username}")
                         return True
@@ -121,7 +257,7 @@ class ApiUploader:
         
         try:
             logger.info(f"Creating zip file from study at {study_dir}")
-            with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zipf:
                 for root, _, files in os.walk(study_dir):
                     for file in files:
                         file_path = Path(root) / file
@@ -152,7 +288,7 @@ class ApiUploader:
         Returns:
             tuple: (success (bool), response_data (dict or None))
         """
-        if not self.auth_token and not self.login():
+        if not self.has_valid_token() and not self.login():
             logger.error("Failed to obtain authentication token for upload")
             return False, None
             
@@ -184,24 +320,24 @@ class ApiUploader:
                         if key != 'name':
                             form_data[key] = str(value)
                 
-                files = {
-                    'file': (os.path.basename(zip_file_path), open(zip_file_path, 'rb'), 'application/octet-stream')
-                }
+                # Stream the zip from disk instead of loading the whole study into memory
+                body = MultipartFileBody(form_data, 'file', zip_file_path)
                 
                 headers = {
                     'Authorization': f'Bearer {self.auth_token}',
                     'User-Agent': 'Mozilla/5.0',
-                    'Accept': 'application/json'
+                    'Accept': 'application/json',
+                    'Content-Type': body.content_type
                 }
                 
-                response = requests.post(
-                    upload_url,
-                    headers=headers,
-                    files=files,
-                    data=form_data
-                )
-                
-                files['file'][1].close()
+                try:
+                    response = self.upload_session.post(
+                        upload_url,
+                        headers=headers,
+                        data=body
+                    )
+                finally:
+                    body.close()
                 
                 logger.debug(f"Upload response status: {response.status_code}")
                 logger.debug(f"Upload response content type: {response.headers.get('Content-Type', 'unknown')}")
@@ -210,7 +346,7 @@ class ApiUploader:
                 
                 if upload_success and 'application/json' in response.headers.get('Content-Type', ''):
                     try:
-                        response_data = json.loads(response.text)
+                        response_data = json.loads(response.content)
                         logger.info(f"Dataset uploaded with ID: {response_data.get('id')}")
                     except json.JSONDecodeError:
                         logger.warning("Unable to parse JSON response")
@@ -238,11 +374,6 @@ class ApiUploader:
                     
             except Exception as e:
                 logger.warning(f"Error during upload attempt {attempt}: {e}")
-                if 'files' in locals() and 'file' in files and hasattr(files['file'][1], 'close'):
-                    try:
-                        files['file'][1].close()
-                    except:
-                        pass
             
             if attempt < self.max_retries:
                 retry_seconds = self.retry_delay * attempt
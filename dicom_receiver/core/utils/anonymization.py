@@ -28,15 +28,24 @@ class AnonymizationUtils:
         if not anonymized_name:
             return None
         
-        # Check if this is an anonymized name that we can de-anonymize
-        reverse_map = {v: k for k, v in self.encryptor.patient_name_map.items()}
-        return reverse_map.get(anonymized_name, None)
+        # The map is keyed by plain strings; PersonName values compare unequal to them
+        if not isinstance(anonymized_name, str):
+            anonymized_name = str(anonymized_name)
+        
+        # Check if this is an anonymized name that we can de-anonymize, using the
+        # reverse map the anonymizer keeps in sync instead of inverting it per call
+        return self.encryptor.reverse_name_map.get(anonymized_name, None)
     
     def get_original_patient_id(self, patient_id):
         """Get the original patient ID from patient ID (handles both old and new anonymization)"""
         if not patient_id:
             return None
         
+        # Only an ID equal to an anonymized name can be an old anonymized ID, so
+        # every other ID is returned without scanning the patient info map
+        if patient_id not in self.encryptor.reverse_name_map:
+            return patient_id
+        
         # Check if this is an old anonymized ID (like "sub-001") that needs to be de-anonymized
         if hasattr(self.encryptor, 'patient_info_map'):
             for study_uid, patient_info in self.encryptor.patient_info_map.items():
@@ -64,8 +73,9 @@ class AnonymizationUtils:
             
             # Fallback to manual de-anonymization using patient name mapping
             # De-anonymize PatientName
-            if hasattr(dataset, 'PatientName'):
-                original_name = self.get_original_patient_name(str(dataset.PatientName))
+            patient_name = dataset.get('PatientName')
+            if patient_name:
+                original_name = self.get_original_patient_name(patient_name)
                 if original_name:
                     dataset.PatientName = original_name
                     logger.debug(f"🔄 De-anonymized PatientName: {dataset.PatientName}")
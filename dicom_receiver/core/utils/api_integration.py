@@ -5,19 +5,133 @@ API Integration utilities for DICOM operations
 Handles API queries, downloads, and data processing
 """
 
+import itertools
 import logging
+import shutil
 import tempfile
+import threading
+import time
 import zipfile
-import requests
-from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import partial
 from io import BytesIO
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from pydicom.tag import Tag
 
 logger = logging.getLogger('dicom_receiver.utils.api_integration')
 
+# The only elements parsed when matching downloaded files against a series or instance
+FILTER_TAGS = [Tag(0x0020, 0x000E), Tag(0x0008, 0x0018)]  # SeriesInstanceUID, SOPInstanceUID
+
+# Block size used to copy downloaded ZIPs to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Seconds a downloaded study or series ZIP is reused by later retrievals
+DOWNLOAD_CACHE_TTL = 600
+
+# Total size of the kept downloads before the least recently used ones are removed
+MAX_DOWNLOAD_CACHE_BYTES = 1024 * 1024 * 1024
+
+# Background study downloads queued or running at once; further requests are skipped
+MAX_PENDING_PREFETCHES = 2
+
+@dataclass
+class IndexedApiData:
+    """De-anonymized C-FIND rows built from one API metadata payload"""
+    patients: List[Dict] = field(default_factory=list)
+    studies: List[Dict] = field(default_factory=list)
+    series_by_study: Dict[str, List[Dict]] = field(default_factory=dict)
+    images_by_series: Dict[Tuple[str, str], List[Dict]] = field(default_factory=dict)
+
+class ZipDownloadCache:
+    """
+    Keeps recently downloaded ZIP archives in a temporary directory
+    
+    A viewer retrieving a study series by series, or image by image, would
+    otherwise download the same archive from the API for every request.
+    Archives are reused for a limited time, and the least recently used ones
+    are removed once the cache grows over its size limit. The directory is
+    removed when the cache is garbage collected or the process exits.
+    """
+    
+    def __init__(self, ttl: float = DOWNLOAD_CACHE_TTL, max_bytes: int = MAX_DOWNLOAD_CACHE_BYTES):
+        """
+        Initialize the download cache
+        
+        Parameters:
+        -----------
+        ttl : float
+            Seconds an archive is reused after it was downloaded
+        max_bytes : int
+            Total size of the kept archives before old ones are removed
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._dir = tempfile.TemporaryDirectory(prefix='dicom_receiver_downloads_')
+        self._entries = OrderedDict()  # key -> (path, size, download time), least recently used first
+        self._total_bytes = 0
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+    
+    def new_path(self) -> Path:
+        """Get a unique path to download an archive to before it is added"""
+        return Path(self._dir.name) / f"{next(self._counter)}.zip"
+    
+    def get(self, key) -> Optional[Path]:
+        """Get the path of a cached archive, or None if it isn't cached or has expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            
+            path, _, downloaded_at = entry
+            if time.monotonic() - downloaded_at >= self.ttl or not path.exists():
+                self._remove(key)
+                return None
+            
+            self._entries.move_to_end(key)
+            return path
+    
+    def add(self, key, path: Path) -> None:
+        """Add a downloaded archive, removing the least recently used ones if over the limit"""
+        size = path.stat().st_size
+        with self._lock:
+            if key in self._entries:
+                # Downloaded concurrently by another request
+                self._remove(key)
+            self._entries[key] = (path, size, time.monotonic())
+            self._total_bytes += size
+            
+            # The newest archive is always kept, even if it is over the limit on its own
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+    
+    def discard(self, path: Path) -> None:
+        """Remove a download that won't be added, e.g. because it failed"""
+        try:
+            path.unlink()
+        except OSError:
+            pass
+    
+    def _remove(self, key) -> None:
+        """Drop an entry and its file (caller holds the lock)"""
+        path, size, _ = self._entries.pop(key)
+        self._total_bytes -= size
+        try:
+            path.unlink()
+        except OSError as e:
+            # Still open by a retrieval on Windows; removed with the directory
+            logger.debug(f"Could not remove cached download {path}: {e}")
+
+
 class ApiIntegrationUtils:
     """Utilities for API integration and downloads"""
     
-    def __init__(self, query_handler, api_url):
+    def __init__(self, query_handler, api_url, metadata_source=None):
         """
         Initialize with query handler and API URL
         
@@ -27,245 +141,410 @@ class ApiIntegrationUtils:
             The query handler for API operations
         api_url : str
             Base API URL
+        metadata_source : CachedMetadataSource, optional
+            Shared metadata cache used for result lookups instead of querying the API
         """
         self.query_handler = query_handler
         self.api_url = api_url
+        self.metadata_source = metadata_source
+        
+        # Indexes of the last payload, rebuilt only when a different payload is passed in
+        self._indexed = None
+        self._indexed_source = None
+        self._result_ids = None
+        self._result_ids_source = None
+        self._index_lock = threading.Lock()
+        
+        # Downloaded archives, reused by retrievals of the same study or series
+        self.download_cache = ZipDownloadCache()
+        
+        # Downloads in progress by cache key, awaited by concurrent retrievals of the same archive
+        self._downloads = {}
+        self._download_lock = threading.Lock()
+        
+        # Background study downloads by StudyInstanceUID (see prefetch_study)
+        self._prefetch_executor = None
+        self._prefetches = {}
+        self._prefetch_lock = threading.Lock()
+    
+    def _get_result_ids(self, api_data):
+        """
+        Get the StudyInstanceUID to result_id map of an API payload
+        
+        The map is kept for the last payload, so the retrievals of a study's
+        series and images don't each scan every result in the metadata.
+        """
+        with self._index_lock:
+            if self._result_ids is None or self._result_ids_source is not api_data:
+                result_ids = {}
+                for result_item in api_data['results']:
+                    if 'result' not in result_item:
+                        continue
+                    if 'dicom_data' in result_item and 'studies' in result_item['dicom_data']:
+                        for study_uid in result_item['dicom_data']['studies']:
+                            # The first result containing a study wins
+                            result_ids.setdefault(study_uid, result_item['result']['id'])
+                self._result_ids = result_ids
+                self._result_ids_source = api_data
+            return self._result_ids
     
     def get_result_id_for_study(self, study_uid):
         """Get the result_id for a given study UID from API metadata"""
         try:
-            api_data = self.query_handler.query_all_metadata()
+            if self.metadata_source:
+                api_data = self.metadata_source.get()
+            else:
+                api_data = self.query_handler.query_all_metadata()
             if api_data and 'results' in api_data:
-                for result_item in api_data['results']:
-                    if 'dicom_data' in result_item and 'studies' in result_item['dicom_data']:
-                        studies_data = result_item['dicom_data']['studies']
-                        if study_uid in studies_data:
-                            return result_item['result']['id']
+                return self._get_result_ids(api_data).get(study_uid)
             return None
         except Exception as e:
             logger.error(f"❌ Error getting result_id for study {study_uid}: {e}")
             return None
     
+    def _request_study_zip(self, result_id, study_uid):
+        """Request a study ZIP from the API, re-authenticating once if needed"""
+        # Ensure we have a valid authentication token
+        if not self.query_handler._authenticate():
+            logger.error("❌ Failed to authenticate for download")
+            return None
+        
+        # Prepare download URL and headers
+        url = f"{self.api_url}/processing/results/{result_id}/download_dicom_study/"
+        params = {"study_uid": study_uid}
+        headers = {"Authorization": f"Bearer {self.query_handler.api_uploader.auth_token}"}
+        
+        logger.info(f"🌐 Downloading from: {url}")
+        logger.info(f"📋 Parameters: {params}")
+        
+        # Download the ZIP file over the query handler's keep-alive session
+        response = self.query_handler.session.get(url, params=params, headers=headers, stream=True)
+        
+        # Handle authentication failure
+        if response.status_code == 401:
+            logger.warning("❌ Authentication failed during download, attempting to re-authenticate")
+            # Clear the existing token to force fresh authentication
+            with self.query_handler.api_uploader.auth_lock:
+                self.query_handler.api_uploader.auth_token = None
+            
+            if self.query_handler._authenticate():
+                # Retry with new token, handing the rejected connection back to the pool first
+                response.close()
+                headers["Authorization"] = f"Bearer {self.query_handler.api_uploader.auth_token}"
+                response = self.query_handler.session.get(url, params=params, headers=headers, stream=True)
+                response.raise_for_status()
+            else:
+                logger.error("❌ Re-authentication failed during download")
+                return None
+        else:
+            response.raise_for_status()
+        
+        return response
+    
+    def _save_response(self, response, path):
+        """Write a streamed response body to a file in large blocks"""
+        # Copy from the raw stream instead of iterating small chunks in Python,
+        # still undoing any gzip/deflate content encoding
+        response.raw.decode_content = True
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(response.raw, f, DOWNLOAD_CHUNK_SIZE)
+    
+    def _get_study_zip(self, result_id, study_uid):
+        """
+        Get the path of a study ZIP from the API, downloading it unless a recent copy is cached
+        
+        The ZIP is spooled to disk because its index is at the end of the archive.
+        """
+        key = ('study', result_id, study_uid)
+        zip_path = self.download_cache.get(key)
+        if zip_path is not None:
+            logger.info(f"📦 Using cached download of study {study_uid}")
+            return zip_path
+        
+        # Wait for a background download of the study that has already started,
+        # or take over one that is still queued
+        with self._prefetch_lock:
+            pending = self._prefetches.get(study_uid)
+        if pending is not None and not pending.cancel():
+            logger.info(f"📦 Waiting for the prefetch of study {study_uid}")
+            pending.result()
+            zip_path = self.download_cache.get(key)
+            if zip_path is not None:
+                return zip_path
+        
+        return self._download_once(key, partial(self._download_study_zip, result_id, study_uid))
+    
+    def _download_once(self, key, download):
+        """
+        Run a download, or wait for the same download already running on another thread
+        
+        Concurrent retrievals of one study (e.g. two viewers opening it) share a
+        single download instead of each fetching the archive.
+        
+        Parameters:
+        -----------
+        key : tuple
+            Download cache key of the archive
+        download : callable
+            Downloads the archive and returns its path
+        
+        Returns:
+        --------
+        Path: Path of the archive, or None if the download failed
+        """
+        with self._download_lock:
+            future = self._downloads.get(key)
+            started = future is None
+            if started:
+                future = Future()
+                self._downloads[key] = future
+        
+        if not started:
+            logger.info(f"📦 Waiting for the download of {key[0]} {key[2]} already in progress")
+            return future.result()
+        
+        try:
+            zip_path = download()
+            future.set_result(zip_path)
+            return zip_path
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._download_lock:
+                del self._downloads[key]
+    
+    def _download_study_zip(self, result_id, study_uid):
+        """Download a study ZIP from the API into the download cache"""
+        key = ('study', result_id, study_uid)
+        response = self._request_study_zip(result_id, study_uid)
+        if response is None:
+            return None
+        
+        zip_path = self.download_cache.new_path()
+        try:
+            self._save_response(response, zip_path)
+        except BaseException:
+            self.download_cache.discard(zip_path)
+            raise
+        finally:
+            response.close()
+        
+        logger.info(f"📦 Downloaded ZIP file: {zip_path.stat().st_size} bytes")
+        
+        # A truncated or invalid download is not served again
+        if not zipfile.is_zipfile(zip_path):
+            self.download_cache.discard(zip_path)
+            raise zipfile.BadZipFile(f"Downloaded study {study_uid} is not a ZIP file")
+        
+        self.download_cache.add(key, zip_path)
+        return zip_path
+    
+    def prefetch_study(self, study_uid):
+        """
+        Start downloading a study ZIP in the background
+        
+        Called when a client lists the series of a study from the API, so the
+        C-GET or C-MOVE that usually follows finds the archive in the download
+        cache instead of waiting for the whole download.
+        
+        Parameters:
+        -----------
+        study_uid : str
+            StudyInstanceUID of the study to download
+        """
+        with self._prefetch_lock:
+            if study_uid in self._prefetches or len(self._prefetches) >= MAX_PENDING_PREFETCHES:
+                return
+            if self._prefetch_executor is None:
+                self._prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='study-prefetch')
+            future = self._prefetch_executor.submit(self._prefetch_study, study_uid)
+            self._prefetches[study_uid] = future
+        future.add_done_callback(partial(self._forget_prefetch, study_uid))
+    
+    def _prefetch_study(self, study_uid):
+        """Download a study into the download cache unless it is already there"""
+        try:
+            result_id = self.get_result_id_for_study(study_uid)
+            key = ('study', result_id, study_uid)
+            if result_id and self.download_cache.get(key) is None:
+                logger.info(f"📥 Prefetching study {study_uid}")
+                self._download_once(key, partial(self._download_study_zip, result_id, study_uid))
+        except Exception as e:
+            logger.warning(f"⚠️ Prefetching study {study_uid} failed: {e}")
+    
+    def _forget_prefetch(self, study_uid, future):
+        """Drop a finished or cancelled background download"""
+        with self._prefetch_lock:
+            if self._prefetches.get(study_uid) is future:
+                del self._prefetches[study_uid]
+    
+    def shutdown(self):
+        """Cancel queued background downloads without waiting for a running one"""
+        with self._prefetch_lock:
+            executor = self._prefetch_executor
+            self._prefetch_executor = None
+            pending = list(self._prefetches.values())
+        for future in pending:
+            future.cancel()
+        if executor:
+            executor.shutdown(wait=False)
+    
     def download_study_from_api(self, result_id, study_uid, series_filter=None, instance_filter=None):
         """Download study ZIP from API and extract DICOM files"""
         try:
-            # Ensure we have a valid authentication token
-            if not self.query_handler._authenticate():
-                logger.error("❌ Failed to authenticate for download")
+            zip_path = self._get_study_zip(result_id, study_uid)
+            if zip_path is None:
                 return []
             
-            # Prepare download URL and headers
-            url = f"{self.api_url}/processing/results/{result_id}/download_dicom_study/"
-            params = {"study_uid": study_uid}
-            headers = {"Authorization": f"Bearer {self.query_handler.api_uploader.auth_token}"}
-            
-            logger.info(f"🌐 Downloading from: {url}")
-            logger.info(f"📋 Parameters: {params}")
+            # Read the DICOM files straight out of the archive; the bytes are
+            # what the callers keep, so nothing is extracted to disk
+            file_data = []
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                for file_info in zip_ref.filelist:
+                    if file_info.filename.lower().endswith('.dcm'):
+                        # Apply filters if specified
+                        if series_filter or instance_filter:
+                            try:
+                                from pydicom import dcmread
+                                # Only the UIDs are needed to decide, so the header is parsed
+                                # from the compressed stream and members that don't match
+                                # are never decompressed past their pixel data
+                                with zip_ref.open(file_info) as member:
+                                    ds = dcmread(member, stop_before_pixels=True, specific_tags=FILTER_TAGS)
+                                
+                                if series_filter and getattr(ds, 'SeriesInstanceUID', '') != series_filter:
+                                    continue
+                                if instance_filter and getattr(ds, 'SOPInstanceUID', '') != instance_filter:
+                                    continue
+                            except Exception as e:
+                                logger.warning(f"⚠️ Could not read DICOM file for filtering: {e}")
+                                continue
+                        
+                        file_data.append(zip_ref.read(file_info))
             
-            # Download the ZIP file
-            response = requests.get(url, params=params, headers=headers, stream=True)
+            logger.info(f"📁 Extracted {len(file_data)} DICOM files")
             
-            # Handle authentication failure
-            if response.status_code == 401:
-                logger.warning("❌ Authentication failed during download, attempting to re-authenticate")
-                # Clear the existing token to force fresh authentication
-                with self.query_handler.api_uploader.auth_lock:
-                    self.query_handler.api_uploader.auth_token = None
-                
-                if self.query_handler._authenticate():
-                    # Retry with new token
-                    headers["Authorization"] = f"Bearer {self.query_handler.api_uploader.auth_token}"
-                    response = requests.get(url, params=params, headers=headers, stream=True)
-                    response.raise_for_status()
-                else:
-                    logger.error("❌ Re-authentication failed during download")
-                    return []
-            else:
-                response.raise_for_status()
+            return file_data
             
-            # Create temporary directory for extraction
-            with tempfile.TemporaryDirectory() as temp_dir:
-                zip_path = Path(temp_dir) / "study.zip"
-                
-                # Save ZIP file
-                with open(zip_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                
-                logger.info(f"📦 Downloaded ZIP file: {zip_path.stat().st_size} bytes")
-                
-                # Extract DICOM files
-                dicom_files = []
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                    for file_info in zip_ref.filelist:
-                        if file_info.filename.lower().endswith('.dcm'):
-                            # Extract to temporary location
-                            extracted_path = zip_ref.extract(file_info, temp_dir)
-                            
-                            # Apply filters if specified
-                            if series_filter or instance_filter:
-                                try:
-                                    from pydicom import dcmread
-                                    ds = dcmread(extracted_path)
-                                    
-                                    if series_filter and getattr(ds, 'SeriesInstanceUID', '') != series_filter:
-                                        continue
-                                    if instance_filter and getattr(ds, 'SOPInstanceUID', '') != instance_filter:
-                                        continue
-                                except Exception as e:
-                                    logger.warning(f"⚠️ Could not read DICOM file for filtering: {e}")
-                                    continue
-                            
-                            dicom_files.append(extracted_path)
-                
-                logger.info(f"📁 Extracted {len(dicom_files)} DICOM files")
-                
-                # Read files into memory (since temp_dir will be deleted)
-                file_data = []
-                for file_path in dicom_files:
-                    with open(file_path, 'rb') as f:
-                        file_data.append(f.read())
-                
-                return file_data
-                
         except Exception as e:
             logger.error(f"❌ Error downloading study from API: {e}")
             return []
 
-    def download_series_from_api(self, result_id, series_uid, instance_filter=None):
-        """Download series ZIP from API and extract DICOM files"""
+    def stream_study_from_api(self, result_id, study_uid):
+        """
+        Download a study ZIP from the API and stream its DICOM files one at a time
+        
+        The ZIP is spooled to a temporary file (its index is at the end of the archive),
+        then members are read lazily so only one DICOM file is held in memory at a time.
+        The archive is only held open while the iterator runs, so an iterator that is
+        never started (e.g. the association went away first) leaves nothing open.
+        
+        Returns:
+        --------
+        tuple: (number of DICOM files, iterator yielding the bytes of each file)
+        """
         try:
-            # Ensure we have a valid authentication token
-            if not self.query_handler._authenticate():
-                logger.error("❌ Failed to authenticate for series download")
-                return []
-            
-            # Prepare download URL and headers
-            url = f"{self.api_url}/processing/results/{result_id}/download_dicom_series/"
-            params = {"series_uid": series_uid}
-            headers = {"Authorization": f"Bearer {self.query_handler.api_uploader.auth_token}"}
-            
-            logger.info(f"🌐 Downloading series from: {url}")
-            logger.info(f"📋 Parameters: {params}")
+            zip_path = self._get_study_zip(result_id, study_uid)
+            if zip_path is None:
+                return 0, iter(())
             
-            # Download the ZIP file
-            response = requests.get(url, params=params, headers=headers, stream=True, timeout=300)
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                members = [
+                    file_info.filename for file_info in zip_ref.filelist
+                    if file_info.filename.lower().endswith('.dcm')
+                ]
+            logger.info(f"📁 Streaming {len(members)} DICOM files")
             
-            # Handle authentication failure
-            if response.status_code == 401:
-                logger.warning("❌ Authentication failed during series download, attempting to re-authenticate")
-                # Clear the existing token to force fresh authentication
-                with self.query_handler.api_uploader.auth_lock:
-                    self.query_handler.api_uploader.auth_token = None
-                
-                if self.query_handler._authenticate():
-                    # Retry with new token
-                    headers["Authorization"] = f"Bearer {self.query_handler.api_uploader.auth_token}"
-                    response = requests.get(url, params=params, headers=headers, stream=True, timeout=300)
-                    response.raise_for_status()
-                else:
-                    logger.error("❌ Re-authentication failed during series download")
-                    return []
-            elif response.status_code != 200:
-                logger.error(f"❌ API returned status {response.status_code}: {response.text[:200]}")
+        except Exception as e:
+            logger.error(f"❌ Error downloading study from API: {e}")
+            return 0, iter(())
+        
+        return len(members), self._iter_zip_members(zip_path, members)
+    
+    def _iter_zip_members(self, zip_path, members):
+        """Yield the bytes of each ZIP member, opening the archive on the first file"""
+        try:
+            zip_ref = zipfile.ZipFile(zip_path, 'r')
+        except (OSError, zipfile.BadZipFile) as e:
+            # Evicted from the download cache since the members were listed
+            logger.error(f"❌ Could not reopen downloaded study {zip_path}: {e}")
+            return
+        
+        with zip_ref:
+            for name in members:
+                yield zip_ref.read(name)
+
+    def download_series_from_api(self, result_id, series_uid, instance_filter=None):
+        """
+        Download series ZIP from API and extract DICOM files
+        
+        Returns:
+        --------
+        list: De-anonymized datasets, or the raw bytes of files that could not be processed
+        """
+        try:
+            zip_path = self._get_series_zip(result_id, series_uid)
+            if zip_path is None:
                 return []
             
-            # Check content type
-            content_type = response.headers.get('content-type', '').lower()
-            if 'application/zip' not in content_type and 'application/octet-stream' not in content_type:
-                logger.warning(f"⚠️ Unexpected content type: {content_type}")
-            
-            # Check content length
-            content_length = response.headers.get('content-length')
-            if content_length:
-                logger.info(f"📦 Expected download size: {int(content_length)} bytes")
-            else:
-                logger.warning("⚠️ No content-length header in response")
-            
-            # Create temporary directory for extraction
-            with tempfile.TemporaryDirectory() as temp_dir:
-                zip_path = Path(temp_dir) / "series.zip"
-                
-                # Save ZIP file
-                downloaded_size = 0
-                with open(zip_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:  # Filter out keep-alive chunks
-                            f.write(chunk)
-                            downloaded_size += len(chunk)
+            # Read the DICOM files straight out of the archive instead of extracting them
+            dicom_files = []
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                logger.info(f"📦 ZIP contains {len(zip_ref.filelist)} files")
                 
-                actual_size = zip_path.stat().st_size
-                logger.info(f"📦 Downloaded series ZIP file: {actual_size} bytes")
-                
-                # Validate ZIP file
-                if actual_size == 0:
-                    logger.error("❌ Downloaded ZIP file is empty")
-                    return []
-                
-                # Check if it's a valid ZIP file
-                try:
-                    with zipfile.ZipFile(zip_path, 'r') as test_zip:
-                        test_zip.testzip()
-                    logger.info("✅ ZIP file validation passed")
-                except zipfile.BadZipFile as e:
-                    logger.error(f"❌ Invalid ZIP file: {e}")
-                    return []
-                except Exception as e:
-                    logger.error(f"❌ ZIP validation error: {e}")
-                    return []
-                
-                # Extract DICOM files
-                dicom_files = []
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                    logger.info(f"📦 ZIP contains {len(zip_ref.filelist)} files")
-                    
-                    for file_info in zip_ref.filelist:
-                        # Skip directories
-                        if file_info.is_dir():
-                            continue
+                for file_info in zip_ref.filelist:
+                    # Skip directories
+                    if file_info.is_dir():
+                        continue
+                        
+                    # Check if it's a DICOM file (by extension or content)
+                    filename = file_info.filename.lower()
+                    if filename.endswith('.dcm') or filename.endswith('.dicom'):
+                        logger.debug(f"📄 Checking DICOM file: {file_info.filename}")
+                        
+                        try:
+                            # Verify it's actually a DICOM file by trying to read it,
+                            # parsing only the UIDs the filter needs from the compressed stream
+                            from pydicom import dcmread
+                            with zip_ref.open(file_info) as member:
+                                ds = dcmread(member, stop_before_pixels=True, specific_tags=FILTER_TAGS)
                             
-                        # Check if it's a DICOM file (by extension or content)
-                        filename = file_info.filename.lower()
-                        if filename.endswith('.dcm') or filename.endswith('.dicom'):
-                            logger.debug(f"📄 Extracting DICOM file: {file_info.filename}")
+                            # Apply instance filter if specified
+                            if instance_filter:
+                                if getattr(ds, 'SOPInstanceUID', '') != instance_filter:
+                                    logger.debug(f"⏭️ Skipping file - SOP Instance UID doesn't match filter")
+                                    continue
                             
-                            try:
-                                # Extract to temporary location
-                                extracted_path = zip_ref.extract(file_info, temp_dir)
-                                
-                                # Verify it's actually a DICOM file by trying to read it
-                                from pydicom import dcmread
-                                ds = dcmread(extracted_path, stop_before_pixels=True)
-                                
-                                # Apply instance filter if specified
-                                if instance_filter:
-                                    if getattr(ds, 'SOPInstanceUID', '') != instance_filter:
-                                        logger.debug(f"⏭️ Skipping file - SOP Instance UID doesn't match filter")
-                                        continue
-                                
-                                dicom_files.append(extracted_path)
-                                logger.debug(f"✅ Added DICOM file: {file_info.filename}")
-                                
-                            except Exception as e:
-                                logger.warning(f"⚠️ Could not process file {file_info.filename}: {e}")
-                                continue
-                        else:
-                            logger.debug(f"⏭️ Skipping non-DICOM file: {file_info.filename}")
+                            dicom_files.append(file_info)
+                            logger.debug(f"✅ Added DICOM file: {file_info.filename}")
+                            
+                        except Exception as e:
+                            logger.warning(f"⚠️ Could not process file {file_info.filename}: {e}")
+                            continue
+                    else:
+                        logger.debug(f"⏭️ Skipping non-DICOM file: {file_info.filename}")
                 
-                logger.info(f"📁 Successfully extracted {len(dicom_files)} valid DICOM files from series")
+                logger.info(f"📁 Found {len(dicom_files)} valid DICOM files in series")
                 
-                # Read files into memory and apply de-anonymization
+                # Read files into memory and apply de-anonymization. The parsed datasets
+                # are returned as they are, so callers don't serialize and parse them again
                 file_data = []
                 processed_count = 0
                 fallback_count = 0
                 
-                for i, file_path in enumerate(dicom_files, 1):
+                for i, file_info in enumerate(dicom_files, 1):
+                    try:
+                        logger.debug(f"📖 Processing DICOM file {i}/{len(dicom_files)}: {Path(file_info.filename).name}")
+                        data = zip_ref.read(file_info)
+                    except Exception as e:
+                        logger.error(f"❌ Failed to read file {file_info.filename} from ZIP: {e}")
+                        continue
+                    
                     try:
-                        logger.debug(f"📖 Processing DICOM file {i}/{len(dicom_files)}: {Path(file_path).name}")
-                        
                         # Read the DICOM file
                         from pydicom import dcmread
-                        ds = dcmread(file_path, force=True)
+                        ds = dcmread(BytesIO(data), force=True)
                         
                         # Log some basic info about the file
                         patient_name = getattr(ds, 'PatientName', 'Unknown')
@@ -283,44 +562,137 @@ class ApiIntegrationUtils:
                         # Ensure proper DICOM file metadata for pixel data accessibility
                         self._fix_dicom_file_metadata(ds)
                         
-                        # Convert back to bytes
-                        from io import BytesIO
-                        buffer = BytesIO()
-                        ds.save_as(buffer)
-                        file_data.append(buffer.getvalue())
+                        file_data.append(ds)
                         processed_count += 1
                         
                     except Exception as e:
-                        logger.warning(f"⚠️ Error processing DICOM file {Path(file_path).name}: {e}")
+                        logger.warning(f"⚠️ Error processing DICOM file {Path(file_info.filename).name}: {e}")
                         logger.warning(f"   Falling back to raw file read")
                         
-                        try:
-                            # Fallback: read file as-is without de-anonymization
-                            with open(file_path, 'rb') as f:
-                                file_data.append(f.read())
-                            fallback_count += 1
-                        except Exception as e2:
-                            logger.error(f"❌ Failed to read file even as raw bytes: {e2}")
-                            continue
-                
-                logger.info(f"📊 Processing complete: {processed_count} de-anonymized, {fallback_count} fallback, {len(file_data)} total files")
-                return file_data
+                        # Fallback: send the file as-is without de-anonymization
+                        file_data.append(data)
+                        fallback_count += 1
+            
+            logger.info(f"📊 Processing complete: {processed_count} de-anonymized, {fallback_count} fallback, {len(file_data)} total files")
+            return file_data
                 
         except Exception as e:
             logger.error(f"❌ Error downloading series from API: {e}")
             return []
+    
+    def _get_series_zip(self, result_id, series_uid):
+        """Get the path of a series ZIP from the API, downloading it unless a recent copy is cached"""
+        key = ('series', result_id, series_uid)
+        zip_path = self.download_cache.get(key)
+        if zip_path is not None:
+            logger.info(f"📦 Using cached download of series {series_uid}")
+            return zip_path
+        
+        return self._download_once(key, partial(self._download_series_zip, result_id, series_uid))
+    
+    def _download_series_zip(self, result_id, series_uid):
+        """Download a series ZIP from the API into the download cache"""
+        key = ('series', result_id, series_uid)
+        
+        # Ensure we have a valid authentication token
+        if not self.query_handler._authenticate():
+            logger.error("❌ Failed to authenticate for series download")
+            return None
+        
+        # Prepare download URL and headers
+        url = f"{self.api_url}/processing/results/{result_id}/download_dicom_series/"
+        params = {"series_uid": series_uid}
+        headers = {"Authorization": f"Bearer {self.query_handler.api_uploader.auth_token}"}
+        
+        logger.info(f"🌐 Downloading series from: {url}")
+        logger.info(f"📋 Parameters: {params}")
+        
+        # Download the ZIP file over the query handler's keep-alive session
+        response = self.query_handler.session.get(url, params=params, headers=headers, stream=True, timeout=300)
+        
+        # Handle authentication failure
+        if response.status_code == 401:
+            logger.warning("❌ Authentication failed during series download, attempting to re-authenticate")
+            # Clear the existing token to force fresh authentication
+            with self.query_handler.api_uploader.auth_lock:
+                self.query_handler.api_uploader.auth_token = None
+            
+            if self.query_handler._authenticate():
+                # Retry with new token, handing the rejected connection back to the pool first
+                response.close()
+                headers["Authorization"] = f"Bearer {self.query_handler.api_uploader.auth_token}"
+                response = self.query_handler.session.get(url, params=params, headers=headers, stream=True, timeout=300)
+                response.raise_for_status()
+            else:
+                logger.error("❌ Re-authentication failed during series download")
+                return None
+        elif response.status_code != 200:
+            logger.error(f"❌ API returned status {response.status_code}: {response.text[:200]}")
+            return None
+        
+        # Check content type
+        content_type = response.headers.get('content-type', '').lower()
+        if 'application/zip' not in content_type and 'application/octet-stream' not in content_type:
+            logger.warning(f"⚠️ Unexpected content type: {content_type}")
+        
+        # Check content length
+        content_length = response.headers.get('content-length')
+        if content_length:
+            logger.info(f"📦 Expected download size: {int(content_length)} bytes")
+        else:
+            logger.warning("⚠️ No content-length header in response")
+        
+        # Save ZIP file
+        zip_path = self.download_cache.new_path()
+        try:
+            self._save_response(response, zip_path)
+        except BaseException:
+            self.download_cache.discard(zip_path)
+            raise
+        finally:
+            response.close()
+        
+        actual_size = zip_path.stat().st_size
+        logger.info(f"📦 Downloaded series ZIP file: {actual_size} bytes")
+        
+        # Validate ZIP file
+        if actual_size == 0:
+            logger.error("❌ Downloaded ZIP file is empty")
+            self.download_cache.discard(zip_path)
+            return None
+        
+        # Check if it's a valid ZIP file
+        try:
+            with zipfile.ZipFile(zip_path, 'r') as test_zip:
+                test_zip.testzip()
+            logger.info("✅ ZIP file validation passed")
+        except zipfile.BadZipFile as e:
+            logger.error(f"❌ Invalid ZIP file: {e}")
+            self.download_cache.discard(zip_path)
+            return None
+        except Exception as e:
+            logger.error(f"❌ ZIP validation error: {e}")
+            self.download_cache.discard(zip_path)
+            return None
+        
+        # Only archives that passed validation are served again
+        self.download_cache.add(key, zip_path)
+        return zip_path
 
     def _deanonymize_dicom_dataset(self, dataset):
         """De-anonymize patient information in a DICOM dataset"""
         try:
             # Get the reverse mapping from anonymized names to original names
-            reverse_name_map = {v: k for k, v in self.query_handler.anonymizer.patient_name_map.items()}
+            reverse_name_map = self.query_handler.anonymizer.reverse_name_map
             
-            # De-anonymize PatientName if it exists and is anonymized
-            if hasattr(dataset, 'PatientName') and str(dataset.PatientName) in reverse_name_map:
-                original_name = reverse_name_map[str(dataset.PatientName)]
-                dataset.PatientName = original_name
-                logger.debug(f"De-anonymized PatientName: {str(dataset.PatientName)} -> {original_name}")
+            # De-anonymize PatientName if it exists and is anonymized, formatting it only once
+            patient_name = dataset.get('PatientName')
+            if patient_name:
+                anonymized_name = str(patient_name)
+                original_name = reverse_name_map.get(anonymized_name)
+                if original_name:
+                    dataset.PatientName = original_name
+                    logger.debug(f"De-anonymized PatientName: {anonymized_name} -> {original_name}")
             
             # Handle PatientID de-anonymization (supports both old and new formats)
             if hasattr(dataset, 'PatientID'):
@@ -414,6 +786,19 @@ class ApiIntegrationUtils:
             logger.error(f"❌ Error downloading study files for {study_uid}: {e}")
             return []
 
+    def stream_study_files(self, study_uid):
+        """Stream files for a study (see stream_study_from_api)"""
+        try:
+            result_id = self.get_result_id_for_study(study_uid)
+            if not result_id:
+                logger.warning(f"❌ No result_id found for study: {study_uid}")
+                return 0, iter(())
+            
+            return self.stream_study_from_api(result_id, study_uid)
+        except Exception as e:
+            logger.error(f"❌ Error streaming study files for {study_uid}: {e}")
+            return 0, iter(())
+
     def download_series_files(self, series_uid, study_uid):
         """Download files for a series (wrapper method for move handler compatibility)"""
         try:
@@ -440,126 +825,146 @@ class ApiIntegrationUtils:
             logger.error(f"❌ Error downloading image files for {sop_uid}: {e}")
             return []
 
+    def build_indexes(self, api_data, anonymization_utils):
+        """
+        Build the C-FIND rows of every level from API data in a single pass
+        
+        Parameters:
+        -----------
+        api_data : dict
+            De-anonymized API metadata
+        anonymization_utils : AnonymizationUtils
+            Utilities for de-anonymization
+            
+        Returns:
+        --------
+        IndexedApiData
+            Unique patients and studies, series per study and images per series
+        """
+        patients = {}
+        studies = {}
+        series_by_study = {}
+        images_by_series = {}
+        
+        # Each anonymized name/ID is resolved once per payload
+        original_names = {}
+        original_ids = {}
+        
+        def deanonymize(patient_name, patient_id):
+            if patient_name not in original_names:
+                original_names[patient_name] = anonymization_utils.get_original_patient_name(patient_name) or patient_name
+            if patient_id not in original_ids:
+                original_ids[patient_id] = anonymization_utils.get_original_patient_id(patient_id) or patient_id
+            return original_names[patient_name], original_ids[patient_id]
+        
+        for result_item in api_data.get('results') or []:
+            if 'dicom_data' not in result_item or 'studies' not in result_item['dicom_data']:
+                continue
+            
+            for study_uid, study_info in result_item['dicom_data']['studies'].items():
+                patient_id = study_info.get('patient_id', '')
+                original_name, original_id = deanonymize(study_info.get('patient_name', ''), patient_id)
+                
+                if patient_id and patient_id not in patients:
+                    patients[patient_id] = {
+                        'PatientName': original_name,
+                        'PatientID': original_id,
+                        'PatientBirthDate': study_info.get('patient_birth_date', ''),
+                        'PatientSex': study_info.get('patient_sex', '')
+                    }
+                
+                if study_uid and study_uid not in studies:
+                    studies[study_uid] = {
+                        'PatientName': original_name,
+                        'PatientID': original_id,
+                        'PatientBirthDate': study_info.get('patient_birth_date', ''),
+                        'PatientSex': study_info.get('patient_sex', ''),
+                        'StudyInstanceUID': study_uid,
+                        'StudyID': study_info.get('study_id', ''),
+                        'StudyDescription': study_info.get('study_description', ''),
+                        'StudyDate': study_info.get('study_date', ''),
+                        'StudyTime': study_info.get('study_time', ''),
+                        'AccessionNumber': study_info.get('accession_number', '')
+                    }
+                
+                study_series = series_by_study.setdefault(study_uid, {})
+                for series_uid, series_info in (study_info.get('series') or {}).items():
+                    if series_uid and series_uid not in study_series:
+                        study_series[series_uid] = {
+                            'PatientName': original_name,
+                            'PatientID': original_id,
+                            'StudyInstanceUID': study_uid,
+                            'SeriesInstanceUID': series_uid,
+                            'SeriesNumber': series_info.get('series_number', ''),
+                            'SeriesDescription': series_info.get('series_description', ''),
+                            'Modality': series_info.get('modality', ''),
+                            'SeriesDate': '',  # Not available in this structure
+                            'SeriesTime': ''   # Not available in this structure
+                        }
+                    
+                    series_images = images_by_series.setdefault((study_uid, series_uid), {})
+                    for instance_info in series_info.get('instances') or []:
+                        sop_uid = instance_info.get('sop_instance_uid', '')
+                        if sop_uid and sop_uid not in series_images:
+                            instance_name, instance_id = deanonymize(
+                                instance_info.get('patient_name', ''), instance_info.get('patient_id', '')
+                            )
+                            series_images[sop_uid] = {
+                                'PatientName': instance_name,
+                                'PatientID': instance_id,
+                                'StudyInstanceUID': study_uid,
+                                'SeriesInstanceUID': series_uid,
+                                'SOPInstanceUID': sop_uid,
+                                'SOPClassUID': '',  # Not available in this structure
+                                'InstanceNumber': instance_info.get('instance_number', '')
+                            }
+        
+        return IndexedApiData(
+            patients=list(patients.values()),
+            studies=list(studies.values()),
+            series_by_study={uid: list(rows.values()) for uid, rows in series_by_study.items()},
+            images_by_series={key: list(rows.values()) for key, rows in images_by_series.items()}
+        )
+    
+    def _get_indexes(self, api_data, anonymization_utils):
+        """
+        Get the indexes of a payload, reusing them while the same payload is passed in
+        
+        The shared metadata cache hands out one payload per TTL window, so the
+        drill-down levels of a C-FIND session are answered from one build.
+        """
+        with self._index_lock:
+            if self._indexed is None or self._indexed_source is not api_data:
+                self._indexed = self.build_indexes(api_data, anonymization_utils)
+                self._indexed_source = api_data
+            return self._indexed
+    
     def extract_patients_from_api_data(self, api_data, anonymization_utils):
         """Extract unique patients from API data with de-anonymization"""
-        unique_patients = {}
-        
         if not api_data or 'results' not in api_data:
             return []
         
-        for result_item in api_data['results']:
-            if 'dicom_data' in result_item and 'studies' in result_item['dicom_data']:
-                studies_data = result_item['dicom_data']['studies']
-                for study_uid, study_info in studies_data.items():
-                    patient_id = study_info.get('patient_id', '')
-                    if patient_id and patient_id not in unique_patients:
-                        # De-anonymize the patient information
-                        original_name = anonymization_utils.get_original_patient_name(study_info.get('patient_name', ''))
-                        original_id = anonymization_utils.get_original_patient_id(patient_id)
-                        
-                        unique_patients[patient_id] = {
-                            'PatientName': original_name or study_info.get('patient_name', ''),
-                            'PatientID': original_id or patient_id,
-                            'PatientBirthDate': study_info.get('patient_birth_date', ''),
-                            'PatientSex': study_info.get('patient_sex', '')
-                        }
-        
-        return list(unique_patients.values())
+        return list(self._get_indexes(api_data, anonymization_utils).patients)
     
     def extract_studies_from_api_data(self, api_data, anonymization_utils):
         """Extract unique studies from API data with de-anonymization"""
-        unique_studies = {}
-        
         if not api_data or 'results' not in api_data:
             return []
         
-        for result_item in api_data['results']:
-            if 'dicom_data' in result_item and 'studies' in result_item['dicom_data']:
-                studies_data = result_item['dicom_data']['studies']
-                for study_uid, study_info in studies_data.items():
-                    if study_uid and study_uid not in unique_studies:
-                        # De-anonymize the patient information
-                        original_name = anonymization_utils.get_original_patient_name(study_info.get('patient_name', ''))
-                        original_id = anonymization_utils.get_original_patient_id(study_info.get('patient_id', ''))
-                        
-                        unique_studies[study_uid] = {
-                            'PatientName': original_name or study_info.get('patient_name', ''),
-                            'PatientID': original_id or study_info.get('patient_id', ''),
-                            'PatientBirthDate': study_info.get('patient_birth_date', ''),
-                            'PatientSex': study_info.get('patient_sex', ''),
-                            'StudyInstanceUID': study_uid,
-                            'StudyID': study_info.get('study_id', ''),
-                            'StudyDescription': study_info.get('study_description', ''),
-                            'StudyDate': study_info.get('study_date', ''),
-                            'StudyTime': study_info.get('study_time', ''),
-                            'AccessionNumber': study_info.get('accession_number', '')
-                        }
-        
-        return list(unique_studies.values())
+        return list(self._get_indexes(api_data, anonymization_utils).studies)
     
     def extract_series_from_api_data(self, api_data, study_uid, anonymization_utils):
         """Extract series for a specific study from API data with de-anonymization"""
-        unique_series = {}
-        
         if not api_data or 'results' not in api_data:
             return []
         
-        for result_item in api_data['results']:
-            if 'dicom_data' in result_item and 'studies' in result_item['dicom_data']:
-                studies_data = result_item['dicom_data']['studies']
-                if study_uid in studies_data:
-                    study_info = studies_data[study_uid]
-                    if 'series' in study_info:
-                        for series_uid_key, series_info in study_info['series'].items():
-                            if series_uid_key and series_uid_key not in unique_series:
-                                # De-anonymize the patient information
-                                original_name = anonymization_utils.get_original_patient_name(study_info.get('patient_name', ''))
-                                original_id = anonymization_utils.get_original_patient_id(study_info.get('patient_id', ''))
-                                
-                                unique_series[series_uid_key] = {
-                                    'PatientName': original_name or study_info.get('patient_name', ''),
-                                    'PatientID': original_id or study_info.get('patient_id', ''),
-                                    'StudyInstanceUID': study_uid,
-                                    'SeriesInstanceUID': series_uid_key,
-                                    'SeriesNumber': series_info.get('series_number', ''),
-                                    'SeriesDescription': series_info.get('series_description', ''),
-                                    'Modality': series_info.get('modality', ''),
-                                    'SeriesDate': '',  # Not available in this structure
-                                    'SeriesTime': ''   # Not available in this structure
-                                }
-        
-        return list(unique_series.values())
+        indexed = self._get_indexes(api_data, anonymization_utils)
+        return list(indexed.series_by_study.get(study_uid, []))
     
     def extract_images_from_api_data(self, api_data, study_uid, series_uid, anonymization_utils):
         """Extract images for a specific series from API data with de-anonymization"""
-        unique_images = {}
-        
         if not api_data or 'results' not in api_data:
             return []
         
-        for result_item in api_data['results']:
-            if 'dicom_data' in result_item and 'studies' in result_item['dicom_data']:
-                studies_data = result_item['dicom_data']['studies']
-                if study_uid in studies_data:
-                    study_info = studies_data[study_uid]
-                    if 'series' in study_info and series_uid in study_info['series']:
-                        series_info = study_info['series'][series_uid]
-                        if 'instances' in series_info:
-                            for instance_info in series_info['instances']:
-                                sop_uid = instance_info.get('sop_instance_uid', '')
-                                if sop_uid and sop_uid not in unique_images:
-                                    # De-anonymize the patient information
-                                    original_name = anonymization_utils.get_original_patient_name(instance_info.get('patient_name', ''))
-                                    original_id = anonymization_utils.get_original_patient_id(instance_info.get('patient_id', ''))
-                                    
-                                    unique_images[sop_uid] = {
-                                        'PatientName': original_name or instance_info.get('patient_name', ''),
-                                        'PatientID': original_id or instance_info.get('patient_id', ''),
-                                        'StudyInstanceUID': study_uid,
-                                        'SeriesInstanceUID': series_uid,
-                                        'SOPInstanceUID': sop_uid,
-                                        'SOPClassUID': '',  # Not available in this structure
-                                        'InstanceNumber': instance_info.get('instance_number', '')
-                                    }
-        
-        return list(unique_images.values())
\ No newline at end of file
+        indexed = self._get_indexes(api_data, anonymization_utils)
+        return list(indexed.images_by_series.get((study_uid, series_uid), []))
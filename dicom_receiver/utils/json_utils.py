@@ -6,6 +6,7 @@ Provides a unified interface for JSON operations with automatic fallback
 from orjson (fast) to standard json (compatible)
 """
 
+import io
 import logging
 from typing import Any, Dict, Union, IO
 from pathlib import Path
@@ -106,10 +107,11 @@ def dump(obj: Any, fp: IO, indent: int = None, ensure_ascii: bool = True) -> Non
     
     Args:
         obj: Python object to serialize
-        fp: File-like object to write to
+        fp: File-like object to write to (text or binary)
         indent: Number of spaces for indentation (None for compact)
         ensure_ascii: Whether to escape non-ASCII characters
     """
+    binary = not isinstance(fp, io.TextIOBase)
     if HAS_ORJSON:
         # Convert non-string keys to strings for orjson compatibility
         obj = _convert_keys_to_strings(obj)
@@ -119,7 +121,10 @@ def dump(obj: Any, fp: IO, indent: int = None, ensure_ascii: bool = True) -> Non
             option |= orjson.OPT_INDENT_2
             
         result = orjson.dumps(obj, option=option)
-        fp.write(result.decode('utf-8'))
+        # Binary files take orjson's output as-is, without a decode/encode round trip
+        fp.write(result if binary else result.decode('utf-8'))
+    elif binary:
+        fp.write(json.dumps(obj, indent=indent, ensure_ascii=ensure_ascii).encode('utf-8'))
     else:
         json.dump(obj, fp, indent=indent, ensure_ascii=ensure_ascii)
 